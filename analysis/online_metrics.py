@@ -0,0 +1,160 @@
+# analysis/online_metrics.py
+"""
+String-stability and safety metrics accumulated while the simulation runs.
+
+run_simulation (and NumpyPlatoonEngine.simulate) call start() once with the
+platoon order and update() every step with the speeds and headways in that
+order; each update is O(N) and nothing per step is kept. report() returns the
+same layout as analysis.string_stability.analyze_run, so
+string_stability.write_report can store it.
+
+    metrics = OnlineMetrics(freq, window=(400, 500))
+    run_simulation(ref_speed, interrupt_time, freq, idm_duration, recorder=False, metrics=metrics)
+    write_report(metrics.report(), "output/metrics.json")
+"""
+import numpy as np
+
+
+class OnlineMetrics:
+    def __init__(self, freq, window=None):
+        self.freq = freq
+        self.dt = 1 / freq
+        self.window = window  # (t_start, t_end) in seconds for the per-step amplification
+        self.ids = None
+
+    def start(self, ids, min_gaps=None):
+        """
+        ids: vehicles in platoon order (leader first); min_gaps turn headways
+        into bumper gaps for TTC, as an array aligned with ids or a
+        {veh_id: min_gap} dict (which may gain vehicles later).
+        """
+        self.n_steps = 0
+        self._reset(ids, min_gaps)
+
+    def _reset(self, ids, min_gaps):
+        self.ids = list(ids)
+        n = len(self.ids)
+        n_followers = max(n - 1, 0)  # an empty platoon (nothing inserted yet) has no followers either
+        if isinstance(min_gaps, dict):
+            self._min_gap_of = min_gaps
+            min_gaps = [min_gaps.get(vid, 0.0) for vid in self.ids]
+        else:
+            self._min_gap_of = None
+        self.min_gaps = np.zeros(n) if min_gaps is None else np.asarray(min_gaps, dtype=float)
+        self.n_complete = 0
+        self.v_sum = 0.0
+        self.v_max = np.full(n, -np.inf)
+        self.v_min = np.full(n, np.inf)
+        self.dv_sq_sum = np.zeros(n_followers)
+        self.dv_abs_max = np.zeros(n_followers)
+        self.min_headway = np.full(n_followers, np.nan)
+        self.min_ttc = np.full(n_followers, np.inf)
+        self.a_max = np.full(n_followers, -np.inf)
+        self.a_min = np.full(n_followers, np.inf)
+        self.a_sum = np.zeros(n_followers)
+        self.a_lt1 = np.zeros(n_followers)
+        self.a_count = 0
+
+    def update(self, step, ids, speeds, headways):
+        """Add one step; ids/speeds/headways are the current vehicles in platoon order."""
+        self.n_steps += 1
+        if list(ids) != self.ids:
+            current, known = set(ids), set(self.ids)
+            if current > known:
+                # Vehicles still being inserted (SUMO): earlier steps were incomplete, start over
+                self._reset(ids, self._min_gap_of)
+            elif current != known:
+                # Only steps with the full platoon count (like pivot(...).dropna() in the notebooks)
+                return
+            else:
+                position = {vid: i for i, vid in enumerate(ids)}
+                order = [position[vid] for vid in self.ids]
+                speeds, headways = np.asarray(speeds)[order], np.asarray(headways)[order]
+
+        v = np.asarray(speeds, dtype=float)
+        h = np.asarray(headways, dtype=float)[1:]
+        self.n_complete += 1
+        self.v_sum += v.sum()
+        np.maximum(self.v_max, v, out=self.v_max)
+        np.minimum(self.v_min, v, out=self.v_min)
+
+        dv = v[:-1] - v[1:]
+        self.dv_sq_sum += dv * dv
+        np.maximum(self.dv_abs_max, np.abs(dv), out=self.dv_abs_max)
+        self.min_headway = np.fmin(self.min_headway, h)
+
+        # Time to collision while closing in on the vehicle ahead
+        closing = -dv
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ttc = np.where(closing > 0, (h + self.min_gaps[1:]) / closing, np.inf)
+        self.min_ttc = np.fmin(self.min_ttc, ttc)
+
+        if self.window is not None and self.window[0] <= step * self.dt < self.window[1]:
+            a_t = v[1:] / v[0] if v[0] != 0 else np.zeros(len(v) - 1)
+            np.maximum(self.a_max, a_t, out=self.a_max)
+            np.minimum(self.a_min, a_t, out=self.a_min)
+            self.a_sum += a_t
+            self.a_lt1 += a_t < 1
+            self.a_count += 1
+
+    def amplification(self):
+        """
+        max|v_n - v_eq| / max|v_leader - v_eq| per follower, v_eq = mean speed
+        of all vehicles. None without a complete step or when the leader never
+        left v_eq (nothing to amplify).
+        """
+        if not self.n_complete:
+            return None
+        v_eq = self.v_sum / (self.n_complete * len(self.ids))
+        # max|v - c| over a run is reached at its minimum or maximum
+        dev = np.maximum(self.v_max - v_eq, v_eq - self.v_min)
+        if not dev[0] > 0:
+            return None
+        return dev[1:] / dev[0]
+
+    def report(self):
+        if len(self.ids or ()) < 2 or not self.n_complete:
+            # Leader only, no vehicle yet, or never the whole platoon at once: nothing to compare
+            return {
+                "run": None,
+                "freq": self.freq,
+                "n_steps": getattr(self, "n_steps", 0),
+                "n_complete_steps": getattr(self, "n_complete", 0),
+                "head_to_tail_amplification": None,
+                "window": list(self.window) if self.window is not None else None,
+                "followers": [],
+                "per_follower": dict.fromkeys(["vehicle_id", "amplification", "max_abs_relative_speed",
+                                               "rms_relative_speed", "min_headway", "min_ttc"]),
+                "l2_string_stability": [],
+            }
+        followers = [f"Follower{i}" for i in range(1, len(self.ids))]
+        amplification = self.amplification()
+        norms = np.sqrt(self.dv_sq_sum)
+        per_follower = {
+            "vehicle_id": self.ids[1:],
+            "amplification": amplification.tolist() if amplification is not None else None,
+            "max_abs_relative_speed": self.dv_abs_max.tolist(),
+            "rms_relative_speed": np.sqrt(self.dv_sq_sum / self.n_complete).tolist(),
+            "min_headway": self.min_headway.tolist(),
+            "min_ttc": [ttc if np.isfinite(ttc) else None for ttc in self.min_ttc.tolist()],  # None: never closing in
+        }
+        if self.a_count:
+            per_follower["max_A"] = self.a_max.tolist()
+            per_follower["mean_A"] = (self.a_sum / self.a_count).tolist()
+            per_follower["min_A"] = self.a_min.tolist()
+            per_follower["percent_A_lt1"] = (self.a_lt1 / self.a_count * 100).tolist()
+
+        l2 = [{"Vehicle": role, "left_norm": float(left), "right_norm": float(right),
+               "violation": str(bool(right > left))}
+              for role, left, right in zip(followers[:-1], norms[:-1], norms[1:])]
+        return {
+            "run": None,
+            "freq": self.freq,
+            "n_steps": self.n_steps,
+            "n_complete_steps": self.n_complete,
+            "head_to_tail_amplification": float(amplification[-1]) if amplification is not None else None,
+            "window": list(self.window) if self.window is not None else None,
+            "followers": followers,
+            "per_follower": per_follower,
+            "l2_string_stability": l2,
+        }
@@ -1,63 +1,158 @@
+"""
+Speed plots of simulation runs.
+
+style="usetex" renders the publication PDF through LaTeX (Times, bold labels);
+style="fast" uses matplotlib's mathtext with the same layout and never spawns
+LaTeX. Long series are decimated before drawing (min-max buckets or LTTB), so
+a figure costs about the same for 1,000 or 100,000 samples per vehicle.
+
+Batch rendering of result files (Agg only, never blocks):
+    python -m analysis.plot_stability output/sweeps/<timestamp> --freq 50 --out figures/sweep --workers 8
+    python -m analysis.plot_stability output/straight/run.csv --freq 50 --style usetex --xlim 0 200
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import rcParams
-from controller.controller_manager import get_controller_name
-import traci
 
 # Plot styling
-rcParams["text.usetex"] = True
 rcParams["font.family"] = "serif"
-rcParams["font.serif"] = ["Times"]
 rcParams["font.size"] = 14
 rcParams["axes.labelsize"] = 16
 rcParams["xtick.labelsize"] = 14
 rcParams["ytick.labelsize"] = 14
 rcParams["legend.fontsize"] = 14
 
-def plot_speeds(time_log, ref_speed, speeds, cf_models = None, ref_vels = None, del_t = 0.1, save_path=None, xlim_start=None, xlim_end=None, ylim_bottom=None, ylim_top=None):
-    plt.figure(figsize=(8, 5))
+STYLES = {
+    "usetex": {"text.usetex": True, "font.serif": ["Times"]},
+    "fast": {"text.usetex": False, "font.serif": ["Times New Roman", "Times", "DejaVu Serif"],
+             "mathtext.fontset": "stix"},
+}
+
+MAX_POINTS = 4000  # samples drawn per vehicle after decimation
+
+
+def set_style(style="usetex"):
+    if style not in STYLES:
+        raise ValueError(f"Unknown plot style: {style}")
+    rcParams.update(STYLES[style])
+
+
+def bold(text, style="usetex"):
+    """Bold label in LaTeX (usetex) or mathtext (fast)."""
+    if style == "usetex":
+        return rf"\textbf{{{text}}}"
+    return r"$\mathbf{" + text.replace(" ", r"\ ") + "}$"
 
-    # Sort vehicle IDs (e.g., veh0, veh1, veh2, ...)
+
+def minmax_downsample(x, y, n_out):
+    """Keep the minimum and maximum of n_out // 2 equal buckets (plus the end points), in time order."""
+    n = len(y)
+    if n <= n_out or n_out < 4:
+        return x, y
+    n_buckets = n_out // 2
+    edges = np.linspace(0, n, n_buckets + 1).astype(int)
+    # Bucket start indices, reduceat works on contiguous slices
+    lo = np.minimum.reduceat(y, edges[:-1])
+    hi = np.maximum.reduceat(y, edges[:-1])
+    bucket = np.repeat(np.arange(n_buckets), np.diff(edges))
+    is_lo = y == lo[bucket]
+    is_hi = y == hi[bucket]
+    # First occurrence of the min and max in every bucket
+    first_lo = np.full(n_buckets, n)
+    first_hi = np.full(n_buckets, n)
+    idx = np.arange(n)
+    np.minimum.at(first_lo, bucket[is_lo], idx[is_lo])
+    np.minimum.at(first_hi, bucket[is_hi], idx[is_hi])
+    keep = np.unique(np.concatenate([[0, n - 1], first_lo, first_hi]))
+    return x[keep], y[keep]
+
+
+def lttb_downsample(x, y, n_out):
+    """Largest-Triangle-Three-Buckets: keeps the points that span the largest triangles."""
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return x, y
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of the next bucket (the last point for the final bucket)
+        nxt_end = edges[i + 2] if i + 2 < len(edges) else n
+        cx, cy = x[end:nxt_end].mean(), y[end:nxt_end].mean()
+        area = np.abs((x[a] - cx) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (cy - y[a]))
+        a = start + int(area.argmax())
+        keep[i + 1] = a
+    return x[keep], y[keep]
+
+
+DOWNSAMPLERS = {"minmax": minmax_downsample, "lttb": lttb_downsample, None: lambda x, y, n_out: (x, y)}
+
+
+def plot_speeds(time_log, ref_speed, speeds, cf_models = None, ref_vels = None, del_t = 0.1, save_path=None, xlim_start=None, xlim_end=None, ylim_bottom=None, ylim_top=None,
+                style="usetex", show=True, max_points=MAX_POINTS, downsample="minmax"):
+    # speeds: {veh_id: speed list} as returned by run_simulation; vehicles are drawn in veh number order
     sorted_ids = sorted(speeds.keys(), key=lambda vid: int(vid.replace("veh", "")))
+    series = []
+    for veh_id in sorted_ids:
+        speed_list = np.asarray(speeds[veh_id], dtype=float)
+        series.append((np.asarray(time_log[:len(speed_list)], dtype=float) * del_t, speed_list))
+    return plot_series(series, save_path, xlim_start, xlim_end, ylim_bottom, ylim_top, style, show, max_points, downsample)
+
 
-    for idx, veh_id in enumerate(sorted_ids):
-        speed_list = speeds[veh_id]
-        sliced_x = [time_log[i] * del_t for i in range(len(speed_list))]
-
-        if idx == 0:
-            label = "Leader"
-            linestyle = '-'
-            linewidth = 1.5
-
-        elif idx == 1:
-            label = "Follower1"
-            linestyle = '-'
-            linewidth = 1
-
-        else:
-            follower_num = idx
-            # controller_name = get_controller_name(veh_id) or "default"
-            if cf_models and veh_id in cf_models:
-                model = cf_models[veh_id]
-            else:
-                model = "unknown"
-            label = f"Follower{follower_num}"
-            linestyle = '-'
-            linewidth = 1.0
-
-        plt.plot(sliced_x, speed_list, label=label, linestyle=linestyle, linewidth=linewidth)
-
-    # plt.plot(sliced_x, ref_vels['veh1'], label='Reference r', linestyle='--')
-
-    plt.xlabel(r"\textbf{Time (s)}")
-    plt.ylabel(r"\textbf{Speed (m/s)}")
-    plt.title(r"\textbf{Speed Over Time}")
+def plot_recorder(recorder, freq, save_path=None, xlim_start=None, xlim_end=None, ylim_bottom=None, ylim_top=None,
+                  style="fast", show=False, max_points=MAX_POINTS, downsample="minmax"):
+    """Speed plot straight from a TrajectoryRecorder (vehicles in platoon order, no per-vehicle lists)."""
+    t = recorder.time_log / freq
+    series = []
+    for col in recorder.sorted_columns():
+        present = recorder.present[:, col]
+        series.append((t[present], recorder.speed[present, col].astype(float)))
+    return plot_series(series, save_path, xlim_start, xlim_end, ylim_bottom, ylim_top, style, show, max_points, downsample)
+
+
+def plot_series(series, save_path=None, xlim_start=None, xlim_end=None, ylim_bottom=None, ylim_top=None,
+                style="usetex", show=True, max_points=MAX_POINTS, downsample="minmax"):
+    """
+    Draw [(t, speed), ...] with the leader first. Returns the render time in
+    seconds (drawing and saving). show=False, or a non-interactive backend,
+    never blocks.
+    """
+    start = time.perf_counter()
+    set_style(style)
+    reduce = DOWNSAMPLERS[downsample]
+    fig = plt.figure(figsize=(8, 5))
+
+    for idx, (t, speed) in enumerate(series):
+        if xlim_start is not None or xlim_end is not None:
+            # Only decimate what is visible
+            visible = np.ones(len(t), dtype=bool)
+            if xlim_start is not None:
+                visible &= t >= xlim_start
+            if xlim_end is not None:
+                visible &= t <= xlim_end
+            t, speed = t[visible], speed[visible]
+        t, speed = reduce(t, speed, max_points)
+        label = "Leader" if idx == 0 else f"Follower{idx}"
+        linewidth = 1.5 if idx == 0 else 1.0
+        plt.plot(t, speed, label=label, linestyle='-', linewidth=linewidth)
+
+    plt.xlabel(bold("Time (s)", style))
+    plt.ylabel(bold("Speed (m/s)", style))
+    plt.title(bold("Speed Over Time", style))
     plt.legend()
     plt.grid(True)
 
     # Set x-axis limits
     if xlim_start is not None or xlim_end is not None:
         if xlim_end is None:
-            xlim_end = time_log[-1]
+            xlim_end = max(t[-1] for t, _ in series if len(t))
         plt.xlim(left=xlim_start, right=xlim_end)
 
     # Set y-axis limits
@@ -66,6 +161,62 @@ def plot_speeds(time_log, ref_speed, speeds, cf_models = None, ref_vels = None,
 
     plt.tight_layout()
     if save_path:
-        plt.savefig(save_path, dpi=300, format='pdf')
-        print(f"Plot saved to: {save_path}")
-    plt.show()
+        fmt = os.path.splitext(save_path)[1][1:] or "pdf"
+        plt.savefig(save_path, dpi=300, format=fmt)
+    elapsed = time.perf_counter() - start
+    if save_path:
+        print(f"Plot saved to: {save_path} ({elapsed:.2f} s)")
+    if show and plt.get_backend().lower() != "agg":
+        plt.show()
+    plt.close(fig)
+    return elapsed
+
+
+def _render(run_path, out_path, freq, style, xlim, max_points, downsample):
+    from controller.io_utils import load_trajectories
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    recorder = load_trajectories(run_path)
+    xlim = xlim or (None, None)
+    elapsed = plot_recorder(recorder, freq, out_path, xlim[0], xlim[1], style=style,
+                            max_points=max_points, downsample=downsample)
+    return run_path, out_path, elapsed
+
+
+def _init_worker():
+    plt.switch_backend("Agg")
+
+
+def main():
+    from analysis.string_stability import find_runs, _report_path
+
+    parser = argparse.ArgumentParser(description="Render speed plots for one run or a directory of runs.")
+    parser.add_argument("path", help="run file (.csv/.npz/.parquet), chunk directory, or directory of runs")
+    parser.add_argument("--freq", type=float, required=True, help="simulation frequency (Hz) of the runs")
+    parser.add_argument("--out", default="figures/batch", help="figure directory")
+    parser.add_argument("--format", choices=["pdf", "png", "svg"], default="pdf")
+    parser.add_argument("--style", choices=list(STYLES), default="fast",
+                        help="fast: mathtext, no LaTeX; usetex: publication PDF through LaTeX")
+    parser.add_argument("--xlim", type=float, nargs=2, metavar=("T_START", "T_END"))
+    parser.add_argument("--max-points", type=int, default=MAX_POINTS, help="samples drawn per vehicle")
+    parser.add_argument("--downsample", choices=["minmax", "lttb", "none"], default="minmax")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    _init_worker()
+    runs = find_runs(args.path)
+    print(f"Rendering {len(runs)} figures on {args.workers} workers -> {args.out}")
+    if not runs:
+        return
+    downsample = None if args.downsample == "none" else args.downsample
+    jobs = [(run, _report_path(run, args.path, args.out, args.format), args.freq, args.style,
+             args.xlim, args.max_points, downsample) for run in runs]
+    total = 0.0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as pool:
+        for run, out_path, elapsed in pool.map(_render, *zip(*jobs)):
+            total += elapsed
+    print(f"Rendered {len(runs)} figures, {total / len(runs):.2f} s per figure")
+
+
+if __name__ == "__main__":
+    main()
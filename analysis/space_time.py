@@ -0,0 +1,223 @@
+# analysis/space_time.py
+"""
+Rasterized space-time figures for platoons of any size.
+
+Recorded (time, x, speed) samples are binned straight into a fixed
+(time bins x position bins) grid with np.bincount, so the cost is linear in
+the number of samples and does not depend on how many vehicles there are.
+The grid is drawn as one image (imshow), so the PDF holds a single embedded
+bitmap instead of one vector path per vehicle.
+
+- kind="heatmap": mean speed per coarse cell (200 x 400 by default), like
+  plot_spatiotemporal_heatmap in analysis/data_analysis.ipynb
+- kind="trajectories": pixel-sized cells, so every vehicle's trajectory
+  shows up as a line coloured by its speed, like plot_time_space_diagram
+
+Samples come from a TrajectoryRecorder or from a CSV, Parquet, NPZ or
+StreamingRecorder chunk directory, read block by block:
+    python -m analysis.space_time output/straight/run.csv --freq 50 --kind heatmap --out figures/straight/heatmap.pdf
+    python -m analysis.space_time output/sweeps/<timestamp>/<job>/chunks --freq 50 --kind trajectories --out st.pdf
+"""
+import argparse
+import os
+import time
+import zipfile
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+from analysis.plot_stability import set_style, bold
+from controller.recorder import iter_chunks
+
+BINS = {"heatmap": (200, 400), "trajectories": (1600, 800)}
+BLOCK_SAMPLES = 2_000_000  # samples binned per block
+
+
+class SpaceTimeRaster:
+    """Sum of speed and sample count per (time, position) cell; add() can be called block by block."""
+
+    def __init__(self, t_range, x_range, bins=BINS["heatmap"]):
+        self.t_range = (float(t_range[0]), float(t_range[1]))
+        self.x_range = (float(x_range[0]), float(x_range[1]))
+        self.bins = tuple(int(b) for b in bins)
+        n = self.bins[0] * self.bins[1]
+        self.speed_sum = np.zeros(n)
+        self.count = np.zeros(n, dtype=np.int64)
+        self.n_samples = 0
+
+    def _index(self, values, lo, hi, n_bins):
+        # Right edge included in the last bin, like np.histogram
+        scale = n_bins / (hi - lo) if hi > lo else 0.0
+        return np.minimum(((values - lo) * scale).astype(np.int64), n_bins - 1)
+
+    def add(self, t, x, speed):
+        t, x, speed = (np.asarray(a, dtype=float).ravel() for a in (t, x, speed))
+        keep = (np.isfinite(t) & np.isfinite(x) & np.isfinite(speed)
+                & (t >= self.t_range[0]) & (t <= self.t_range[1])
+                & (x >= self.x_range[0]) & (x <= self.x_range[1]))
+        t, x, speed = t[keep], x[keep], speed[keep]
+        cell = (self._index(t, *self.t_range, self.bins[0]) * self.bins[1]
+                + self._index(x, *self.x_range, self.bins[1]))
+        n = len(self.count)
+        self.speed_sum += np.bincount(cell, weights=speed, minlength=n)
+        self.count += np.bincount(cell, minlength=n)
+        self.n_samples += len(cell)
+
+    def mean_speed(self):
+        """(time bins x position bins) mean speed, NaN where no vehicle was."""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = self.speed_sum / self.count
+        return mean.reshape(self.bins)
+
+
+def iter_samples(source, freq, block_samples=BLOCK_SAMPLES):
+    """
+    Yield (t in seconds, x, speed) blocks of at most about block_samples
+    samples from a recorder, a run file or a chunk directory.
+    """
+    if isinstance(source, str) and os.path.isdir(source):
+        for meta, arrays, present in iter_chunks(source):
+            rows = meta["first_step"] + np.arange(meta["n_steps"])
+            yield from _recorder_blocks(rows, arrays["x"], arrays["speed"], present, freq, block_samples)
+    elif isinstance(source, str) and source.endswith(".csv"):
+        import pandas as pd
+
+        for df in pd.read_csv(source, usecols=["time_step", "x", "speed_mps"], chunksize=block_samples):
+            yield df["time_step"].to_numpy() / freq, df["x"].to_numpy(), df["speed_mps"].to_numpy()
+    elif isinstance(source, str) and source.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(source).iter_batches(block_samples, columns=["time_step", "x", "speed_mps"]):
+            yield (batch.column("time_step").to_numpy() / freq, batch.column("x").to_numpy(zero_copy_only=False),
+                   batch.column("speed_mps").to_numpy(zero_copy_only=False))
+    elif isinstance(source, str) and source.endswith(".npz"):
+        yield from _npz_blocks(source, freq, block_samples)
+    else:
+        if isinstance(source, str):
+            from controller.io_utils import load_trajectories
+
+            source = load_trajectories(source)
+        yield from _recorder_blocks(source.time_log, source.x, source.speed, source.present, freq, block_samples)
+
+
+def _npy_header(f):
+    version = np.lib.format.read_magic(f)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    return read_header(f)
+
+
+def _npz_blocks(path, freq, block_samples):
+    """
+    Rows of the x, speed and present arrays of a save_trajectories .npz,
+    decompressed block by block straight from the zip members (np.load would
+    inflate each whole array).
+    """
+    with zipfile.ZipFile(path) as zf:
+        with zf.open("time_log.npy") as f:
+            steps = np.lib.format.read_array(f)
+        members = [zf.open(f"{name}.npy") for name in ("x", "speed", "present")]
+        try:
+            headers = [_npy_header(f) for f in members]
+            if any(fortran_order or dtype.hasobject for _, fortran_order, dtype in headers):
+                # Not written row by row: fall back to whole arrays (still only these three)
+                with np.load(path) as data:
+                    yield from _recorder_blocks(steps, data["x"], data["speed"], data["present"], freq, block_samples)
+                return
+            n_rows, n_cols = headers[0][0]
+            rows_per_block = max(1, block_samples // max(1, n_cols))
+            for start in range(0, n_rows, rows_per_block):
+                n = min(rows_per_block, n_rows - start)
+                x, speed, present = (np.frombuffer(f.read(n * n_cols * dtype.itemsize), dtype).reshape(n, n_cols)
+                                     for f, (_, _, dtype) in zip(members, headers))
+                yield from _recorder_blocks(steps[start:start + n], x, speed, present, freq, block_samples)
+        finally:
+            for f in members:
+                f.close()
+
+
+def _recorder_blocks(steps, x, speed, present, freq, block_samples):
+    rows_per_block = max(1, block_samples // max(1, x.shape[1]))
+    for start in range(0, len(steps), rows_per_block):
+        block = slice(start, start + rows_per_block)
+        mask = present[block]
+        t = np.broadcast_to((steps[block] / freq)[:, None], mask.shape)
+        yield t[mask], x[block][mask], speed[block][mask]
+
+
+def sample_ranges(source, freq, block_samples=BLOCK_SAMPLES):
+    """(t_min, t_max), (x_min, x_max) over all samples, in one pass."""
+    t_lo = x_lo = np.inf
+    t_hi = x_hi = -np.inf
+    for t, x, _ in iter_samples(source, freq, block_samples):
+        if len(t):
+            t_lo, t_hi = min(t_lo, np.nanmin(t)), max(t_hi, np.nanmax(t))
+            x_lo, x_hi = min(x_lo, np.nanmin(x)), max(x_hi, np.nanmax(x))
+    return (t_lo, t_hi), (x_lo, x_hi)
+
+
+def rasterize(source, freq, kind="heatmap", bins=None, t_range=None, x_range=None, block_samples=BLOCK_SAMPLES):
+    """Bin a whole run; ranges default to the data (one extra pass over the source)."""
+    if t_range is None or x_range is None:
+        data_t, data_x = sample_ranges(source, freq, block_samples)
+        t_range = t_range or data_t
+        x_range = x_range or data_x
+    raster = SpaceTimeRaster(t_range, x_range, bins or BINS[kind])
+    for t, x, speed in iter_samples(source, freq, block_samples):
+        raster.add(t, x, speed)
+    return raster
+
+
+def plot_space_time(raster, save_path=None, kind="heatmap", cmap=plt.cm.RdYlGn, vmin=0, vmax=33,
+                    style="fast", ylim_top=None, dpi=300, show=False):
+    """Draw a raster as one embedded image. Returns the render time in seconds."""
+    start = time.perf_counter()
+    set_style(style)
+    fig = plt.figure(figsize=(10, 4) if kind == "heatmap" else (10, 5))
+    image = plt.imshow(raster.mean_speed().T, origin="lower", aspect="auto", interpolation="nearest",
+                       extent=(*raster.t_range, *raster.x_range), cmap=cmap.with_extremes(bad="white"),
+                       vmin=vmin, vmax=vmax)
+    cbar = plt.colorbar(image, pad=0)
+    cbar.set_label(bold("Speed (m/s)", style))
+    plt.xlabel(bold("Time (s)", style))
+    plt.ylabel(bold("Longitudinal Position (m)", style))
+    title = "Time–Space Heatmap of Vehicle Speeds" if kind == "heatmap" else "Time–Space Diagram"
+    plt.title(bold(title, style))
+    if ylim_top is not None:
+        plt.ylim(top=ylim_top)
+
+    if save_path:
+        os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+        fmt = os.path.splitext(save_path)[1][1:] or "pdf"
+        plt.savefig(save_path, dpi=dpi, format=fmt, bbox_inches="tight")
+    elapsed = time.perf_counter() - start
+    if save_path:
+        print(f"Plot saved to: {save_path} ({elapsed:.2f} s)")
+    if show and plt.get_backend().lower() != "agg":
+        plt.show()
+    plt.close(fig)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rasterized space-time heatmap or trajectory diagram of one run.")
+    parser.add_argument("path", help="run file (.csv/.npz/.parquet) or chunk directory")
+    parser.add_argument("--freq", type=float, required=True, help="simulation frequency (Hz) of the run")
+    parser.add_argument("--kind", choices=list(BINS), default="heatmap")
+    parser.add_argument("--out", required=True, help="figure path (.pdf/.png)")
+    parser.add_argument("--bins", type=int, nargs=2, metavar=("TIME", "POSITION"), help="grid size")
+    parser.add_argument("--t-range", type=float, nargs=2, metavar=("T_START", "T_END"))
+    parser.add_argument("--x-range", type=float, nargs=2, metavar=("X_MIN", "X_MAX"))
+    parser.add_argument("--style", choices=["fast", "usetex"], default="fast")
+    parser.add_argument("--block-samples", type=int, default=BLOCK_SAMPLES, help="samples read and binned at once")
+    args = parser.parse_args()
+
+    plt.switch_backend("Agg")
+    start = time.perf_counter()
+    raster = rasterize(args.path, args.freq, args.kind, args.bins, args.t_range, args.x_range, args.block_samples)
+    print(f"Binned {raster.n_samples} samples into {raster.bins[0]} x {raster.bins[1]} cells "
+          f"({time.perf_counter() - start:.2f} s)")
+    plot_space_time(raster, args.out, args.kind, style=args.style)
+
+
+if __name__ == "__main__":
+    main()
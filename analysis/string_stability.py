@@ -0,0 +1,356 @@
+# analysis/string_stability.py
+"""
+String-stability metrics from analysis/string_stability_test.ipynb, working on
+(time x vehicle) arrays instead of re-reading and re-pivoting the CSV per call.
+
+A run (CSV, NPZ, Parquet or StreamingRecorder chunk directory) is loaded once
+through load_run(), which is memoized on the file path and mtime. Vehicles
+are in platoon order (leader first), and every metric is evaluated for all
+successive pairs at once.
+
+    python -m analysis.string_stability output/sweeps/<timestamp> --freq 50 --workers 8
+    python -m analysis.string_stability output/straight/run.csv --freq 50 --format parquet
+"""
+import argparse
+import functools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from controller.io_utils import load_trajectories
+
+RUN_EXTENSIONS = (".csv", ".npz", ".parquet")
+
+
+class Run:
+    """One simulation run as (steps x vehicles) arrays in platoon order."""
+
+    def __init__(self, path, recorder, freq):
+        cols = recorder.sorted_columns()
+        self.path = path
+        self.freq = freq
+        self.dt = 1 / freq
+        self.ids = [recorder.ids[col] for col in cols]
+        self.roles = ["Leader"] + [f"Follower{i}" for i in range(1, len(cols))]
+        self.time = recorder.time_log * self.dt
+        self.speed = recorder.speed[:, cols]
+        self.acceleration = recorder.acceleration[:, cols]
+        self.x = recorder.x[:, cols]
+        self.headway = recorder.headway[:, cols]
+        # Steps where every vehicle was recorded (the notebooks' pivot(...).dropna())
+        self.complete = recorder.present[:, cols].all(axis=1)
+
+    def column(self, name):
+        return getattr(self, {"speed_mps": "speed", "space_headway": "headway"}.get(name, name))
+
+    def window(self, t_start=None, t_end=None):
+        """Row mask of complete steps with t_start <= t < t_end (seconds)."""
+        mask = self.complete.copy()
+        if t_start is not None:
+            mask &= self.time >= t_start
+        if t_end is not None:
+            mask &= self.time < t_end
+        return mask
+
+
+@functools.lru_cache(maxsize=16)
+def _load_run(path, freq, mtime):
+    return Run(path, load_trajectories(path), freq)
+
+
+def load_run(path, freq):
+    """Load a run once; later calls with the same unchanged file reuse the arrays."""
+    path = os.path.abspath(path)
+    return _load_run(path, freq, os.path.getmtime(path))
+
+
+def relative_deviation(run, metric="speed"):
+    """
+    speed: predecessor minus follower speed for every successive pair
+    (steps x followers); headway: the followers' space headways.
+    """
+    if metric == "speed":
+        return run.speed[:, :-1] - run.speed[:, 1:]
+    if metric == "headway":
+        return run.headway[:, 1:]
+    raise ValueError("Metric must be 'speed' or 'headway'")
+
+
+def head_to_tail_amplification(run, t_start=None, t_end=None):
+    """
+    A_n = max|v_n(t) - v_eq| / max|v_leader(t) - v_eq| for every follower n,
+    with v_eq the mean speed of all vehicles. The last entry is the
+    head-to-tail amplification.
+    """
+    speed = run.speed[run.window(t_start, t_end)]
+    v_eq = np.mean(speed)
+    dev = np.abs(speed - v_eq)
+    return dev[:, 1:].max(axis=0) / dev[:, 0].max()
+
+
+def amplification_window(run, t_start, t_end):
+    """
+    Per-step amplification A_t = v_n(t) / v_leader(t) of every follower over
+    [t_start, t_end), with division by zero counted as 0, and its summary.
+    """
+    speed = run.speed[run.window(t_start, t_end)]
+    leader = speed[:, :1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a_t = np.where(leader != 0, speed[:, 1:] / leader, 0.0)
+    summary = {
+        "max_A": a_t.max(axis=0),
+        "mean_A": a_t.mean(axis=0),
+        "min_A": a_t.min(axis=0),
+        "percent_A_lt1": (a_t < 1).mean(axis=0) * 100,
+    }
+    return a_t, summary
+
+
+def transfer_ratio(run, column="speed_mps", t_start=None, t_end=None):
+    """
+    |FFT(follower)| / |FFT(predecessor)| for every successive pair, on the
+    positive frequencies. Returns (freqs, ratios of shape (bins, followers)).
+    """
+    values = run.column(column)[run.window(t_start, t_end)]
+    spectrum = np.abs(np.fft.rfft(values, axis=0))
+    n = len(values)
+    freqs = np.fft.rfftfreq(n, d=run.dt)[:n // 2]
+    ratios = spectrum[:n // 2, 1:] / (spectrum[:n // 2, :-1] + 1e-6)  # Avoid divide-by-zero
+    return freqs, ratios
+
+
+class WelchTransfer:
+    """
+    Welch estimate of the transfer function G(jw) = S_xy / S_xx from every
+    input vehicle x to its follower y, where x is the predecessor
+    (reference="predecessor") or the leader (reference="leader").
+
+    Rows (steps x vehicles, platoon order) are fed in blocks through update().
+    Every block is cut into Hann-windowed, mean-removed segments of nperseg
+    samples with `overlap` (fraction) between them. One rfft covers all
+    vehicles and segments at once, and the auto and cross spectra are summed
+    over segments. Only the unfinished segment tail is kept between blocks,
+    so memory stays bounded on long runs.
+    """
+
+    def __init__(self, freq, nperseg=1024, overlap=0.5, reference="predecessor", batch_values=4_000_000):
+        if reference not in ("predecessor", "leader"):
+            raise ValueError("Reference must be 'predecessor' or 'leader'")
+        self.freq = freq
+        self.nperseg = int(nperseg)
+        self.step = max(1, self.nperseg - int(self.nperseg * overlap))
+        self.reference = reference
+        self.batch_values = batch_values  # samples per batched rfft (segments x nperseg x vehicles)
+        n = np.arange(self.nperseg)
+        self.taper = 0.5 - 0.5 * np.cos(2 * np.pi * n / self.nperseg)  # periodic Hann
+        self.freqs = np.fft.rfftfreq(self.nperseg, d=1 / freq)
+        self._tail = None
+        self.n_segments = 0
+        self.s_xx = self.s_yy = self.s_xy = None
+
+    def _inputs(self, spectra):
+        # spectra: (..., vehicles); input spectrum for every follower
+        if self.reference == "leader":
+            return np.broadcast_to(spectra[..., :1], spectra[..., 1:].shape)
+        return spectra[..., :-1]
+
+    def update(self, rows):
+        rows = np.asarray(rows, dtype=float)
+        if self._tail is not None:
+            rows = np.concatenate([self._tail, rows])
+        n_seg = (len(rows) - self.nperseg) // self.step + 1 if len(rows) >= self.nperseg else 0
+        batch = max(1, self.batch_values // (self.nperseg * rows.shape[1]))
+        for first in range(0, n_seg, batch):
+            count = min(batch, n_seg - first)
+            # (segments x samples x vehicles)
+            starts = (first + np.arange(count)) * self.step
+            segments = rows[starts[:, None] + np.arange(self.nperseg)]
+            segments = segments - segments.mean(axis=1, keepdims=True)
+            spectra = np.fft.rfft(segments * self.taper[:, None], axis=1)
+            x, y = self._inputs(spectra), spectra[..., 1:]
+            s_xx = (np.abs(x) ** 2).sum(axis=0)
+            s_yy = (np.abs(y) ** 2).sum(axis=0)
+            s_xy = (np.conj(x) * y).sum(axis=0)
+            if self.s_xx is None:
+                self.s_xx, self.s_yy, self.s_xy = s_xx, s_yy, s_xy
+            else:
+                self.s_xx += s_xx
+                self.s_yy += s_yy
+                self.s_xy += s_xy
+            self.n_segments += count
+        self._tail = rows[n_seg * self.step:]
+        return self
+
+    def gain(self, power_floor=1e-6):
+        """
+        (freqs, |G| of shape (bins, followers)). Bins where the input power is
+        below power_floor times its peak carry no information and are NaN.
+        """
+        if not self.n_segments:
+            raise ValueError(f"Need at least nperseg={self.nperseg} samples")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gain = np.abs(self.s_xy) / self.s_xx
+        gain[self.s_xx <= power_floor * self.s_xx.max(axis=0)] = np.nan
+        return self.freqs, gain
+
+    def coherence(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.abs(self.s_xy) ** 2 / (self.s_xx * self.s_yy)
+
+    def peaks(self, power_floor=1e-6):
+        """Peak |G| and its frequency per follower, skipping the DC bin."""
+        freqs, gain = self.gain(power_floor)
+        gain = np.where(np.isnan(gain[1:]), -np.inf, gain[1:])
+        idx = gain.argmax(axis=0)
+        return gain[idx, np.arange(gain.shape[1])], freqs[1:][idx]
+
+
+def welch_transfer(run, column="speed_mps", nperseg=1024, overlap=0.5, reference="predecessor",
+                   t_start=None, t_end=None, block_steps=None):
+    """
+    WelchTransfer over one run. block_steps feeds the rows in blocks of that
+    many steps (bounded memory); None processes the window in one go.
+    """
+    values = run.column(column)[run.window(t_start, t_end)]
+    estimator = WelchTransfer(run.freq, min(nperseg, len(values)), overlap, reference)
+    block_steps = block_steps or len(values)
+    for start in range(0, len(values), block_steps):
+        estimator.update(values[start:start + block_steps])
+    return estimator
+
+
+def l2_string_stability(run, column="speed_mps", t_start=None, t_end=None):
+    """
+    L2 norm of the relative velocity to the predecessor (left) and of the
+    follower to this vehicle (right) for every vehicle with both neighbours;
+    right > left is a violation. Same records as Reports/time_domain_string_stability.json.
+    """
+    values = run.column(column)[run.window(t_start, t_end)]
+    norms = np.linalg.norm(values[:, 1:] - values[:, :-1], axis=0)
+    left, right = norms[:-1], norms[1:]
+    return [{"Vehicle": role, "left_norm": float(l), "right_norm": float(r), "violation": str(bool(r > l))}
+            for role, l, r in zip(run.roles[1:-1], left, right)]
+
+
+def analyze_run(path, freq, window=None, fft_window=None, column="speed_mps", nperseg=1024):
+    """All metrics of one run as a JSON-serializable report."""
+    run = load_run(path, freq)
+    fft_window = fft_window or (None, None)
+    followers = run.roles[1:]
+
+    amplification = head_to_tail_amplification(run)
+    freqs, ratios = transfer_ratio(run, column, *fft_window)
+    rel_speed = relative_deviation(run, "speed")[run.complete]
+    per_follower = {
+        "vehicle_id": run.ids[1:],
+        "amplification": amplification.tolist(),
+        "max_abs_relative_speed": np.abs(rel_speed).max(axis=0).tolist(),
+        "rms_relative_speed": np.sqrt(np.mean(rel_speed ** 2, axis=0)).tolist(),
+        "min_headway": np.nanmin(relative_deviation(run, "headway")[run.complete], axis=0).tolist(),
+        "max_transfer_ratio": ratios[1:].max(axis=0).tolist(),  # skip the DC bin
+        "peak_frequency_hz": freqs[1:][ratios[1:].argmax(axis=0)].tolist(),
+    }
+    for reference, suffix in (("predecessor", ""), ("leader", "_from_leader")):
+        peak_gain, peak_freq = welch_transfer(run, column, nperseg, reference=reference,
+                                              t_start=fft_window[0], t_end=fft_window[1]).peaks()
+        per_follower["welch_peak_gain" + suffix] = peak_gain.tolist()
+        per_follower["welch_peak_frequency_hz" + suffix] = peak_freq.tolist()
+    if window is not None:
+        _, summary = amplification_window(run, *window)
+        for key, values in summary.items():
+            per_follower[key] = values.tolist()
+
+    return {
+        "run": path,
+        "freq": freq,
+        "n_steps": int(len(run.time)),
+        "n_complete_steps": int(run.complete.sum()),
+        "head_to_tail_amplification": float(amplification[-1]),
+        "window": list(window) if window is not None else None,
+        "fft_window": list(fft_window),
+        "nperseg": nperseg,
+        "followers": followers,
+        "per_follower": per_follower,
+        "l2_string_stability": l2_string_stability(run, column),
+    }
+
+
+def write_report(report, out_path):
+    """Write a report as .json, or as .parquet (one row per follower, run-level values repeated)."""
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    if out_path.endswith(".parquet"):
+        import pandas as pd
+
+        df = pd.DataFrame(report["per_follower"], index=pd.Index(report["followers"], name="role")).reset_index()
+        l2 = {row["Vehicle"]: row for row in report["l2_string_stability"]}
+        df["l2_left_norm"] = [l2[role]["left_norm"] if role in l2 else np.nan for role in df["role"]]
+        df["l2_right_norm"] = [l2[role]["right_norm"] if role in l2 else np.nan for role in df["role"]]
+        for key in ("run", "freq", "n_steps", "head_to_tail_amplification"):
+            df[key] = report[key]
+        df.to_parquet(out_path, index=False)
+    else:
+        with open(out_path, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+def find_runs(path):
+    """Run files (and chunk directories) under path, or path itself if it is a run."""
+    if os.path.isfile(path) or _is_chunk_dir(path):
+        return [path]
+    runs = []
+    for root, dirs, files in os.walk(path):
+        for d in list(dirs):
+            if _is_chunk_dir(os.path.join(root, d)):
+                runs.append(os.path.join(root, d))
+                dirs.remove(d)
+        runs += [os.path.join(root, f) for f in files
+                 if f.endswith(RUN_EXTENSIONS) and f != "summary.csv" and not f.startswith("chunk_")]
+    return sorted(runs)
+
+
+def _is_chunk_dir(path):
+    return any(name.startswith("chunk_") for name in os.listdir(path))
+
+
+def _report_path(run_path, root, out_dir, fmt):
+    # The run's extension stays in the name (run.csv.json), so run.csv and run.npz side by side do not collide
+    rel = os.path.relpath(run_path, root) if os.path.isdir(root) and run_path != root else os.path.basename(run_path)
+    return os.path.join(out_dir, rel + "." + fmt)
+
+
+def _process(run_path, out_path, freq, window, fft_window, column, nperseg):
+    report = analyze_run(run_path, freq, window, fft_window, column, nperseg)
+    write_report(report, out_path)
+    return run_path, out_path, report["head_to_tail_amplification"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="String-stability reports for one run or a directory of runs.")
+    parser.add_argument("path", help="run file (.csv/.npz/.parquet), chunk directory, or directory of runs")
+    parser.add_argument("--freq", type=float, required=True, help="simulation frequency (Hz) of the runs")
+    parser.add_argument("--out", default="analysis/Reports", help="report directory")
+    parser.add_argument("--format", choices=["json", "parquet"], default="json")
+    parser.add_argument("--window", type=float, nargs=2, metavar=("T_START", "T_END"),
+                        help="time window (s) for per-step amplification")
+    parser.add_argument("--fft-window", type=float, nargs=2, metavar=("T_START", "T_END"),
+                        help="time window (s) for the transfer ratio")
+    parser.add_argument("--column", default="speed_mps", help="signal for the L2 and transfer metrics")
+    parser.add_argument("--nperseg", type=int, default=1024, help="Welch segment length (steps) for the transfer gain")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    runs = find_runs(args.path)
+    print(f"Analyzing {len(runs)} runs on {args.workers} workers -> {args.out}")
+    if not runs:
+        return
+    jobs = [(run, _report_path(run, args.path, args.out, args.format), args.freq,
+             args.window, args.fft_window, args.column, args.nperseg) for run in runs]
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for run, out_path, amplification in pool.map(_process, *zip(*jobs)):
+            print(f"{run}: head-to-tail amplification {amplification:.3f} -> {out_path}")
+
+
+if __name__ == "__main__":
+    main()
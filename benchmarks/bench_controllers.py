@@ -0,0 +1,119 @@
+# benchmarks/bench_controllers.py
+# Batched controller kernels vs. one scalar call per vehicle.
+# Run from the project root: python -m benchmarks.bench_controllers
+import math
+import time
+import numpy as np
+from controller.controller_manager import (
+    follower_stopper_batch, follower_stopper_params, ovm_bando_batch, accel_based_batch,
+)
+
+
+def _follower_stopper_scalar(r, dx, dv, v_AV, dx_min, dx_activate, decel, h):
+    # Per-vehicle pure-Python formulation that run_simulation used to call in its follower loop
+    dx_mid = (dx_min + dx_activate) / 2.0
+    v = min(r, max(v_AV + dv, 0.0))
+    dv = min(dv, 0.0)
+    dx1 = dx_min + (1 / (2 * decel[0])) * dv**2
+    dx2 = dx_mid + (1 / (2 * decel[1])) * dv**2
+    dx3 = dx_activate + (1 / (2 * decel[2])) * dv**2
+    if dx < dx1:
+        return 0.0
+    elif dx1 <= dx < dx2:
+        return v * (dx - dx1) / (dx2 - dx1)
+    elif dx2 <= dx < dx3:
+        return v + (r - v) * (dx - dx2) / (dx3 - dx2)
+    return r
+
+
+def _ovm_bando_scalar(s, v0, delta_s, beta):
+    return v0 * (math.tanh(s / delta_s - beta) + math.tanh(beta)) / (1.0 + math.tanh(beta))
+
+
+def _accel_based_scalar(gap, leader_speed, follower_speed, desired_gap=5.0, Kp=0.3, max_acc=2.5, max_dec=4.5):
+    accel = max_acc * math.tanh(Kp * (gap - desired_gap) + 0.2 * (leader_speed - follower_speed))
+    return max(-max_dec, min(accel, max_acc))
+
+
+def check_exact(n=200000, seed=0):
+    # The batched kernels must reproduce the scalar formulas bit for bit
+    rng = np.random.default_rng(seed)
+    r = rng.uniform(0.0, 35.0, n)
+    dx = rng.uniform(0.0, 60.0, n)
+    dv = rng.uniform(-15.0, 15.0, n)
+    v = rng.uniform(0.0, 35.0, n)
+    v0, delta_s, beta = rng.uniform(10.0, 35.0, n), rng.uniform(2.0, 30.0, n), rng.uniform(0.5, 3.0, n)
+    p = follower_stopper_params
+    cases = {
+        "follower_stopper": (
+            [_follower_stopper_scalar(*args, p["dx_min"], p["dx_activate"], p["decel"], p["h"])
+             for args in zip(r.tolist(), dx.tolist(), dv.tolist(), v.tolist())],
+            follower_stopper_batch(r, dx, dv, v, **p)),
+        "ovm_bando": (
+            [_ovm_bando_scalar(*args) for args in zip(dx.tolist(), v0.tolist(), delta_s.tolist(), beta.tolist())],
+            ovm_bando_batch(dx, v0, delta_s, beta)),
+        "accel_based": (
+            [_accel_based_scalar(*args) for args in zip(dx.tolist(), (v + dv).tolist(), v.tolist())],
+            accel_based_batch(dx, v + dv, v)),
+    }
+    for name, (scalar, batch) in cases.items():
+        differ = np.count_nonzero(np.asarray(scalar) != batch)
+        assert differ == 0, f"{name}: batched kernel differs from the scalar formula on {differ} of {n} inputs"
+
+
+def best_of(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench(n, repeat=5):
+    rng = np.random.default_rng(0)
+    r = 20.0
+    dx = rng.uniform(0.0, 60.0, n)
+    dv = rng.uniform(-10.0, 10.0, n)
+    v = rng.uniform(0.0, 30.0, n)
+    lead = v + dv
+    dx_l, dv_l, v_l, lead_l = dx.tolist(), dv.tolist(), v.tolist(), lead.tolist()
+    p = follower_stopper_params
+    repeat = repeat if n < 100000 else 1
+
+    cases = {
+        "follower_stopper": (
+            lambda: [_follower_stopper_scalar(r, a, b, c, p["dx_min"], p["dx_activate"], p["decel"], p["h"])
+                     for a, b, c in zip(dx_l, dv_l, v_l)],
+            lambda: follower_stopper_batch(r, dx, dv, v, **p),
+        ),
+        "ovm_bando": (
+            lambda: [_ovm_bando_scalar(a, 30.0, 10.0, 1.5) for a in dx_l],
+            lambda: ovm_bando_batch(dx, 30.0, 10.0, 1.5),
+        ),
+        "accel_based": (
+            lambda: [_accel_based_scalar(a, b, c) for a, b, c in zip(dx_l, lead_l, v_l)],
+            lambda: accel_based_batch(dx, lead, v),
+        ),
+    }
+
+    results = []
+    for name, (scalar, batch) in cases.items():
+        t_scalar = best_of(scalar, repeat)
+        t_batch = best_of(batch, repeat)
+        results.append({"kernel": name, "n": n, "scalar_s": t_scalar, "batch_s": t_batch,
+                        "speedup": t_scalar / t_batch})
+    return results
+
+
+def main():
+    check_exact()
+    print(f"{'kernel':<18}{'n':>8}{'scalar (ms)':>14}{'batch (ms)':>13}{'speedup':>10}")
+    for n in (10, 1000, 100000):
+        for row in bench(n):
+            print(f"{row['kernel']:<18}{row['n']:>8}{row['scalar_s'] * 1e3:>14.3f}"
+                  f"{row['batch_s'] * 1e3:>13.3f}{row['speedup']:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
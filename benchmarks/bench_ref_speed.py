@@ -0,0 +1,79 @@
+# benchmarks/bench_ref_speed.py
+# Reference-speed estimators vs. the list-based rolling mean run_simulation used to keep.
+# Run from the project root: python -m benchmarks.bench_ref_speed
+import statistics
+import time
+import numpy as np
+from controller.ref_speed import WindowedMean, EMA, WindowedQuantile
+
+
+def _list_mean(profile, window):
+    # append / pop(0) / sum(...) / len(...) every step, as in the original FS loop
+    leader_speed_list = []
+    for speed in profile:
+        leader_speed_list.append(speed)
+        if len(leader_speed_list) > window:
+            leader_speed_list.pop(0)
+        ref_speed = sum(leader_speed_list) / len(leader_speed_list)
+    return ref_speed
+
+
+def _list_median(profile, window):
+    leader_speed_list = []
+    for speed in profile:
+        leader_speed_list.append(speed)
+        if len(leader_speed_list) > window:
+            leader_speed_list.pop(0)
+        ref_speed = statistics.median(leader_speed_list)
+    return ref_speed
+
+
+def _run(estimator, profile):
+    for speed in profile:
+        estimator.update(speed)
+    return estimator.value
+
+
+def check_quantile_memory(window=200, n_steps=25000):
+    # Monotonic input: expired values never reach the top of a heap, so only the rebuild bounds memory
+    estimator = WindowedQuantile(window, 0.5)
+    _run(estimator, np.arange(n_steps, dtype=float))
+    size = len(estimator._lo) + len(estimator._hi)
+    assert size <= 2 * window, f"WindowedQuantile heaps hold {size} entries for window {window}"
+    assert len(estimator._delayed) <= window, f"WindowedQuantile tracks {len(estimator._delayed)} expired values"
+
+
+def bench(window, n_steps=None):
+    n_steps = n_steps or max(20000, 2 * window)  # long enough for the window to slide
+    rng = np.random.default_rng(0)
+    profile = (20 + np.cumsum(rng.normal(0.0, 0.05, n_steps))).tolist()
+
+    cases = {
+        "list mean": lambda: _list_mean(profile, window),
+        "WindowedMean": lambda: _run(WindowedMean(window), profile),
+        "EMA": lambda: _run(EMA(time_constant=window / 100, freq=100), profile),
+        "WindowedQuantile": lambda: _run(WindowedQuantile(window, 0.5), profile),
+    }
+    if window <= 3000:
+        cases["list median"] = lambda: _list_median(profile, window)
+
+    results = []
+    for name, func in cases.items():
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        results.append({"estimator": name, "window": window, "us_per_update": elapsed / n_steps * 1e6})
+    return results
+
+
+def main():
+    check_quantile_memory()
+    print(f"{'estimator':<18}{'window':>8}{'us/update':>12}")
+    # 4 s at 50 Hz (current default), 30 s at 100 Hz, 300 s at 100 Hz
+    for window in (200, 3000, 30000):
+        for row in bench(window):
+            print(f"{row['estimator']:<18}{row['window']:>8}{row['us_per_update']:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+# benchmarks/suite.py
+# Benchmark suite for the 50 Hz hot paths, without SUMO (controller/fake_traci.py stands in for traci).
+# Every case runs for platoons of 7, 100 and 1000 followers; results go to JSON and can be
+# compared with a stored baseline. Run from the project root:
+#   python -m benchmarks.suite --out benchmarks/results.json
+#   python -m benchmarks.suite --compare benchmarks/baseline.json --threshold 0.15
+#   python -m benchmarks.suite --sizes 7 100 --cases follower_stopper run_simulation --out -
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import matplotlib
+
+matplotlib.use("Agg")
+# plot_speeds draws one legend entry per vehicle, which does not fit for big platoons
+warnings.filterwarnings("ignore", message="Tight layout not applied")
+
+from controller.controller_manager import follower_stopper_batch, follower_stopper_params
+from controller.fake_traci import FakeConnection
+from controller.io_utils import save_simulation_to_csv, save_trajectories
+from controller.leader_speed_profile import resample_profile
+from controller.recorder import TrajectoryRecorder
+from controller.route_generator import generate_straight_route
+from controller.simulation import run_simulation
+from controller.vehicle_config import vehicle_types
+from analysis.online_metrics import OnlineMetrics
+from analysis.plot_stability import plot_speeds
+from analysis import string_stability
+
+SIZES = (7, 100, 1000)
+FREQ = 50
+RUN_SECONDS = 20  # simulated time of the run_simulation case
+IDM_SECONDS = 10  # switch to the follower controllers halfway
+PROFILE_CSV = "controller/2021-07-26-21-10-20_2T3H1RFV8LC057037_CAN_Messages_decoded_speed.csv"
+THRESHOLD = 0.10  # slowdown flagged as a regression by --compare
+# Synthetic leader speeds (20 m/s with a 2 m/s oscillation), so run_simulation needs no CAN data
+LEADER_PROFILE = 20 + 2 * np.sin(2 * np.pi * np.arange(RUN_SECONDS * FREQ) / (15 * FREQ))
+
+
+def best_of(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def quiet(func):
+    """func with its prints swallowed (run_simulation reports every vehicle at the switch)."""
+    def call():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return func()
+    return call
+
+
+class Context:
+    """Files and the recorded run of one platoon size, shared by the cases."""
+
+    def __init__(self, n, tmp):
+        self.n = n
+        self.tmp = tmp
+        self.route_file = os.path.join(tmp, f"straight_{n}.rou.xml")
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_straight_route(vehicle_types, [("idm_follower", n)], filename=self.route_file)
+        self.recorder = None
+
+    def simulate(self):
+        conn = FakeConnection.from_route_file(self.route_file, step_length=1 / FREQ)
+        recorder = TrajectoryRecorder(RUN_SECONDS * FREQ)
+        run_simulation(20, RUN_SECONDS, FREQ, IDM_SECONDS, conn=conn, recorder=recorder, leader_profile=LEADER_PROFILE)
+        self.recorder = recorder
+        return recorder
+
+    def run(self):
+        if self.recorder is None:
+            quiet(self.simulate)()
+        return self.recorder
+
+
+# Every case: ctx -> (timed function, units of work per call, unit name)
+def case_follower_stopper(ctx):
+    rng = np.random.default_rng(0)
+    dx = rng.uniform(0.0, 60.0, ctx.n)
+    dv = rng.uniform(-10.0, 10.0, ctx.n)
+    v = rng.uniform(0.0, 30.0, ctx.n)
+    calls = 1000
+
+    def func():
+        for _ in range(calls):
+            follower_stopper_batch(20.0, dx, dv, v, **follower_stopper_params)
+    return func, calls * ctx.n, "vehicle-steps"
+
+
+def case_run_simulation(ctx):
+    return quiet(ctx.simulate), RUN_SECONDS * FREQ, "steps"
+
+
+def case_save_csv(ctx):
+    outputs = ctx.run().legacy_outputs()
+    path = os.path.join(ctx.tmp, f"run_{ctx.n}.csv")
+    return quiet(lambda: save_simulation_to_csv(*outputs[:6], outputs[7], save_path=path)), \
+        RUN_SECONDS * FREQ * (ctx.n + 1), "rows"
+
+
+def case_load_profile(ctx):
+    if not os.path.exists(PROFILE_CSV):
+        return None
+    return lambda: resample_profile(PROFILE_CSV, FREQ), 1, "profiles"
+
+
+def case_plot_speeds(ctx):
+    outputs = ctx.run().legacy_outputs()
+    path = os.path.join(ctx.tmp, f"speeds_{ctx.n}.png")
+    return quiet(lambda: plot_speeds(outputs[0], 20, outputs[1], del_t=1 / FREQ, save_path=path, style="fast",
+                                     show=False)), ctx.n + 1, "vehicles"
+
+
+def case_string_stability(ctx):
+    path = os.path.join(ctx.tmp, f"run_{ctx.n}.npz")
+    save_trajectories(ctx.run(), path)
+
+    def func():
+        string_stability._load_run.cache_clear()  # time loading the file too
+        string_stability.analyze_run(path, FREQ, window=(IDM_SECONDS, RUN_SECONDS), nperseg=256)
+    return func, RUN_SECONDS * FREQ, "steps"
+
+
+def case_online_metrics(ctx):
+    rec = ctx.run()
+    cols = rec.sorted_columns()
+    ids = [rec.ids[col] for col in cols]
+    speed, headway = rec.speed[:, cols], rec.headway[:, cols]
+
+    def func():
+        metrics = OnlineMetrics(FREQ, window=(IDM_SECONDS, RUN_SECONDS))
+        metrics.start(ids)
+        for step in range(len(speed)):
+            metrics.update(step, ids, speed[step], headway[step])
+        metrics.report()
+    return func, len(speed), "steps"
+
+
+CASES = {
+    "follower_stopper": case_follower_stopper,
+    "run_simulation": case_run_simulation,
+    "save_simulation_to_csv": case_save_csv,
+    "load_real_profile": case_load_profile,
+    "plot_speeds": case_plot_speeds,
+    "string_stability": case_string_stability,
+    "online_metrics": case_online_metrics,
+}
+SIZE_INDEPENDENT = {"load_real_profile"}
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "commit": commit, "python": platform.python_version(),
+            "numpy": np.__version__, "platform": platform.platform(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count()}
+
+
+def run_suite(sizes=SIZES, cases=None, repeat=3):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            ctx = Context(n, tmp)
+            for name in cases or CASES:
+                if name in SIZE_INDEPENDENT and n != sizes[0]:
+                    continue
+                setup = CASES[name](ctx)
+                if setup is None:
+                    print(f"{name:<24}{n:>6}   skipped")
+                    continue
+                func, work, unit = setup
+                # One call for the big platoon, which takes seconds per call
+                seconds = best_of(func, 1 if n >= 1000 else repeat)
+                row = {"case": name, "size": None if name in SIZE_INDEPENDENT else n, "seconds": seconds,
+                       "throughput": work / seconds, "unit": unit}
+                results.append(row)
+                print(f"{name:<24}{n:>6}{seconds * 1e3:>12.2f} ms{row['throughput']:>14.0f} {unit}/s")
+    return {"machine": machine_info(), "freq": FREQ, "run_seconds": RUN_SECONDS, "results": results}
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Rows of (case, size, baseline s, current s, ratio, regressed); ratio > 1 is slower."""
+    base = {(row["case"], row["size"]): row["seconds"] for row in baseline["results"]}
+    rows = []
+    for row in results["results"]:
+        key = (row["case"], row["size"])
+        if key not in base:
+            continue
+        ratio = row["seconds"] / base[key]
+        rows.append((row["case"], row["size"], base[key], row["seconds"], ratio, ratio > 1 + threshold))
+    return rows
+
+
+def print_comparison(rows, threshold):
+    print(f"\n{'case':<24}{'size':>6}{'baseline (ms)':>15}{'current (ms)':>14}{'ratio':>8}")
+    for case, size, base_s, cur_s, ratio, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{case:<24}{str(size or '-'):>6}{base_s * 1e3:>15.2f}{cur_s * 1e3:>14.2f}{ratio:>7.2f}x{flag}")
+    n_regressed = sum(row[-1] for row in rows)
+    print(f"{n_regressed} of {len(rows)} cases slower than the baseline by more than {threshold:.0%}")
+    return n_regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the simulation, I/O, plotting and analysis hot paths.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="platoon sizes (followers)")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), help="subset of cases (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="best of N calls (one call for 1000 vehicles)")
+    parser.add_argument("--out", default="benchmarks/results.json", help="result JSON, '-' to skip writing")
+    parser.add_argument("--compare", metavar="BASELINE", help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="relative slowdown flagged as regression")
+    args = parser.parse_args()
+
+    results = run_suite(args.sizes, args.cases, args.repeat)
+    if args.out != "-":
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to: {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["machine"].get("platform") != results["machine"]["platform"]:
+            print(f"Note: baseline was measured on {baseline['machine'].get('platform')}")
+        if print_comparison(compare(results, baseline, args.threshold), args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
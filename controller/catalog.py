@@ -0,0 +1,258 @@
+# controller/catalog.py
+"""
+Content-addressed catalog of simulation runs (SQLite).
+
+run_config() collects everything a run's result depends on: ref_speed,
+interrupt_time, freq, idm_duration, the vehicle plan and vehicle_types,
+controller and reference speed estimator parameters, rate settings, the
+backend, and the sha1 of the net file, route file, leader profile and
+controller/analysis sources. config_hash() of it is the run's key.
+main.py and sweep.py look the key up before simulating and reuse the
+stored result on a hit, then register what they computed:
+
+    catalog = Catalog()
+    key = config_hash(config)
+    cached = catalog.lookup(key, trajectories=True)
+    ...
+    catalog.register(key, config, trajectories=csv_path, metrics=report, runtime_s=...)
+
+Searchable fields (network, ref_speed, freq, ...) and summary metrics are
+columns of the runs table, so analyses filter runs without opening a CSV:
+
+    Catalog().query(network="ring", ref_speed=(15, 35))
+    python -m controller.catalog --network ring --ref-speed 15 35
+
+Rows whose files were deleted are treated as misses and overwritten by the
+next run.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from controller.controller_manager import follower_stopper_params
+from controller.ref_speed import default_estimator, estimator_assignment
+from controller.route_generator import plan_sequence
+
+CATALOG_PATH = "output/catalog.sqlite"
+CATALOG_FORMAT = 1  # part of every key; bump when run_config changes meaning
+# Sources whose changes invalidate cached results
+CODE_GLOBS = ("controller/*.py", "analysis/online_metrics.py")
+COLUMNS = ("key", "created", "network", "network_name", "backend", "ref_speed", "freq", "idm_duration",
+           "interrupt_time", "n_followers", "trajectories", "metrics_path", "head_to_tail_amplification",
+           "min_ttc", "runtime_s", "config")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    key TEXT PRIMARY KEY,
+    created TEXT,
+    network TEXT,
+    network_name TEXT,
+    backend TEXT,
+    ref_speed REAL,
+    freq REAL,
+    idm_duration REAL,
+    interrupt_time REAL,
+    n_followers INTEGER,
+    trajectories TEXT,
+    metrics_path TEXT,
+    head_to_tail_amplification REAL,
+    min_ttc REAL,
+    runtime_s REAL,
+    config TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_network ON runs (network, ref_speed);
+CREATE INDEX IF NOT EXISTS runs_freq ON runs (freq, idm_duration);
+"""
+_code_digest = None
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def code_digest():
+    """sha1 over the controller and online metrics sources (computed once per process)."""
+    global _code_digest
+    if _code_digest is None:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        h = hashlib.sha1()
+        for pattern in CODE_GLOBS:
+            for path in sorted(glob.glob(os.path.join(root, pattern))):
+                h.update(os.path.relpath(path, root).encode())
+                h.update(file_digest(path).encode())
+        _code_digest = h.hexdigest()
+    return _code_digest
+
+
+def run_config(ref_speed, interrupt_time, freq, idm_duration, vehicle_plan, vehicle_types, network, net_file,
+               route_file=None, leader_profile=None, backend="traci", **options):
+    """
+    Everything the result of a run depends on, as a JSON-able dict.
+    network is the network type or network_builder name; leader_profile is
+    the profile array given to run_simulation (None: DEFAULT_PROFILE_CSV);
+    options are further run_simulation arguments that change the result
+    (controllers, ref_estimators, control_dt, record_dt, leader_dist, ...).
+    """
+    if leader_profile is None:
+        from controller.leader_speed_profile import DEFAULT_PROFILE_CSV, cached_profile
+        leader_profile = cached_profile(DEFAULT_PROFILE_CSV, freq)
+    profile = np.ascontiguousarray(leader_profile, dtype=float)
+    sequence = plan_sequence(vehicle_plan)
+    return {
+        "format": CATALOG_FORMAT,
+        "ref_speed": ref_speed,
+        "interrupt_time": interrupt_time,
+        "freq": freq,
+        "idm_duration": idm_duration,
+        "vehicle_plan": sequence,
+        "vehicle_types": {vtype: vehicle_types[vtype] for vtype in sorted(set(sequence) | {"idm_follower"})},
+        "network": network,
+        "net_file": file_digest(net_file),
+        "route_file": file_digest(route_file) if route_file and backend != "numpy" else None,
+        "leader_profile": hashlib.sha1(profile.tobytes()).hexdigest(),
+        "backend": backend,
+        "follower_stopper_params": follower_stopper_params,
+        "ref_estimators": {"default": default_estimator, "assignment": estimator_assignment},
+        "options": options,
+        "code": code_digest(),
+    }
+
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _network_kind(network):
+    for kind in ("ring", "straight", "circular"):
+        if str(network).startswith(kind):
+            return kind
+    return str(network)
+
+
+class Catalog:
+    def __init__(self, path=None):
+        self.path = path or CATALOG_PATH
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Sweep workers register concurrently: WAL mode and a generous busy timeout
+        self._db = sqlite3.connect(self.path, timeout=60)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def lookup(self, key, trajectories=False):
+        """Catalog row of `key` as a dict, or None if unknown or its files are gone (or it has no trajectories but they are needed)."""
+        row = self._db.execute("SELECT * FROM runs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        row = dict(row)
+        paths = [row["trajectories"] if trajectories else None, row["metrics_path"]]
+        if trajectories and not row["trajectories"]:
+            return None
+        if not all(os.path.exists(path) for path in paths if path):
+            return None
+        row["config"] = json.loads(row["config"])
+        return row
+
+    def register(self, key, config, trajectories=None, metrics=None, metrics_path=None, runtime_s=None):
+        """
+        Add or replace the run `key`. metrics is an OnlineMetrics /
+        analyze_run report; its head-to-tail amplification and smallest TTC
+        become searchable columns.
+        """
+        amplification = min_ttc = None
+        if metrics is not None:
+            amplification = metrics.get("head_to_tail_amplification")
+            ttcs = [ttc for ttc in metrics.get("per_follower", {}).get("min_ttc") or [] if ttc is not None]
+            min_ttc = min(ttcs) if ttcs else None
+        values = {
+            "key": key,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "network": _network_kind(config["network"]),
+            "network_name": str(config["network"]),
+            "backend": config["backend"],
+            "ref_speed": config["ref_speed"],
+            "freq": config["freq"],
+            "idm_duration": config["idm_duration"],
+            "interrupt_time": config["interrupt_time"],
+            "n_followers": len(config["vehicle_plan"]),
+            "trajectories": os.path.abspath(trajectories) if trajectories else None,
+            "metrics_path": os.path.abspath(metrics_path) if metrics_path else None,
+            "head_to_tail_amplification": amplification,
+            "min_ttc": min_ttc,
+            "runtime_s": runtime_s,
+            "config": json.dumps(config, sort_keys=True, default=str),
+        }
+        with self._db:
+            self._db.execute(f"INSERT OR REPLACE INTO runs ({', '.join(COLUMNS)}) "
+                             f"VALUES ({', '.join('?' * len(COLUMNS))})", [values[col] for col in COLUMNS])
+
+    def query(self, order_by="created", **filters):
+        """
+        Rows matching every filter, e.g. query(network="ring", ref_speed=(15, 35)):
+        a (low, high) tuple is an inclusive range (None for an open end), anything else must be equal.
+        """
+        clauses, params = [], []
+        for column, value in filters.items():
+            if column not in COLUMNS:
+                raise ValueError(f"Unknown catalog column: {column}")
+            if isinstance(value, (tuple, list)):
+                low, high = value
+                if low is not None:
+                    clauses.append(f"{column} >= ?")
+                    params.append(low)
+                if high is not None:
+                    clauses.append(f"{column} <= ?")
+                    params.append(high)
+            else:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if order_by not in COLUMNS:
+            raise ValueError(f"Unknown catalog column: {order_by}")
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._db.execute(f"SELECT * FROM runs{where} ORDER BY {order_by}", params).fetchall()
+        return [dict(row) for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List cataloged runs.")
+    parser.add_argument("--catalog", default=CATALOG_PATH)
+    parser.add_argument("--network", help="ring, straight or circular")
+    parser.add_argument("--backend", choices=["traci", "numpy"])
+    parser.add_argument("--ref-speed", type=float, nargs=2, metavar=("LOW", "HIGH"))
+    parser.add_argument("--freq", type=float)
+    args = parser.parse_args()
+
+    filters = {}
+    if args.network:
+        filters["network"] = args.network
+    if args.backend:
+        filters["backend"] = args.backend
+    if args.ref_speed:
+        filters["ref_speed"] = tuple(args.ref_speed)
+    if args.freq:
+        filters["freq"] = args.freq
+    rows = Catalog(args.catalog).query(order_by="ref_speed", **filters)
+    print(f"{'key':<14}{'network':<22}{'backend':<8}{'r':>6}{'freq':>6}{'followers':>10}{'amplification':>15}  result")
+    for row in rows:
+        amplification = row["head_to_tail_amplification"]
+        print(f"{row['key'][:12]:<14}{row['network_name']:<22}{row['backend']:<8}{row['ref_speed']:>6g}"
+              f"{row['freq']:>6g}{row['n_followers']:>10}"
+              f"{'-' if amplification is None else f'{amplification:.4f}':>15}  "
+              f"{row['trajectories'] or row['metrics_path']}")
+    print(f"{len(rows)} runs")
+
+
+if __name__ == "__main__":
+    main()
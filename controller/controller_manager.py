@@ -1,11 +1,38 @@
 import traci
 import math
+import time
 import numpy as np
 
-# Keep this persistent across time steps
-_nominal_y = 0.0
+def _tanh(x):
+    # math.tanh per element: np.tanh differs from it in the last bits, and the
+    # batched controllers must give exactly what the scalar formulas gave
+    x = np.asarray(x, dtype=float)
+    return np.fromiter(map(math.tanh, x.ravel().tolist()), float, x.size).reshape(x.shape)
 
-def nominal_controller(vel, max_speed, max_accel, max_decel, freq):
+
+def nominal_batch(vel, max_speed, dt, state, max_accel=2.0, max_decel=-2.0):
+    """
+    Array version of nominal_controller. state["y"] holds every vehicle's
+    smoothed speed between steps and is replaced with the updated values.
+    """
+    y = np.asarray(state["y"], dtype=float)
+    max_speed = np.asarray(max_speed, dtype=float)
+    y = np.where(y > max_speed + 1, np.maximum(max_speed, y - abs(max_decel) * dt),
+        np.where(y < max_speed - 1, np.minimum(max_speed, y + max_accel * dt), max_speed))
+
+    # rounding
+    y = np.where((y < 2) & (max_speed > 2), 2.0, np.where((y < 1) & (max_speed > 1), 1.0, y))
+    state["y"] = y
+
+    # Output bounded reference
+    vel = np.asarray(vel, dtype=float)
+    return np.minimum(np.maximum(y, vel - 1.0), vel + 2.0)
+
+
+# State of callers that do not pass their own (a single AV)
+_nominal_state = {"y": 0.0}
+
+def nominal_controller(vel, max_speed, max_accel, max_decel, freq, state=None):
     """
     Nominal controller to generate reference velocity r.
     This smooths acceleration/deceleration over time.
@@ -16,29 +43,71 @@ def nominal_controller(vel, max_speed, max_accel, max_decel, freq):
     - max_accel: maximum allowable acceleration
     - max_decel: maximum allowable deceleration (positive value)
     - dt: time step (should match simulation step, e.g., 0.1s)
+    - state: this vehicle's {"y": smoothed speed} kept between calls, so
+      several AVs can run the controller independently
     
     Returns:
     - r: reference speed (to be used as input to the FollowerStopper controller)
     """
-    global _nominal_y
-    dt = 1/freq
+    if state is None:
+        state = _nominal_state
+    r = nominal_batch(vel, max_speed, 1 / freq, state, max_accel, max_decel)
+    state["y"] = float(state["y"])
+    return float(r)
+
+
+# FollowerStopper parameters used by run_simulation
+follower_stopper_params = {
+    "dx_min": 4.5, # omega_1
+    "dx_activate": 6.0, # omega 3
+    "decel": [1.5, 1.0, 0.5],
+    "h": [0.4, 1.2, 1.8],
+}
 
-    if _nominal_y > max_speed + 1:
-        _nominal_y = max(max_speed, _nominal_y - abs(max_decel) * dt)
-    elif _nominal_y < max_speed - 1:
-        _nominal_y = min(max_speed, _nominal_y + max_accel * dt)
-    else:
-        _nominal_y = float(max_speed)
 
-    # rounding
-    if _nominal_y < 2 and max_speed > 2:
-        _nominal_y = 2
-    elif _nominal_y < 1 and max_speed > 1:
-        _nominal_y = 1
+def follower_stopper_batch(r, dx, dv, v_AV, dx_min, dx_activate, decel, h):
+    """
+    Array version of follower_stopper: evaluates every vehicle in one call.
 
-    # Output bounded reference
-    r = min(max(_nominal_y, vel - 1.0), vel + 2.0)
-    return r
+    r, dx, dv, v_AV, dx_min and dx_activate are scalars or arrays that broadcast
+    against each other. decel and h hold the 3 band values, either shared
+    (shape (3,)) or per vehicle (shape (n, 3)).
+
+    Returns:
+        u_cmd: array of commanded velocities
+    """
+    r = np.asarray(r, dtype=float)
+    dx = np.asarray(dx, dtype=float)
+    dv = np.asarray(dv, dtype=float)
+    v_AV = np.asarray(v_AV, dtype=float)
+    decel = np.asarray(decel, dtype=float)
+
+    # Controller-specific spacing mid point
+    dx_mid = (np.asarray(dx_min, dtype=float) + dx_activate) / 2.0
+
+    # Estimate lead vehicle speed
+    v_lead = np.maximum(v_AV + dv, 0.0)  # Lead vehicle cannot go backward
+    v = np.minimum(r, v_lead)            # Desired velocity cannot exceed safe lead speed
+
+    # Ensure dv is non-negative for band calculation
+    dv = np.minimum(dv, 0.0)
+
+    # Band boundary calculations. float_power is libm pow like Python's dv**2;
+    # np.power and dv * dv take numpy's square loops, which round differently
+    dv_sq = np.float_power(dv, 2.0)
+    dx1 = dx_min + (1 / (2 * decel[..., 0])) * dv_sq #+ v_AV*h[0]
+    dx2 = dx_mid + (1 / (2 * decel[..., 1])) * dv_sq #+ v_AV*h[1]
+    dx3 = dx_activate + (1 / (2 * decel[..., 2])) * dv_sq #+ v_AV*h[2]
+
+    # Compute u_cmd based on parabolic interpolation
+    with np.errstate(divide="ignore", invalid="ignore"):
+        adapt_low = v * (dx - dx1) / (dx2 - dx1) #adaptation region between x1 and x2
+        adapt_high = v + (r - v) * (dx - dx2) / (dx3 - dx2) #adaptation region between x2 and x3
+
+    # Bands are checked in order, so each np.where only sees dx beyond the previous band
+    return np.where(dx < dx1, 0.0,
+           np.where(dx < dx2, adapt_low,
+           np.where(dx < dx3, adapt_high, r)))
 
 
 def follower_stopper(r, dx, dv, v_AV, dx_min, dx_activate, decel, h):
@@ -48,7 +117,7 @@ def follower_stopper(r, dx, dv, v_AV, dx_min, dx_activate, decel, h):
     Parameters:
         r          : desired velocity (from other models)
         dx         : estimated gap to vehicle ahead
-        dv         : estimated dẋ (i.e., lead - ego speed)
+        dv         : estimated dẋ (i.e., lead - ego speed)
         v_AV       : velocity of the ego (autonomous) vehicle
         dx_min     : minimum spacing (omega_1)
         dx_activate: activation spacing (omega_3)
@@ -57,37 +126,17 @@ def follower_stopper(r, dx, dv, v_AV, dx_min, dx_activate, decel, h):
     Returns:
         u_cmd: commanded velocity (always <= r)
     """
+    return float(follower_stopper_batch(r, dx, dv, v_AV, dx_min, dx_activate, decel, h))
 
-    # Controller-specific spacing mid point
-    dx_mid = (dx_min + dx_activate) / 2.0
-
-    # Estimate lead vehicle speed
-    v_lead = v_AV + dv
-    v_lead = max(v_lead, 0.0)  # Lead vehicle cannot go backward
-    v = min(r, v_lead)       # Desired velocity cannot exceed safe lead speed
-
-    # Ensure dv is non-negative for band calculation
-    dv = min(dv, 0.0)
-
-    # Band boundary calculations
-    dx1 = dx_min + (1 / (2 * decel[0])) * dv**2 #+ v_AV*h[0]
-    dx2 = dx_mid + (1 / (2 * decel[1])) * dv**2 #+ v_AV*h[1]
-    dx3 = dx_activate + (1 / (2 * decel[2])) * dv**2 #+ v_AV*h[2]
 
-    # Compute u_cmd based on parabolic interpolation
-    if dx < dx1:
-        u_cmd = 0.0
-    elif dx1 <= dx < dx2:
-        u_cmd = v * (dx - dx1) / (dx2 - dx1) #adaptation region between x1 and x2
-    elif dx2 <= dx < dx3:
-        u_cmd = v + (r - v) * (dx - dx2) / (dx3 - dx2) #adaptation region between x2 and x3
-    else:
-        u_cmd = r
-
-    return u_cmd
+# Optimal velocity Model by Bando et. al.
 
+def ovm_bando_batch(s, v0, delta_s, beta):
+    """Array version of ovm_bando; all arguments broadcast against each other."""
+    s = np.asarray(s, dtype=float)
+    tanh_beta = _tanh(beta)
+    return v0 * (_tanh(s / delta_s - beta) + tanh_beta) / (1.0 + tanh_beta)
 
-# Optimal velocity Model by Bando et. al.
 
 def ovm_bando(s, v0, delta_s, beta):
     """
@@ -107,9 +156,51 @@ def ovm_bando(s, v0, delta_s, beta):
     Returns:
         float : optimal velocity (m/s)
     """
-    return v0 * (math.tanh(s / delta_s - beta) + math.tanh(beta)) / (1.0 + math.tanh(beta))
+    return float(ovm_bando_batch(s, v0, delta_s, beta))
+
+# --- Controller registry ---
+# Batched controllers with their declared inputs. The dispatcher passes the
+# inputs positionally, as arrays over the vehicles of one group:
+#   speed, gap (to the vehicle ahead), leader_speed, dv (leader - ego speed),
+#   ref_speed (reference speed estimator), target_speed (cruise speed), dt
+controller_registry = {}
+
+def register_controller(name, inputs, command="speed", state=None, params=None):
+    """
+    Register a batched controller under `name`. It returns one command per
+    vehicle (NaN: none), applied with setSpeed (command="speed") or
+    setAcceleration (command="accel"). `state` declares per-vehicle variables
+    with their initial value; the function then gets state={var: array} and
+    replaces the arrays with the updated values. `params` are passed as keywords
+    (the dict is read on every call, so later edits apply).
+    """
+    def decorator(func):
+        controller_registry[name] = {"func": func, "inputs": tuple(inputs), "command": command,
+                                     "state": dict(state or {}), "params": params if params is not None else {}}
+        return func
+    return decorator
+
+
+register_controller("follower_stopper", ("ref_speed", "gap", "dv", "speed"),
+                    params=follower_stopper_params)(follower_stopper_batch)
+register_controller("nominal", ("speed", "target_speed", "dt"), state={"y": 0.0})(nominal_batch)
+
+
+@register_controller("nominal_fs", ("speed", "target_speed", "dt", "gap", "dv"), state={"y": 0.0})
+def nominal_fs_batch(speed, target_speed, dt, gap, dv, state, max_accel=2.0, max_decel=-2.0):
+    """Nominal controller reference r fed into FollowerStopper."""
+    r = nominal_batch(speed, target_speed, dt, state, max_accel, max_decel)
+    return follower_stopper_batch(r, gap, dv, speed, **follower_stopper_params)
+
 
 # Simple Gap-Based Speed Controller 
+@register_controller("simple_gap", ("gap", "speed"))
+def simple_gap_batch(gap, speed, Kp=0.4, desired_gap=5.0):
+    """Array version of simple_gap_controller."""
+    new_speed = np.asarray(speed, dtype=float) + Kp * (np.asarray(gap, dtype=float) - desired_gap)
+    return np.maximum(0, np.minimum(new_speed, 30))
+
+
 def simple_gap_controller(veh_id, Kp=0.4, desired_gap=5.0):
     leader_info = traci.vehicle.getLeader(veh_id)
     if not leader_info or leader_info[0] == "":
@@ -117,14 +208,20 @@ def simple_gap_controller(veh_id, Kp=0.4, desired_gap=5.0):
 
     leader_id, gap = leader_info
     follower_speed = traci.vehicle.getSpeed(veh_id)
+    return float(simple_gap_batch(gap, follower_speed, Kp, desired_gap))
 
-    error = gap - desired_gap
-    new_speed = follower_speed + Kp * error
 
-    return max(0, min(new_speed, 30))
+# Acceleration-Based Controller
+@register_controller("accel_based", ("gap", "leader_speed", "speed"), command="accel")
+def accel_based_batch(gap, leader_speed, follower_speed, desired_gap=5.0, Kp=0.3, max_acc=2.5, max_dec=4.5):
+    """Array version of accel_based_controller working on gaps and speeds instead of TraCI lookups."""
+    gap_error = np.asarray(gap, dtype=float) - desired_gap
+    speed_error = np.asarray(leader_speed, dtype=float) - follower_speed
+
+    accel = max_acc * _tanh(Kp * gap_error + 0.2 * speed_error)
+    return np.maximum(-max_dec, np.minimum(accel, max_acc))
 
 
-# Acceleration-Based Controller
 def accel_based_controller(veh_id, desired_gap=5.0, Kp=0.3, max_acc=2.5, max_dec=4.5):
     leader_info = traci.vehicle.getLeader(veh_id)
     if not leader_info or leader_info[0] == "":
@@ -134,13 +231,7 @@ def accel_based_controller(veh_id, desired_gap=5.0, Kp=0.3, max_acc=2.5, max_dec
     leader_speed = traci.vehicle.getSpeed(leader_id)
     follower_speed = traci.vehicle.getSpeed(veh_id)
 
-    gap_error = gap - desired_gap
-    speed_error = leader_speed - follower_speed
-
-    accel = max_acc * math.tanh(Kp * gap_error + 0.2 * speed_error)
-    accel = max(-max_dec, min(accel, max_acc))
-
-    return accel
+    return float(accel_based_batch(gap, leader_speed, follower_speed, desired_gap, Kp, max_acc, max_dec))
 
 
 # Controller Map
@@ -163,23 +254,151 @@ controller_assignment = {
 def get_controller_name(veh_id):
     return controller_assignment.get(veh_id, default_controller)
 
-def apply_controller(veh_id):
-    controller_name = get_controller_name(veh_id)
-    if not controller_name:
-        return  # No controller specified
-
-    func = controller_map.get(controller_name)
-    if not func:
-        return  # Invalid controller
-
-    if controller_name == "accel_based":
-        accel = func(veh_id)
-        if accel is not None:
-            traci.vehicle.setAcceleration(veh_id, accel, duration=1.0)
-            print("Acceleration based controller applied")
-    else:
-        speed = func(veh_id)
-        if speed is not None:
-            traci.vehicle.setSpeed(veh_id, speed)
-            print("Gap based controller applied")
 
+class ControllerDispatcher:
+    """
+    Evaluates the registered controllers once per step for all vehicles:
+    vehicles are grouped by their assigned controller (groups are rebuilt only
+    when the vehicle list changes), every group is one array call, and the
+    commands are applied afterwards in a single pass. Per-vehicle controller
+    state lives in arrays indexed by a slot given to each vehicle on first
+    sight. Time spent per controller is kept in `timings` (see report()).
+
+    assignment: {veh_id: controller name}, vehicles not in it use `default`
+    (None: no controller). params: {controller name: keyword overrides}.
+    """
+
+    def __init__(self, assignment=None, default=None, dt=0.1, params=None):
+        self.assignment = {} if assignment is None else assignment
+        self.default = default
+        self.dt = dt
+        self.params = params or {}
+        self.timings = {}  # name -> {"seconds", "calls", "vehicles"}
+        self._ids = None
+        self._groups = {}
+        self._slots = {}
+        self._state = {}  # name -> {var: array over slots}
+
+    def controller_of(self, veh_id):
+        return self.assignment.get(veh_id, self.default)
+
+    def _regroup(self, ids):
+        groups = {}
+        for i, vid in enumerate(ids):
+            name = self.controller_of(vid)
+            if name is None:
+                continue
+            if name not in controller_registry:
+                raise ValueError(f"Unknown controller for {vid}: {name}")
+            groups.setdefault(name, []).append(i)
+            if vid not in self._slots:
+                self._slots[vid] = len(self._slots)
+        self._groups = {name: (np.array(idx), np.array([self._slots[ids[i]] for i in idx]))
+                        for name, idx in groups.items()}
+        self._ids = list(ids)
+
+    def _state_of(self, name, spec):
+        state = self._state.setdefault(name, {var: np.empty(0) for var in spec["state"]})
+        for var, initial in spec["state"].items():
+            if len(state[var]) < len(self._slots):
+                grown = np.full(len(self._slots), float(initial))
+                grown[:len(state[var])] = state[var]
+                state[var] = grown
+        return state
+
+    def compute(self, ids, inputs, active=None):
+        """
+        inputs: {input name: array aligned with ids, or a scalar}; active:
+        optional mask of the vehicles to control this step. Returns
+        (speed commands, acceleration commands) aligned with ids, NaN where
+        there is no command.
+        """
+        if ids != self._ids:
+            self._regroup(ids)
+        inputs = dict(inputs, dt=inputs.get("dt", self.dt))
+        speed_cmd = np.full(len(ids), np.nan)
+        accel_cmd = np.full(len(ids), np.nan)
+        for name, (idx, slots) in self._groups.items():
+            if active is not None:
+                keep = active[idx]
+                idx, slots = idx[keep], slots[keep]
+            if not len(idx):
+                continue
+            start = time.perf_counter()
+            spec = controller_registry[name]
+            args = [inputs[key][idx] if np.ndim(inputs[key]) else inputs[key] for key in spec["inputs"]]
+            kwargs = dict(spec["params"], **self.params.get(name, {}))
+            if spec["state"]:
+                state = self._state_of(name, spec)
+                group_state = {var: state[var][slots] for var in spec["state"]}
+                out = spec["func"](*args, state=group_state, **kwargs)
+                for var in spec["state"]:
+                    state[var][slots] = group_state[var]
+            else:
+                out = spec["func"](*args, **kwargs)
+            (speed_cmd if spec["command"] == "speed" else accel_cmd)[idx] = out
+
+            timing = self.timings.setdefault(name, {"seconds": 0.0, "calls": 0, "vehicles": 0})
+            timing["seconds"] += time.perf_counter() - start
+            timing["calls"] += 1
+            timing["vehicles"] += len(idx)
+        return speed_cmd, accel_cmd
+
+    def apply(self, conn, ids, speed_cmd, accel_cmd, accel_duration=1.0):
+        """Send every command of one step, after all groups have been evaluated."""
+        for vid, speed, accel in zip(ids, speed_cmd.tolist(), accel_cmd.tolist()):
+            if speed == speed:
+                conn.vehicle.setSpeed(vid, speed)
+            elif accel == accel:
+                conn.vehicle.setAcceleration(vid, accel, accel_duration)
+
+    def report(self):
+        for name, t in self.timings.items():
+            per_vehicle = t["seconds"] / max(t["vehicles"], 1) * 1e6
+            print(f"Controller {name}: {t['calls']} calls, {t['vehicles']} vehicle-steps, "
+                  f"{t['seconds']:.3f} s ({per_vehicle:.2f} us per vehicle)")
+
+
+# Dispatcher behind apply_controller (controller_assignment / default_controller)
+_dispatcher = None
+
+LEADER_INPUTS = ("gap", "leader_speed", "dv")
+
+
+def apply_controller(veh_id, conn=traci, ref_speed=None, target_speed=None):
+    """
+    Apply the controller assigned to one vehicle, reading its state through
+    TraCI. Controllers that need a reference or cruise speed (follower_stopper,
+    nominal, nominal_fs) get it from ref_speed / target_speed.
+    """
+    global _dispatcher
+    if _dispatcher is None or _dispatcher.default != default_controller:
+        _dispatcher = ControllerDispatcher(controller_assignment, default_controller)
+    name = get_controller_name(veh_id)
+    if name not in controller_registry:
+        return  # No (valid) controller specified
+
+    speed = conn.vehicle.getSpeed(veh_id)
+    inputs = {"speed": np.array([speed])}
+    if ref_speed is not None:
+        inputs["ref_speed"] = np.array([float(ref_speed)])
+    if target_speed is not None:
+        inputs["target_speed"] = np.array([float(target_speed)])
+    declared = controller_registry[name]["inputs"]
+    missing = [key for key in declared if key not in inputs and key not in LEADER_INPUTS + ("dt",)]
+    if missing:
+        raise ValueError(f"Controller {name} of {veh_id} needs {', '.join(missing)}; "
+                         f"pass {' and '.join(missing)} to apply_controller")
+
+    if any(key in LEADER_INPUTS for key in declared):
+        leader_info = conn.vehicle.getLeader(veh_id)
+        if not leader_info or leader_info[0] == "":
+            if name == "simple_gap":
+                conn.vehicle.setSpeed(veh_id, speed)  # keeps its speed, as simple_gap_controller did
+            return
+        leader_id, gap = leader_info
+        leader_speed = conn.vehicle.getSpeed(leader_id)
+        inputs.update(gap=np.array([gap]), leader_speed=np.array([leader_speed]),
+                      dv=np.array([leader_speed - speed]))
+    speed_cmd, accel_cmd = _dispatcher.compute([veh_id], inputs)
+    _dispatcher.apply(conn, [veh_id], speed_cmd, accel_cmd)
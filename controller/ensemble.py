@@ -0,0 +1,223 @@
+# controller/ensemble.py
+"""
+Monte Carlo ensembles of perturbed platoons on the NumPy engine.
+
+EnsembleEngine advances R replicates of the platoon at once as
+(replicates x vehicles) arrays, with the car-following models of
+NumpyPlatoonEngine and follower_stopper_batch for the AVs after
+idm_duration. Every replicate draws, from one seeded generator:
+- its initial spacings: the route_generator spacing times U(1 - gap_jitter, 1 + gap_jitter)
+- the human-driver parameters of every vehicle (accel, decel, tau, minGap,
+  desired speed): the vehicle_types values times N(1, param_jitter), clipped to [0.5, 1.5]
+- where it starts in the leader profile: U{0, ..., max_offset_s * freq} steps
+
+No trajectories are kept. Per replicate the run accumulates what
+OnlineMetrics computes (amplification, min gap, min TTC), and report()
+summarises the distribution over replicates:
+
+    ensemble = EnsembleEngine(vehicle_types, [("idm_follower", 7)], 50, n_replicates=1000, seed=0)
+    report = ensemble.run(leader_profile, interrupt_time=500, idm_duration=120)
+    report["head_to_tail_amplification"]["p95"], report["collision_probability"]
+
+    python -m controller.ensemble --replicates 1000 --seed 0 --out output/ensemble.json
+
+With n_replicates=1 and no jitter or offsets, the amplification and TTCs
+match NumpyPlatoonEngine.simulate with OnlineMetrics.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from controller.controller_manager import follower_stopper_batch
+from controller.leader_speed_profile import DEFAULT_PROFILE_CSV, cached_profile
+from controller.numpy_engine import NumpyPlatoonEngine, VEHICLE_LENGTH
+from controller.route_generator import network_routes, platoon_layout
+from controller.vehicle_config import vehicle_types as default_vehicle_types
+
+PERTURBED = ("accel", "decel", "tau", "min_gap", "v_desired")
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def _percentiles(values):
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return None
+    summary = {f"p{q}": float(p) for q, p in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+    summary["mean"] = float(values.mean())
+    return summary
+
+
+class EnsembleEngine(NumpyPlatoonEngine):
+    """
+    NumpyPlatoonEngine over n_replicates perturbed copies of the platoon.
+    avs: follower IDs that switch to follower_stopper after idm_duration
+    (default: every follower, as in run_simulation); the others keep their
+    car-following model.
+    """
+
+    def __init__(self, vehicle_types, vehicle_plan, freq, n_replicates=100, seed=0, gap_jitter=0.25,
+                 param_jitter=0.1, max_offset_s=60.0, avs=None, network_type="straight", gap=12,
+                 leader_dist=2000.0, fs_params=None, net_file=None):
+        super().__init__(vehicle_types, vehicle_plan, freq, network_type, gap, leader_dist, fs_params, net_file)
+        self.n_replicates = int(n_replicates)
+        self.seed = seed
+        self.gap_jitter = gap_jitter
+        self.param_jitter = param_jitter
+        self.max_offset_s = max_offset_s
+        self.avs = np.array([vid in set(avs) for vid in self.ids[1:]]) if avs is not None \
+            else np.ones(len(self.ids) - 1, dtype=bool)
+
+        rng = np.random.default_rng(seed)
+        n, R = len(self.ids), self.n_replicates
+        # Spacing between consecutive vehicles, back to front
+        _, _, spacing = platoon_layout(n, network_type, gap, net_file)
+        spacings = spacing * rng.uniform(1 - gap_jitter, 1 + gap_jitter, (R, n - 1))
+        spacings = np.maximum(spacings, VEHICLE_LENGTH + 0.5)
+        pos = np.zeros((R, n))
+        pos[:, :-1] = np.cumsum(spacings[:, ::-1], axis=1)[:, ::-1]
+        available = self.road_length if network_routes[network_type]["ring"] else self.road_length - gap
+        if pos[:, 0].max() >= available:
+            raise ValueError(f"Jittered platoon of {n} vehicles does not fit on {available:.0f} m")
+        self.depart_pos = pos
+
+        # Human-driver parameters per replicate and vehicle
+        for name in PERTURBED:
+            base = getattr(self, name)
+            factor = np.clip(rng.normal(1.0, param_jitter, (R, n)), 0.5, 1.5) if param_jitter else np.ones((R, n))
+            setattr(self, name, base * factor)
+
+        self.max_offset = int(round(max_offset_s * freq))
+        self.offsets = rng.integers(0, self.max_offset + 1, R)
+
+    def reference_speeds(self, profile, n_idm, window=200):
+        """(replicates x steps) r: rolling mean of the last `window` leader speeds from each replicate's offset."""
+        csum = np.concatenate(([0.0], np.cumsum(profile)))
+        steps = np.arange(self.n_steps)
+        start = self.offsets[:, None] + np.maximum(steps - window + 1, 0)
+        end = self.offsets[:, None] + steps + 1
+        ref = np.round((csum[end] - csum[start]) / (end - start), 4)
+        ref[:, :n_idm] = np.nan
+        return ref
+
+    def run(self, leader_profile=None, interrupt_time=500, idm_duration=120, window=200):
+        """Simulate every replicate and return report(); leader_profile defaults to DEFAULT_PROFILE_CSV."""
+        if leader_profile is None:
+            leader_profile = cached_profile(DEFAULT_PROFILE_CSV, self.freq)
+        profile = np.asarray(leader_profile, dtype=float)
+        self.n_steps = min(int(interrupt_time * self.freq), len(profile) - self.max_offset)
+        if self.n_steps <= 0:
+            raise ValueError(f"Leader profile too short for offsets up to {self.max_offset_s} s")
+        n_idm = int(idm_duration * self.freq)
+        ref = self.reference_speeds(profile, n_idm, window)
+
+        R, n = self.depart_pos.shape
+        rows = np.arange(R)[:, None]
+        avs = np.flatnonzero(self.avs) + 1  # columns of the AVs
+        pos = self.depart_pos.copy()
+        v = np.zeros((R, n))
+        cmd = np.full((R, n), np.nan)
+        gap = self.gaps(pos)
+
+        v_sum = np.zeros(R)
+        v_max = np.full((R, n), -np.inf)
+        v_min = np.full((R, n), np.inf)
+        min_bumper = np.full(R, np.inf)
+        min_ttc = np.full((R, n - 1), np.inf)
+        start = time.perf_counter()
+        for step in range(self.n_steps):
+            v_new = np.where(np.isnan(cmd), self.model_speed(v, gap), cmd)
+            v_new = np.maximum(v_new, 0.0)
+            v = v_new
+            pos = pos + v * self.dt
+            gap = self.gaps(pos)
+
+            # Commands applied in the next simulation step
+            cmd[:, 0] = profile[self.offsets + step]
+            if step >= n_idm and len(avs):
+                dx = gap[:, avs]
+                u_cmd = follower_stopper_batch(ref[:, step, None], dx, v[:, avs - 1] - v[:, avs], v[:, avs],
+                                               **self.fs_params)
+                has_leader = ~np.isnan(dx)
+                cmd[rows, avs] = np.where(has_leader & ~np.isnan(u_cmd), u_cmd, cmd[rows, avs])
+
+            # OnlineMetrics.update, for all replicates at once
+            v_sum += v.sum(axis=1)
+            np.maximum(v_max, v, out=v_max)
+            np.minimum(v_min, v, out=v_min)
+            bumper = gap[:, 1:] + self.min_gap[:, 1:]
+            min_bumper = np.fmin(min_bumper, np.nanmin(bumper, axis=1, initial=np.inf))
+            closing = v[:, 1:] - v[:, :-1]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ttc = np.where(closing > 0, bumper / closing, np.inf)
+            min_ttc = np.fmin(min_ttc, ttc)
+
+        self.runtime_s = time.perf_counter() - start
+        v_eq = v_sum / (self.n_steps * n)
+        dev = np.maximum(v_max - v_eq[:, None], v_eq[:, None] - v_min)
+        self.amplification = dev[:, 1:] / dev[:, :1]
+        self.min_bumper_gap = min_bumper
+        self.min_ttc = min_ttc.min(axis=1)
+        return self.report()
+
+    def report(self):
+        head_to_tail = self.amplification[:, -1]
+        collided = self.min_bumper_gap <= 0
+        return {
+            "n_replicates": self.n_replicates,
+            "seed": self.seed,
+            "freq": self.freq,
+            "n_steps": self.n_steps,
+            "runtime_s": self.runtime_s,
+            "perturbation": {"gap_jitter": self.gap_jitter, "param_jitter": self.param_jitter,
+                             "max_offset_s": self.max_offset_s},
+            "head_to_tail_amplification": _percentiles(head_to_tail),
+            "string_unstable_share": float(np.mean(head_to_tail > 1)),
+            "max_amplification": _percentiles(self.amplification.max(axis=1)),
+            "collision_probability": float(collided.mean()),
+            "min_bumper_gap": _percentiles(self.min_bumper_gap),
+            "min_ttc": _percentiles(self.min_ttc),
+            "replicates": {
+                "offset_s": (self.offsets / self.freq).tolist(),
+                "head_to_tail_amplification": head_to_tail.tolist(),
+                "min_bumper_gap": self.min_bumper_gap.tolist(),
+                "collided": collided.tolist(),
+            },
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo ensemble of perturbed platoons (NumPy engine).")
+    parser.add_argument("--replicates", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--followers", type=int, default=7, help="idm_follower vehicles behind the leader")
+    parser.add_argument("--network", choices=["straight", "ring"], default="straight")
+    parser.add_argument("--freq", type=float, default=50)
+    parser.add_argument("--interrupt-time", type=float, default=500, help="simulated seconds")
+    parser.add_argument("--idm-duration", type=float, default=120, help="seconds before the AVs switch to FS")
+    parser.add_argument("--gap-jitter", type=float, default=0.25, help="relative spread of the initial spacings")
+    parser.add_argument("--param-jitter", type=float, default=0.1, help="relative std of the driver parameters")
+    parser.add_argument("--max-offset", type=float, default=60, help="largest leader profile offset (s)")
+    parser.add_argument("--out", help="report JSON")
+    args = parser.parse_args()
+
+    ensemble = EnsembleEngine(default_vehicle_types, [("idm_follower", args.followers)], args.freq,
+                              n_replicates=args.replicates, seed=args.seed, gap_jitter=args.gap_jitter,
+                              param_jitter=args.param_jitter, max_offset_s=args.max_offset, network_type=args.network)
+    report = ensemble.run(interrupt_time=args.interrupt_time, idm_duration=args.idm_duration)
+    amp = report["head_to_tail_amplification"]
+    print(f"{report['n_replicates']} replicates x {report['n_steps']} steps in {report['runtime_s']:.1f} s: "
+          f"head-to-tail amplification p5 {amp['p5']:.3f} / p50 {amp['p50']:.3f} / p95 {amp['p95']:.3f}, "
+          f"collision probability {report['collision_probability']:.3f}")
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Ensemble report saved to: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+# controller/fake_traci.py
+"""
+In-process stand-in for the parts of traci used by run_simulation.
+
+It moves vehicles along a single lane with a simple IDM model so that the
+simulation loop, the state reader and the recorder can be exercised without
+a SUMO installation:
+
+    from controller import fake_traci
+    conn = fake_traci.FakeConnection.from_route_file("sumo_config/route/straight.rou.xml", step_length=0.02)
+    run_simulation(ref_speed, interrupt_time, freq, idm_duration, conn=conn)
+"""
+import math
+import pickle
+import xml.etree.ElementTree as ET
+import traci.constants as tc
+from controller.vehicle_config import vehicle_types
+
+VEHICLE_LENGTH = 5.0  # SUMO default passenger length
+
+
+class _Vehicle:
+    def __init__(self, vid, vtype, pos):
+        params = vehicle_types.get(vtype, vehicle_types["idm_follower"])
+        self.id = vid
+        self.type = vtype
+        self.pos = float(pos)
+        self.speed = 0.0
+        self.accel = 0.0
+        self.cmd_speed = None
+        self.speed_mode = 31
+        self.max_accel = params["accel"]
+        self.max_decel = params["decel"]
+        self.tau = params["tau"]
+        self.min_gap = params["minGap"]
+        self.max_speed = params["maxSpeed"]
+
+
+class _VehicleDomain:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def getIDList(self):
+        return tuple(self._conn._vehicles)
+
+    def getSpeed(self, vid):
+        return self._conn._vehicles[vid].speed
+
+    def getAcceleration(self, vid):
+        return self._conn._vehicles[vid].accel
+
+    def getPosition(self, vid):
+        return (self._conn._vehicles[vid].pos, self._conn.lane_y)
+
+    def getLanePosition(self, vid):
+        return self._conn._vehicles[vid].pos
+
+    def getRoadID(self, vid):
+        return "e0"
+
+    def getLength(self, vid):
+        return VEHICLE_LENGTH
+
+    def getMinGap(self, vid):
+        return self._conn._vehicles[vid].min_gap
+
+    def getRoute(self, vid):
+        return ("e0",)
+
+    def getTypeID(self, vid):
+        return self._conn._vehicles[vid].type
+
+    def getLeader(self, vid, dist=100.0):
+        return self._conn._leader(vid, dist)
+
+    def setSpeedMode(self, vid, mode):
+        self._conn._vehicles[vid].speed_mode = mode
+
+    def setSpeed(self, vid, speed):
+        self._conn._vehicles[vid].cmd_speed = None if speed < 0 else float(speed)
+
+    def setAcceleration(self, vid, accel, duration):
+        veh = self._conn._vehicles[vid]
+        veh.cmd_speed = max(0.0, veh.speed + accel * self._conn.step_length)
+
+    def subscribe(self, vid, varIDs=None, begin=None, end=None, parameters=None):
+        dist = 0.0
+        if parameters and tc.VAR_LEADER in parameters:
+            dist = parameters[tc.VAR_LEADER][1]
+        self._conn._subscriptions[vid] = (tuple(varIDs or ()), dist)
+        self._conn._results[vid] = self._conn._subscription_values(vid)
+
+    def subscribeLeader(self, vid, dist=0.0, begin=None, end=None):
+        self.subscribe(vid, (tc.VAR_LEADER,), parameters={tc.VAR_LEADER: ("d", dist)})
+
+    def getSubscriptionResults(self, vid):
+        return self._conn._results.get(vid, {})
+
+    def getAllSubscriptionResults(self):
+        return self._conn._results
+
+
+class _LaneDomain:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def getLength(self, lane_id):
+        return self._conn.road_length
+
+    def getLinks(self, lane_id, extended=True):
+        return []
+
+
+class _SimulationDomain:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def getTime(self):
+        return self._conn.step * self._conn.step_length
+
+    def getDeltaT(self):
+        return self._conn.step_length
+
+    def subscribe(self, varIDs=(tc.VAR_DEPARTED_VEHICLES_IDS,), begin=0, end=None, parameters=None):
+        self._conn._sim_vars = tuple(varIDs)
+
+    def getSubscriptionResults(self):
+        return self._conn._sim_results
+
+    def getOption(self, name):
+        return self._conn.options.get(name, "")
+
+    def saveState(self, path):
+        with open(path, "wb") as f:
+            pickle.dump((self._conn.step, self._conn._pending, self._conn._vehicles), f)
+
+    def loadState(self, path):
+        # Like SUMO: subscriptions and TraCI speed commands are not part of the state
+        conn = self._conn
+        with open(path, "rb") as f:
+            conn.step, conn._pending, conn._vehicles = pickle.load(f)
+        for veh in conn._vehicles.values():
+            veh.cmd_speed, veh.speed_mode = None, 31
+        conn._subscriptions, conn._results = {}, {}
+
+
+class FakeConnection:
+    """Single-lane stand-in with the traci connection surface (vehicle, simulation, simulationStep, close)."""
+
+    def __init__(self, vehicles, step_length=0.1, lane_y=-1.6, road_length=50000.0):
+        """vehicles: iterable of (veh_id, vtype, depart_pos); all depart at the first step on edge e0."""
+        self.step_length = step_length
+        self.lane_y = lane_y
+        self.road_length = road_length
+        self.step = 0
+        self._pending = [_Vehicle(vid, vtype, pos) for vid, vtype, pos in vehicles]
+        self._vehicles = {}
+        self._subscriptions = {}
+        self._results = {}
+        self._sim_vars = ()
+        self._sim_results = {}
+        # Answers to simulation.getOption; saved states are always exact
+        self.options = {"step-length": str(step_length), "save-state.precision": "17", "save-state.rng": "true"}
+        self.vehicle = _VehicleDomain(self)
+        self.simulation = _SimulationDomain(self)
+        self.lane = _LaneDomain(self)
+
+    @classmethod
+    def from_route_file(cls, route_file, step_length=0.1):
+        vehicles = []
+        for elem in ET.parse(route_file).getroot().iter("vehicle"):
+            vehicles.append((elem.get("id"), elem.get("type"), float(elem.get("departPos", 0))))
+        conn = cls(vehicles, step_length=step_length)
+        conn.options["route-files"] = route_file
+        return conn
+
+    def _ordered(self):
+        return sorted(self._vehicles.values(), key=lambda veh: veh.pos, reverse=True)
+
+    def _leader(self, vid, dist):
+        veh = self._vehicles[vid]
+        best = None
+        for other in self._vehicles.values():
+            if other.pos > veh.pos and (best is None or other.pos < best.pos):
+                best = other
+        if best is None:
+            return None
+        # Like SUMO, the gap excludes the follower's minGap
+        gap = best.pos - VEHICLE_LENGTH - veh.pos - veh.min_gap
+        if dist > 0 and gap > dist:
+            return None
+        return (best.id, gap)
+
+    def _subscription_values(self, vid):
+        varIDs, dist = self._subscriptions[vid]
+        veh = self._vehicles[vid]
+        values = {}
+        for var in varIDs:
+            if var == tc.VAR_SPEED:
+                values[var] = veh.speed
+            elif var == tc.VAR_ACCELERATION:
+                values[var] = veh.accel
+            elif var == tc.VAR_POSITION:
+                values[var] = (veh.pos, self.lane_y)
+            elif var == tc.VAR_LANEPOSITION:
+                values[var] = veh.pos
+            elif var == tc.VAR_ROAD_ID:
+                values[var] = "e0"
+            elif var == tc.VAR_LENGTH:
+                values[var] = VEHICLE_LENGTH
+            elif var == tc.VAR_TYPE:
+                values[var] = veh.type
+            elif var == tc.VAR_LEADER:
+                values[var] = self._leader(vid, dist) or ("", -1.0)
+        return values
+
+    def _idm_accel(self, veh, leader):
+        accel = veh.max_accel * (1 - (veh.speed / veh.max_speed) ** 4)
+        if leader is not None:
+            gap = max(leader.pos - VEHICLE_LENGTH - veh.pos, 0.1)
+            dv = veh.speed - leader.speed
+            s_star = veh.min_gap + max(0.0, veh.speed * veh.tau +
+                                      veh.speed * dv / (2 * math.sqrt(veh.max_accel * veh.max_decel)))
+            accel -= veh.max_accel * (s_star / gap) ** 2
+        return accel
+
+    def simulationStep(self, step=0.0):
+        departed = [veh.id for veh in self._pending]
+        for veh in self._pending:
+            self._vehicles[veh.id] = veh
+        self._pending = []
+
+        dt = self.step_length
+        ordered = self._ordered()
+        new_speeds = {}
+        for i, veh in enumerate(ordered):
+            leader = ordered[i - 1] if i > 0 else None
+            if veh.cmd_speed is not None:
+                target = veh.cmd_speed
+                if veh.speed_mode != 0:
+                    target = min(max(target, veh.speed - veh.max_decel * dt), veh.speed + veh.max_accel * dt)
+            else:
+                accel = max(self._idm_accel(veh, leader), -veh.max_decel)
+                target = veh.speed + accel * dt
+            new_speeds[veh.id] = max(0.0, target)
+
+        for veh in ordered:
+            v_new = new_speeds[veh.id]
+            veh.accel = (v_new - veh.speed) / dt
+            veh.speed = v_new
+            veh.pos += v_new * dt
+
+        self.step += 1
+        self._results = {vid: self._subscription_values(vid) for vid in self._subscriptions if vid in self._vehicles}
+        self._sim_results = {tc.VAR_DEPARTED_VEHICLES_IDS: tuple(departed)} if self._sim_vars else {}
+
+    def close(self):
+        self._vehicles = {}
+        self._results = {}
+
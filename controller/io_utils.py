@@ -1,29 +1,75 @@
 import os
+import numpy as np
 import pandas as pd
+from controller.recorder import TrajectoryRecorder, load_chunks, vehicle_sort_key
+
+PARQUET_ROW_GROUP = 1_000_000  # rows per Parquet row group, so readers like analysis/space_time.py can stream a run
 
 def save_simulation_to_csv(time_log, speeds, accelerations, x_positions, y_positions, headways, ref_vels, save_path="output/simulation.csv"):
     os.makedirs(os.path.dirname(save_path), exist_ok=True)
 
-    records = []
-    sorted_ids = sorted(speeds.keys())
-
-    for t_idx, time in enumerate(time_log):
-        for i, vid in enumerate(sorted_ids):
-            role = "Leader" if i == 0 else f"Follower{i}"
-            
-            if t_idx < len(speeds[vid]):
-                records.append({
-                    "time_step": time,
-                    "vehicle_id": vid,
-                    "role": role,
-                    "speed_mps": speeds[vid][t_idx],
-                    "acceleration": accelerations[vid][t_idx],
-                    "x": x_positions[vid][t_idx],
-                    "y": y_positions[vid][t_idx],
-                    "space_headway": headways[vid][t_idx],
-                    "ref_vels": ref_vels[vid][t_idx] if vid in ref_vels and t_idx < len(ref_vels[vid]) else None
-                })
-
-    df = pd.DataFrame(records)
+    # Numeric ID order (veh2 before veh10); the first vehicle is the leader
+    sorted_ids = sorted(speeds.keys(), key=vehicle_sort_key)
+    time_log = np.asarray(time_log)
+
+    # One column block per vehicle instead of one dict per (time, vehicle) row
+    frames = []
+    for i, vid in enumerate(sorted_ids):
+        role = "Leader" if i == 0 else f"Follower{i}"
+        n = min(len(speeds[vid]), len(time_log))
+        ref = np.full(n, np.nan)
+        if vid in ref_vels:
+            m = min(len(ref_vels[vid]), n)
+            ref[:m] = np.asarray(ref_vels[vid][:m], dtype=float)
+
+        frames.append(pd.DataFrame({
+            "time_step": time_log[:n],
+            "vehicle_id": vid,
+            "role": role,
+            "speed_mps": speeds[vid][:n],
+            "acceleration": accelerations[vid][:n],
+            "x": x_positions[vid][:n],
+            "y": y_positions[vid][:n],
+            "space_headway": headways[vid][:n],
+            "ref_vels": ref,
+        }))
+
+    df = pd.concat(frames, ignore_index=True)
+    # Rows ordered by time step, then vehicle, like the original row-by-row export
+    df = df.sort_values("time_step", kind="stable", ignore_index=True)
     df.to_csv(save_path, index=False)
     # print(f"Simulation CSV saved to: {save_path}")
+
+
+def save_trajectories(recorder, save_path):
+    """Save a TrajectoryRecorder as .npz (compressed arrays), .parquet or .csv depending on the extension."""
+    os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+    ext = os.path.splitext(save_path)[1].lower()
+
+    if ext == ".npz":
+        np.savez_compressed(save_path, **recorder.to_arrays())
+    elif ext == ".parquet":
+        recorder.to_dataframe(decimals=None).to_parquet(save_path, index=False, row_group_size=PARQUET_ROW_GROUP)
+    elif ext == ".csv":
+        recorder.to_dataframe().to_csv(save_path, index=False)
+    else:
+        raise ValueError(f"Unsupported trajectory format: {ext}")
+
+
+def load_trajectories(path):
+    """
+    Load a run saved by save_trajectories (or any save_simulation_to_csv file,
+    or a StreamingRecorder chunk directory) into a TrajectoryRecorder with
+    (steps x vehicles) arrays.
+    """
+    if os.path.isdir(path):
+        return load_chunks(path)
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npz":
+        with np.load(path, allow_pickle=False) as data:
+            return TrajectoryRecorder.from_arrays({key: data[key] for key in data.files})
+    if ext == ".parquet":
+        return TrajectoryRecorder.from_dataframe(pd.read_parquet(path))
+    if ext == ".csv":
+        return TrajectoryRecorder.from_dataframe(pd.read_csv(path))
+    raise ValueError(f"Unsupported trajectory format: {ext}")
@@ -1,30 +1,140 @@
 # controller/leader_profile.py
+import glob
+import hashlib
+import json
 import math
+import os
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib import rcParams
-# Plot styling
-rcParams["text.usetex"] = True
-rcParams["font.family"] = "serif"
-rcParams["font.serif"] = ["Times"]
-rcParams["font.size"] = 14
-rcParams["axes.labelsize"] = 16
-rcParams["xtick.labelsize"] = 14
-rcParams["ytick.labelsize"] = 14
-rcParams["legend.fontsize"] = 14
 
 _speed_profile = []
 _time_profile = []
 
-import matplotlib.pyplot as plt
+# Drive that run_simulation follows unless it is given a leader profile
+DEFAULT_PROFILE_CSV = "controller/2021-07-26-21-10-20_2T3H1RFV8LC057037_CAN_Messages_decoded_speed.csv"
 
-_speed_profile = []
-_time_profile = []
+# Disk cache of resampled profiles, shared between processes through mmap'd .npy files
+PROFILE_CACHE_DIR = "output/cache/profiles"
+PROFILE_CACHE_MAX_BYTES = 256 * 1024 * 1024  # least recently used entries are evicted above this
+profile_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
 
-def load_real_profile(csv_path, freq):
+
+def load_real_profile(csv_path, freq, use_cache=True):
     global _speed_profile, _time_profile
 
+    if use_cache:
+        _speed_profile = cached_profile(csv_path, freq)
+    else:
+        _speed_profile = resample_profile(csv_path, freq)
+
+
+def _profile_key(csv_path, freq):
+    # Hash of the file content, so a CSV replaced in place with the same size and
+    # mtime (cp -p, rsync) still gets a new key; reading a CSV costs far less than parsing it
+    source = os.path.abspath(csv_path)
+    h = hashlib.sha1(f"{source}|{float(freq)!r}|".encode())
+    with open(csv_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return source, h.hexdigest()
+
+
+def cached_profile(csv_path, freq, cache_dir=None, max_bytes=None):
+    """
+    Resampled profile for (csv_path, freq), read-only memory-mapped from the
+    disk cache. On a miss the CSV is parsed once and the result stored as .npy
+    (replacing stale entries of the same source and freq).
+    """
+    cache_dir = cache_dir or PROFILE_CACHE_DIR
+    source, key = _profile_key(csv_path, freq)
+    npy_path = os.path.join(cache_dir, key + ".npy")
+
+    if os.path.exists(npy_path):
+        try:
+            profile = np.load(npy_path, mmap_mode="r")
+            os.utime(npy_path)  # mark as recently used
+            profile_cache_stats["hits"] += 1
+            return profile
+        except (OSError, ValueError):
+            pass  # truncated or removed by another process, rebuild it
+
+    profile_cache_stats["misses"] += 1
+    profile = resample_profile(csv_path, freq)
+    os.makedirs(cache_dir, exist_ok=True)
+    _invalidate_profile(cache_dir, source, freq, keep=key)
+
+    # Write under a unique name and rename so concurrent workers never read a partial file
+    tmp = f"{npy_path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, profile)
+    os.replace(tmp, npy_path)
+    with open(os.path.join(cache_dir, key + ".json"), "w") as f:
+        json.dump({"source": source, "freq": float(freq)}, f)
+
+    evict_profiles(cache_dir, max_bytes if max_bytes is not None else PROFILE_CACHE_MAX_BYTES, keep=key)
+    try:
+        return np.load(npy_path, mmap_mode="r")
+    except (OSError, ValueError):
+        return profile  # evicted by another process in between
+
+
+def _invalidate_profile(cache_dir, source, freq, keep):
+    for meta_path in glob.glob(os.path.join(cache_dir, "*.json")):
+        key = os.path.basename(meta_path)[:-5]
+        if key == keep:
+            continue
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if meta.get("source") == source and meta.get("freq") == float(freq):
+            _remove_profile(cache_dir, key)
+
+
+def _remove_profile(cache_dir, key):
+    for ext in (".npy", ".json"):
+        try:
+            os.remove(os.path.join(cache_dir, key + ext))
+        except FileNotFoundError:
+            pass
+
+
+def evict_profiles(cache_dir=None, max_bytes=None, keep=None):
+    """
+    Remove least recently used cached profiles until the cache fits in
+    max_bytes. The entry `keep` (the one just written) is never removed, even
+    if it alone is larger than max_bytes.
+    """
+    cache_dir = cache_dir or PROFILE_CACHE_DIR
+    max_bytes = PROFILE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for npy_path in glob.glob(os.path.join(cache_dir, "*.npy")):
+        try:
+            st = os.stat(npy_path)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, npy_path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, npy_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.basename(npy_path)[:-4] == keep:
+            continue
+        _remove_profile(cache_dir, os.path.basename(npy_path)[:-4])
+        profile_cache_stats["evictions"] += 1
+        total -= size
+
+
+def clear_profile_cache(cache_dir=None):
+    cache_dir = cache_dir or PROFILE_CACHE_DIR
+    for path in glob.glob(os.path.join(cache_dir, "*.npy")) + glob.glob(os.path.join(cache_dir, "*.json")):
+        os.remove(path)
+
+
+def read_can_speeds(csv_path):
+    """(time in s, speed in m/s) of a decoded CAN CSV, from the first moving sample on."""
     df = pd.read_csv(csv_path)
 
     # Use first column as POSIX timestamps (in seconds with microseconds)
@@ -45,18 +155,19 @@ def load_real_profile(csv_path, freq):
     start_time = df[time_col].iloc[0]
     df['timestamp'] = df[time_col] - start_time  # already in seconds
 
-    # # KEEP ORIGINAL SAMPLING
-    # _speed_profile = df[speed_col].to_numpy()
-    # _time_profile = df['timestamp'].to_numpy()
+    return df['timestamp'].to_numpy(), df[speed_col].to_numpy()
+
+
+def resample_profile(csv_path, freq):
+    """Parse the CAN CSV and resample the leader speed (m/s) to 1/freq steps."""
+    timestamps, speeds = read_can_speeds(csv_path)
 
     # Resample to fixed 0.1s steps
-    max_time = df['timestamp'].iloc[-1]
+    max_time = timestamps[-1]
     ts_uniform = np.arange(0, max_time, 1/freq)  # uniform resolution
-    speed_uniform = np.interp(ts_uniform, df['timestamp'], df[speed_col])
-
-    # Store values
-    _speed_profile = speed_uniform     # in m/s
+    speed_uniform = np.interp(ts_uniform, timestamps, speeds)
 
+    return speed_uniform     # in m/s
 
     # Plot the result
     # plt.figure(figsize=(12, 5))
@@ -77,6 +188,9 @@ def get_profile_length():
     # print  (f"Leader profile length: {len(_speed_profile)}")
     return len(_speed_profile)
 
+def get_profile():
+    return np.asarray(_speed_profile, dtype=float)
+
 def stop_and_go_profile(step):
     """
     Sinusoidal stop-and-go speed profile.
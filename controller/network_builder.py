@@ -0,0 +1,210 @@
+# controller/network_builder.py
+"""
+SUMO networks of any size, built on demand and cached.
+
+build_network("ring", 2000) writes the nod/edg/netccfg files of a ring with
+a 2 km lap (a regular polygon of edges), runs netconvert and registers the
+network under its name in route_generator.network_files/network_routes and
+numpy_engine.NETWORKS, so generate_route(), NumpyPlatoonEngine and
+write_sumo_config() take it like the hand-built networks:
+
+    net = build_network("ring", 2000, lanes=1)
+    generate_route(vehicle_types, [("idm_follower", 20)], net.name, filename=route_file)
+    net.write_config(cfg_file, route_file, step_length=1 / freq)
+
+Networks are cached under NETWORK_CACHE_DIR by a hash of the parameters
+and the netconvert binary, so netconvert only runs for new parameters; a
+cache hit reads one JSON file. Each network is built in a temporary
+directory that is renamed into place, so concurrent sweep workers asking
+for the same network never see a partial one.
+
+netconvert shortens edges at junctions, so the first ring build comes out
+slightly short of the requested lap; the radius is corrected once from the
+measured lap and the ring rebuilt. `length` of the result is the measured
+lap (ring) or road length (straight).
+"""
+import hashlib
+import json
+import math
+import os
+import shutil
+import subprocess
+
+import sumolib
+
+from controller import numpy_engine, route_generator
+
+NETWORK_CACHE_DIR = "output/cache/networks"
+NETWORK_FORMAT = 1  # bump when the generated files change, so cached networks are rebuilt
+KINDS = ("ring", "straight")
+RING_EDGE_LENGTH = 1000.0  # target edge length of a ring (the 40 km ring has 40 edges)
+RING_MIN_EDGES = 16  # fewer edges would give sharp corners on small rings
+RING_ROUTE_LENGTH = 100000.0  # meters a ring route lasts; laps = ceil(RING_ROUTE_LENGTH / lap)
+STRAIGHT_SPEED = 25  # speed limit of the hand-built straight road; rings keep netconvert's default
+network_cache_stats = {"hits": 0, "builds": 0}
+
+
+def network_label(kind, length, lanes=1):
+    """Short name for job and file names, e.g. ring2000m or straight5000m_2l."""
+    label = f"{kind}{route_generator._fmt(length)}m"
+    return label if lanes == 1 else f"{label}_{lanes}l"
+
+
+def _netconvert():
+    binary = sumolib.checkBinary("netconvert")
+    try:
+        stat = os.stat(binary)
+        return [binary, stat.st_size, stat.st_mtime_ns]
+    except OSError:
+        return [binary]
+
+
+def network_key(kind, length, lanes=1, speed=None, n_edges=None):
+    inputs = {"format": NETWORK_FORMAT, "kind": kind, "length": float(length), "lanes": int(lanes),
+              "speed": speed, "n_edges": n_edges, "netconvert": _netconvert()}
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def _edge_attrs(lanes, speed):
+    attrs = f' numLanes="{lanes}"' if lanes != 1 else ""
+    return attrs + (f' speed="{speed}"' if speed is not None else "")
+
+
+def _write_ring(directory, n_edges, radius, lanes, speed):
+    with open(os.path.join(directory, "net.nod.xml"), "w") as f:
+        f.write("<nodes>\n")
+        for i in range(n_edges):
+            angle = 2 * math.pi * i / n_edges
+            f.write(f'    <node id="n{i}" x="{radius * math.cos(angle):.2f}" y="{radius * math.sin(angle):.2f}"/>\n')
+        f.write("</nodes>\n")
+    with open(os.path.join(directory, "net.edg.xml"), "w") as f:
+        f.write("<edges>\n")
+        for i in range(n_edges):
+            f.write(f'    <edge id="e{i}" from="n{i}" to="n{(i + 1) % n_edges}"{_edge_attrs(lanes, speed)}/>\n')
+        f.write("</edges>\n")
+
+
+def _write_straight(directory, length, lanes, speed):
+    with open(os.path.join(directory, "net.nod.xml"), "w") as f:
+        f.write("<nodes>\n")
+        f.write('    <node id="start" x="0" y="0" type="priority"/>\n')
+        f.write(f'    <node id="end" x="{route_generator._fmt(length)}" y="0" type="priority"/>\n')
+        f.write("</nodes>\n")
+    with open(os.path.join(directory, "net.edg.xml"), "w") as f:
+        f.write("<edges>\n")
+        f.write(f'    <edge id="e0" from="start" to="end"{_edge_attrs(lanes, speed)}/>\n')
+        f.write("</edges>\n")
+
+
+def _netconvert_run(directory):
+    with open(os.path.join(directory, "net.netccfg"), "w") as f:
+        f.write("<configuration>\n")
+        f.write("    <input>\n")
+        f.write('        <node-files value="net.nod.xml"/>\n')
+        f.write('        <edge-files value="net.edg.xml"/>\n')
+        f.write("    </input>\n")
+        f.write("    <output>\n")
+        f.write('        <output-file value="net.net.xml"/>\n')
+        f.write("    </output>\n")
+        f.write("</configuration>\n")
+    result = subprocess.run([sumolib.checkBinary("netconvert"), "-c", "net.netccfg", "--no-warnings"],
+                            cwd=directory, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"netconvert failed in {directory}:\n{result.stderr}")
+
+
+def _build(directory, kind, length, lanes, speed, n_edges):
+    """Write and convert the network in `directory`; returns its metadata."""
+    if kind == "ring":
+        n_edges = n_edges or max(RING_MIN_EDGES, math.ceil(length / RING_EDGE_LENGTH))
+        edges = [f"e{i}" for i in range(n_edges)]
+        # Radius of the polygon whose perimeter is the lap, then corrected once for the junctions
+        radius = length / (2 * n_edges * math.sin(math.pi / n_edges))
+        for _ in range(2):
+            _write_ring(directory, n_edges, radius, lanes, speed)
+            _netconvert_run(directory)
+            lap = route_generator.route_geometry(os.path.join(directory, "net.net.xml"), edges)[2]
+            radius *= length / lap
+        route = {"route_id": "loop", "edges": edges, "laps": math.ceil(RING_ROUTE_LENGTH / lap) + 1, "ring": True}
+    else:
+        speed = STRAIGHT_SPEED if speed is None else speed
+        _write_straight(directory, length, lanes, speed)
+        _netconvert_run(directory)
+        lap = route_generator.route_geometry(os.path.join(directory, "net.net.xml"), ["e0"])[2]
+        route = {"route_id": "straight", "edges": ["e0"], "laps": 1, "ring": False}
+    return {"kind": kind, "requested_length": float(length), "length": lap, "lanes": lanes, "speed": speed,
+            "route": route}
+
+
+class Network:
+    """A built network: name (registered with route_generator), net_file, length, route."""
+
+    def __init__(self, directory, meta):
+        self.directory = directory
+        self.meta = meta
+        self.name = meta["name"]
+        self.kind = meta["kind"]
+        self.length = meta["length"]
+        self.lanes = meta["lanes"]
+        self.route = meta["route"]
+        self.net_file = os.path.join(directory, "net.net.xml")
+
+    def register(self):
+        route_generator.network_files[self.name] = self.net_file
+        route_generator.network_routes[self.name] = self.route
+        numpy_engine.NETWORKS[self.name] = {"net_file": self.net_file, "ring": self.route["ring"]}
+        return self
+
+    def write_config(self, cfg_file, route_file, step_length=0.1):
+        route_generator.write_sumo_config(cfg_file, self.net_file, route_file, step_length)
+        return cfg_file
+
+
+def build_network(kind, length, lanes=1, speed=None, n_edges=None, cache_dir=None, force=False):
+    """
+    Ring with a `length` m lap, or straight road `length` m long, with
+    `lanes` lanes and speed limit `speed` (m/s; None keeps the hand-built
+    networks' limits). Built once per parameter set; returns the registered
+    Network.
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown network kind: {kind} (expected one of {KINDS})")
+    cache_dir = cache_dir or NETWORK_CACHE_DIR
+    key = network_key(kind, length, lanes, speed, n_edges)
+    directory = os.path.join(cache_dir, key)
+    meta_path = os.path.join(directory, "network.json")
+
+    if not force and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        network_cache_stats["hits"] += 1
+        return Network(directory, meta).register()
+
+    tmp = f"{directory}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    try:
+        meta = _build(tmp, kind, length, lanes, speed, n_edges)
+        meta["name"] = f"{network_label(kind, length, lanes)}_{key[:8]}"
+        meta["key"] = key
+        with open(os.path.join(tmp, "network.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        if force:
+            shutil.rmtree(directory, ignore_errors=True)
+        try:
+            os.rename(tmp, directory)
+        except OSError:
+            # Another worker finished the same network first; use theirs
+            shutil.rmtree(tmp, ignore_errors=True)
+            with open(meta_path) as f:
+                meta = json.load(f)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    network_cache_stats["builds"] += 1
+    print(f"Network built: {meta['name']} ({meta['length']:.1f} m) in {directory}")
+    return Network(directory, meta).register()
+
+
+def clear_network_cache(cache_dir=None):
+    shutil.rmtree(cache_dir or NETWORK_CACHE_DIR, ignore_errors=True)
@@ -0,0 +1,256 @@
+# controller/numpy_engine.py
+"""
+SUMO-free longitudinal platoon simulator.
+
+Advances the whole platoon as NumPy arrays each step, following the same
+phases as run_simulation: the leader tracks the speed profile, followers
+drive with their SUMO car-following model (IDM or Krauss) until
+idm_duration, then every follower switches to follower_stopper with
+r = rolling mean of the last 200 leader speeds.
+
+Vehicles are laid out like route_generator.generate_straight_route /
+generate_ring_route (veh0 in front, fixed initial gap). Known differences
+from SUMO:
+- desired speed = min(maxSpeed, lane speed limit); SUMO additionally draws a
+  per-vehicle speedFactor (default normc(1, 0.1)) unless speedDev=0
+- Krauss runs without dawdling (sigma = 0)
+- CACC types fall back to IDM
+"""
+import math
+import xml.etree.ElementTree as ET
+import numpy as np
+from controller.controller_manager import ControllerDispatcher, follower_stopper_params
+from controller.route_generator import network_files, plan_sequence, platoon_layout
+from controller.recorder import TrajectoryRecorder
+from controller.ref_speed import ReferenceSpeeds
+
+VEHICLE_LENGTH = 5.0  # SUMO default passenger length
+
+MODEL_IDM = 0
+MODEL_KRAUSS = 1
+
+# Network files the route generators are written for
+NETWORKS = {
+    "straight": {"net_file": network_files["straight"], "ring": False},
+    "ring": {"net_file": network_files["ring"], "ring": True},
+}
+
+def read_network(net_file):
+    """Return (total lane length, speed limit) of a single-lane net.xml, internal lanes included."""
+    length = 0.0
+    speed = None
+    for lane in ET.parse(net_file).getroot().iter("lane"):
+        if lane.get("index") != "0":
+            continue
+        length += float(lane.get("length"))
+        if not lane.get("id").startswith(":"):
+            speed = float(lane.get("speed")) if speed is None else max(speed, float(lane.get("speed")))
+    return length, speed
+
+
+def build_platoon(vehicle_plan, gap=12, network_type="straight", net_file=None):
+    """Vehicle IDs, types and depart positions in the layout used by route_generator."""
+    vtypes = ["idm_follower"] + plan_sequence(vehicle_plan)
+    ids = [f"veh{i}" for i in range(len(vtypes))]
+    positions, _, _ = platoon_layout(len(vtypes), network_type, gap, net_file)
+    return ids, vtypes, np.array(positions, dtype=float)
+
+
+def rolling_reference(profile, n_idm, window=200):
+    """Reference speed per step: mean of the last `window` leader speeds (NaN during the IDM phase)."""
+    profile = np.asarray(profile, dtype=float)
+    csum = np.concatenate(([0.0], np.cumsum(profile)))
+    steps = np.arange(len(profile))
+    start = np.maximum(steps - window + 1, 0)
+    ref = (csum[steps + 1] - csum[start]) / (steps + 1 - start)
+    ref[:n_idm] = np.nan
+    return ref
+
+
+class NumpyPlatoonEngine:
+    def __init__(self, vehicle_types, vehicle_plan, freq, network_type="straight", gap=12,
+                 leader_dist=2000.0, fs_params=None, net_file=None, ref_estimators=None, controllers=None):
+        if network_type not in NETWORKS:
+            raise ValueError(f"Unknown network type for the NumPy backend: {network_type}")
+
+        network = NETWORKS[network_type]
+        self.ring = network["ring"]
+        self.road_length, self.speed_limit = read_network(net_file or network["net_file"])
+        self.freq = freq
+        self.dt = 1 / freq
+        self.leader_dist = leader_dist
+        self.fs_params = fs_params or follower_stopper_params
+        self.ref_estimators = ref_estimators  # None: rolling mean of `window` leader speeds for every follower
+        self.controllers = controllers  # as in run_simulation: a controller name or {veh_id: name}
+
+        self.ids, self.vtypes, self.depart_pos = build_platoon(vehicle_plan, gap, network_type, net_file)
+        params = [vehicle_types[vtype] for vtype in self.vtypes]
+        self.accel = np.array([p["accel"] for p in params], dtype=float)
+        self.decel = np.array([p["decel"] for p in params], dtype=float)
+        self.tau = np.array([p["tau"] for p in params], dtype=float)
+        self.min_gap = np.array([p["minGap"] for p in params], dtype=float)
+        self.v_desired = np.minimum([p["maxSpeed"] for p in params], self.speed_limit)
+        self.model = np.array([MODEL_KRAUSS if p["carFollowModel"] == "Krauss" else MODEL_IDM for p in params])
+        self.cf_models = {vid: p["carFollowModel"] for vid, p in zip(self.ids, params)}
+
+    def gaps(self, pos):
+        """
+        Gap to the vehicle ahead excluding minGap, as reported by getLeader (NaN
+        when none). Vehicles are on the last axis, so (replicates x vehicles)
+        arrays work too (controller/ensemble.py).
+        """
+        gap = np.full(pos.shape, np.nan)
+        gap[..., 1:] = pos[..., :-1] - VEHICLE_LENGTH - pos[..., 1:] - self.min_gap[..., 1:]
+        if self.ring:
+            gap[..., 0] = pos[..., -1] + self.road_length - VEHICLE_LENGTH - pos[..., 0] - self.min_gap[..., 0]
+        gap[gap > self.leader_dist] = np.nan
+        return gap
+
+    def model_speed(self, v, gap):
+        """Next speed of every vehicle under its own car-following model, given gaps() of the current positions."""
+        v_lead = np.empty_like(v)
+        v_lead[..., 1:] = v[..., :-1]
+        v_lead[..., 0] = v[..., -1]
+        free = np.isnan(gap)
+        gap = np.where(free, np.inf, np.maximum(gap, 1e-6))
+
+        # IDM as in SUMO's MSCFModel_IDM with one iteration per step; it works on the bumper gap (minGap included)
+        s_star = self.min_gap + np.maximum(0.0, v * self.tau + v * (v - v_lead) / (2 * np.sqrt(self.accel * self.decel)))
+        acc = self.accel * (1 - (v / self.v_desired) ** 4 - (s_star / (gap + self.min_gap)) ** 2)
+        v_idm = np.maximum(0.0, v + acc * self.dt)
+
+        # Krauss safe speed without dawdling
+        bt = self.decel * self.tau
+        v_safe = -bt + np.sqrt(bt ** 2 + v_lead ** 2 + 2 * self.decel * gap)
+        v_krauss = np.minimum.reduce([v + self.accel * self.dt, v_safe, self.v_desired])
+        v_krauss = np.maximum(v_krauss, v - self.decel * self.dt)
+
+        return np.where(self.model == MODEL_KRAUSS, v_krauss, v_idm)
+
+    def positions(self, pos):
+        """Cartesian (x, y) of lane positions; the ring is a circle centred on the origin."""
+        if not self.ring:
+            return pos.copy(), np.full(len(pos), -1.6)
+        radius = self.road_length / (2 * math.pi)
+        angle = pos / radius
+        return radius * np.cos(angle), radius * np.sin(angle)
+
+    def simulate(self, leader_profile, interrupt_time, idm_duration, window=200, recorder=None, dtype=np.float64,
+                 metrics=None, target_speed=None):
+        """
+        Run the platoon and return a TrajectoryRecorder with (steps x vehicles)
+        arrays: speed, acceleration, x, y, headway and ref_vel.
+        recorder=False skips recording (only `metrics` is updated) and returns None.
+        target_speed is the cruise speed for controllers that use it (nominal).
+        """
+        profile = np.asarray(leader_profile, dtype=float)
+        n_steps = min(int(interrupt_time * self.freq), len(profile))
+        n_idm = int(idm_duration * self.freq)
+        ref, ref_cols = self.reference_speeds(profile[:n_steps], n_idm, window)
+
+        n = len(self.ids)
+        pos = self.depart_pos.copy()
+        v = np.zeros(n)
+        cmd = np.full(n, np.nan)
+        gap = self.gaps(pos)
+
+        if recorder is None:
+            recorder = TrajectoryRecorder(n_steps, dtype=dtype)
+        if recorder is not False:
+            cols = np.array([recorder.add_vehicle(vid, self.cf_models[vid]) for vid in self.ids])
+            recorder.order = list(self.ids)
+        if metrics is not None:
+            metrics.start(self.ids, self.min_gap)
+        ref_vel = np.full(n, np.nan)
+        followers = self.ids[1:]
+        dispatcher = self.dispatcher()
+        for step in range(n_steps):
+            v_new = np.where(np.isnan(cmd), self.model_speed(v, gap), cmd)
+            v_new = np.maximum(v_new, 0.0)
+            acc = (v_new - v) / self.dt
+            v = v_new
+            pos = pos + v * self.dt
+            gap = self.gaps(pos)
+
+            # Commands applied in the next simulation step
+            cmd[0] = profile[step]
+            if step >= n_idm:
+                r = ref[step, ref_cols]
+                dv = np.empty(n)
+                dv[1:] = v[:-1] - v[1:]
+                dv[0] = v[-1] - v[0]
+                has_leader = ~np.isnan(gap[1:])
+                inputs = {"ref_speed": r, "gap": gap[1:], "dv": dv[1:], "speed": v[1:], "leader_speed": v[:-1],
+                          "target_speed": target_speed}
+                speed_cmd, accel_cmd = dispatcher.compute(followers, inputs, active=has_leader)
+                # Acceleration commands act over the next step, like setAcceleration in SUMO
+                u_cmd = np.where(np.isnan(speed_cmd), v[1:] + accel_cmd * self.dt, speed_cmd)
+                cmd[1:] = np.where(has_leader & ~np.isnan(u_cmd), u_cmd, cmd[1:])
+                ref_vel[1:] = np.where(has_leader, r, np.nan)
+
+            if recorder is not False:
+                x, y = self.positions(pos)
+                recorder.record_step(step, v, acc, x, y, gap, ref_vel, cols=cols)
+            if metrics is not None:
+                metrics.update(step, self.ids, v, gap)
+
+        return recorder or None
+
+    def dispatcher(self):
+        params = {"follower_stopper": self.fs_params}
+        if isinstance(self.controllers, str):
+            return ControllerDispatcher(default=self.controllers, dt=self.dt, params=params)
+        return ControllerDispatcher(self.controllers or {}, default="follower_stopper", dt=self.dt, params=params)
+
+    def reference_speeds(self, profile, n_idm, window=200):
+        """
+        (steps x estimators) reference speeds, rounded like run_simulation, and
+        the estimator column used by each follower.
+        """
+        followers = self.ids[1:]
+        if self.ref_estimators is None:
+            ref = np.round(rolling_reference(profile, n_idm, window), 4)
+            return ref[:, None], np.zeros(len(followers), dtype=int)
+
+        ref_speeds = ReferenceSpeeds(self.freq, self.ref_estimators)
+        estimators = [ref_speeds.estimator(vid) for vid in followers]
+        unique = list({id(est): est for est in estimators}.values())
+        ref = np.empty((len(profile), len(unique)))
+        for step, speed in enumerate(profile.tolist()):
+            ref_speeds.update(speed)
+            ref[step] = [round(est.value, 4) for est in unique]
+        cols = {id(est): col for col, est in enumerate(unique)}
+        return ref, np.array([cols[id(est)] for est in estimators], dtype=int)
+
+    def run(self, leader_profile, interrupt_time, idm_duration, window=200):
+        """simulate() converted to the outputs returned by run_simulation."""
+        return self.simulate(leader_profile, interrupt_time, idm_duration, window).legacy_outputs()
+
+
+def compare_with_recording(csv_path, recorder, columns=("speed_mps", "space_headway")):
+    """
+    RMSE and max absolute error per vehicle between a recorded SUMO CSV
+    (save_simulation_to_csv layout) and the TrajectoryRecorder returned by
+    NumpyPlatoonEngine.simulate().
+    """
+    import pandas as pd
+
+    key_for = {"speed_mps": "speed", "acceleration": "acceleration", "x": "x", "y": "y", "space_headway": "headway"}
+    df = pd.read_csv(csv_path)
+    n_steps = min(df["time_step"].max() + 1, recorder.n_steps)
+
+    rows = []
+    for col in columns:
+        recorded = df.pivot(index="time_step", columns="vehicle_id", values=col).iloc[:n_steps]
+        simulated = getattr(recorder, key_for[col])
+        for i, vid in enumerate(recorder.ids):
+            if vid not in recorded.columns:
+                continue
+            error = simulated[:n_steps, i] - recorded[vid].to_numpy()
+            error = error[~np.isnan(error)]
+            if not len(error):
+                continue
+            rows.append({"variable": col, "vehicle_id": vid,
+                         "rmse": float(np.sqrt(np.mean(error ** 2))),
+                         "max_abs_error": float(np.max(np.abs(error)))})
+    return pd.DataFrame(rows)
@@ -0,0 +1,152 @@
+# controller/platoon.py
+import math
+import numpy as np
+
+VEHICLE_LENGTH = 5.0  # SUMO default passenger length
+MIN_GAP = 2.5  # SUMO default minGap
+
+
+def route_offsets(conn, edges):
+    """
+    Distance from the start of the route to every edge of `edges` (internal
+    junction edges included), from the lane lengths reported by TraCI.
+
+    Returns (offsets, loop_length); loop_length is the length of one lap if
+    the route comes back to its first edge (ring) and None otherwise.
+    """
+    offsets = {}
+    pos = 0.0
+    for i, edge in enumerate(edges):
+        if edge in offsets:
+            return offsets, (pos if edge == edges[0] else None)
+        offsets[edge] = pos
+        lane = f"{edge}_0"
+        pos += conn.lane.getLength(lane)
+        if i + 1 < len(edges):
+            # Junction lane leading to the next edge, if any
+            for link in conn.lane.getLinks(lane):
+                if link[0].rsplit("_", 1)[0] == edges[i + 1] and link[4]:
+                    internal = link[4]
+                    offsets[internal.rsplit("_", 1)[0]] = pos
+                    pos += conn.lane.getLength(internal)
+                    break
+    return offsets, None
+
+
+class PlatoonIndex:
+    """
+    Front-to-back order of the platoon and the gap of every vehicle to the one
+    ahead, derived from road/lane positions instead of getLeader.
+
+    Positions along the route come from per-edge offsets; on a ring they are
+    taken modulo the lap length, relative to the platoon head. The order is
+    kept from the previous step and repaired with an insertion sort, which is
+    O(n) when nobody overtook. Gaps follow getLeader: bumper to bumper minus
+    the follower's minGap, NaN beyond leader_dist or when nobody is ahead.
+    """
+
+    def __init__(self, offsets, loop_length=None, leader_dist=2000.0):
+        self.offsets = offsets
+        self.loop_length = loop_length
+        self.leader_dist = leader_dist
+        self.order = []
+        self.head = None
+        self.length = {}
+        self.min_gap = {}
+        self.gaps = np.empty(0)
+        self.reorders = 0
+        self.check_stats = {"checked": 0, "mismatches": 0, "max_gap_error": 0.0}
+
+    @classmethod
+    def from_route(cls, conn, veh_id, leader_dist=2000.0):
+        offsets, loop_length = route_offsets(conn, conn.vehicle.getRoute(veh_id))
+        return cls(offsets, loop_length, leader_dist)
+
+    @property
+    def ring(self):
+        return self.loop_length is not None
+
+    def route_position(self, road, lane_pos):
+        return self.offsets.get(road, 0.0) + lane_pos
+
+    def _keys(self, pos, ids):
+        # Distance behind the head: 0 for the head, increasing towards the tail
+        if self.head is None or self.head not in pos:
+            return [-pos[vid] for vid in ids]
+        head_pos = pos[self.head]
+        if self.ring:
+            return [(head_pos - pos[vid]) % self.loop_length for vid in ids]
+        return [head_pos - pos[vid] for vid in ids]
+
+    def update(self, snapshot, conn=None):
+        """Refresh order and gaps from a SubscriptionStateReader snapshot; returns (order, gaps)."""
+        pos = {vid: self.route_position(state["road"], state["lane_pos"]) for vid, state in snapshot.items()}
+
+        order = [vid for vid in self.order if vid in pos]
+        new_ids = [vid for vid in pos if vid not in self.length]
+        for vid in new_ids:
+            # Vehicle dimensions are read once, when a vehicle is first seen
+            self.length[vid] = conn.vehicle.getLength(vid) if conn is not None else VEHICLE_LENGTH
+            self.min_gap[vid] = conn.vehicle.getMinGap(vid) if conn is not None else MIN_GAP
+        known = set(order)
+        order += [vid for vid in pos if vid not in known]
+        if self.head is None and order:
+            self.head = max(order, key=lambda vid: pos[vid])
+
+        keys = self._keys(pos, order)
+        if any(keys[i] > keys[i + 1] for i in range(len(keys) - 1)):
+            self.reorders += 1
+            for i in range(1, len(order)):
+                vid, key = order[i], keys[i]
+                j = i - 1
+                while j >= 0 and keys[j] > key:
+                    order[j + 1], keys[j + 1] = order[j], keys[j]
+                    j -= 1
+                order[j + 1], keys[j + 1] = vid, key
+        self.order = order
+
+        p = np.array([pos[vid] for vid in order])
+        length = np.array([self.length[vid] for vid in order])
+        min_gap = np.array([self.min_gap[vid] for vid in order])
+        gaps = np.full(len(order), np.nan)
+        if len(order) > 1:
+            dist = p[:-1] - p[1:]
+            if self.ring:
+                dist = dist % self.loop_length
+            gaps[1:] = dist - length[:-1] - min_gap[1:]
+            if self.ring:
+                gaps[0] = (p[-1] - p[0]) % self.loop_length - length[-1] - min_gap[0]
+        gaps[gaps > self.leader_dist] = np.nan
+        self.gaps = gaps
+        return self.order, self.gaps
+
+    def leader_of(self, veh_id):
+        """(leader_id, gap) like getLeader, or None."""
+        i = self.order.index(veh_id)
+        if math.isnan(self.gaps[i]):
+            return None
+        return self.order[i - 1], float(self.gaps[i])
+
+    def leaders(self):
+        """{veh_id: (leader_id, gap) or None} for the current order."""
+        result = {}
+        for i, vid in enumerate(self.order):
+            gap = self.gaps[i]
+            result[vid] = None if math.isnan(gap) else (self.order[i - 1], float(gap))
+        return result
+
+    def cross_check(self, snapshot, tol=1e-6):
+        """Compare with the getLeader values in the snapshot (reader created with leader=True)."""
+        for vid, derived in self.leaders().items():
+            reported = snapshot[vid]["leader"]
+            self.check_stats["checked"] += 1
+            if (derived is None) != (reported is None):
+                self.check_stats["mismatches"] += 1
+                continue
+            if derived is None:
+                continue
+            error = abs(derived[1] - reported[1])
+            self.check_stats["max_gap_error"] = max(self.check_stats["max_gap_error"], error)
+            if derived[0] != reported[0] or error > tol:
+                self.check_stats["mismatches"] += 1
+        return self.check_stats
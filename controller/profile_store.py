@@ -0,0 +1,186 @@
+# controller/profile_store.py
+"""
+Leader speed profiles of many recorded drives in one memory-mapped store.
+
+    python -m controller.profile_store ingest data/can_drives --out output/profiles
+    python -m controller.profile_store info output/profiles
+
+ingest parses every decoded CAN CSV of a directory once, with the cleaning
+of leader_speed_profile.read_can_speeds (missing speeds -> 0, leading stop
+dropped, km/h -> m/s, time relative to the first moving sample). The
+(time, speed) samples of all drives go to samples.f32, one float32 (n, 2)
+array; index.json holds the offset and length of every drive in it and its
+metadata (duration, mean/max speed, stop count).
+
+ProfileStore memory-maps the samples read-only, so opening a store costs
+nothing and only the pages of the drives in use are read. profile() cuts a
+drive or a segment of it and interpolates it to any freq on the fly. A store
+has no per-run state, so concurrent runs can each follow their own drive:
+
+    store = ProfileStore("output/profiles")
+    run_simulation(20, 500, 50, 120, leader_profile=store.profile("2021-07-26-21-10-20", 50, start=60))
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+
+from controller.leader_speed_profile import read_can_speeds
+
+STORE_FORMAT = 1
+SAMPLES_FILE = "samples.f32"
+INDEX_FILE = "index.json"
+CAN_SUFFIX = "_CAN_Messages_decoded_speed"  # dropped from the file name to get the drive name
+STOP_SPEED = 0.5  # m/s; a drive slower than this is stopped
+
+
+def drive_name(csv_path):
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return name[:-len(CAN_SUFFIX)] if name.endswith(CAN_SUFFIX) else name
+
+
+def drive_metadata(timestamps, speeds):
+    """Duration (s), mean/max speed (m/s) and number of stops of one drive."""
+    stopped = speeds < STOP_SPEED
+    # A stop is a stopped sample after a moving one (the leading stop is already cut off)
+    stops = int(np.count_nonzero(stopped[1:] & ~stopped[:-1]))
+    duration = float(timestamps[-1] - timestamps[0])
+    # Time-weighted mean, so irregular CAN sampling does not bias it
+    mean_speed = float(np.trapezoid(speeds, timestamps) / duration) if duration > 0 else float(speeds.mean())
+    return {"duration_s": round(duration, 3), "mean_speed": round(mean_speed, 4),
+            "max_speed": round(float(speeds.max()), 4), "stop_count": stops}
+
+
+def ingest(csv_dir, out_dir, pattern="*.csv"):
+    """
+    Build a store in out_dir from the CAN CSVs matching pattern in csv_dir
+    (replacing an existing store). Samples are appended drive by drive, so
+    memory use is bounded by the largest CSV. Returns the index.
+    """
+    paths = sorted(glob.glob(os.path.join(csv_dir, pattern)))
+    if not paths:
+        raise FileNotFoundError(f"No CSV files matching {pattern} in {csv_dir}")
+    os.makedirs(out_dir, exist_ok=True)
+    samples_path = os.path.join(out_dir, SAMPLES_FILE)
+    tmp = f".{os.getpid()}.tmp"
+
+    drives = []
+    offset = 0
+    start = time.perf_counter()
+    with open(samples_path + tmp, "wb") as f:
+        for path in paths:
+            name = drive_name(path)
+            try:
+                timestamps, speeds = read_can_speeds(path)
+            except (ValueError, KeyError, IndexError) as exc:
+                print(f"Skipping {path}: {exc!r}")
+                continue
+            if len(timestamps) < 2:
+                print(f"Skipping {path}: no moving samples")
+                continue
+            if any(drive["name"] == name for drive in drives):
+                raise ValueError(f"Two CSV files give the drive name {name}")
+            np.column_stack((timestamps, speeds)).astype(np.float32).tofile(f)
+            drives.append({"name": name, "source": os.path.abspath(path), "offset": offset,
+                           "length": len(timestamps), **drive_metadata(timestamps, speeds)})
+            offset += len(timestamps)
+
+    index = {"format": STORE_FORMAT, "n_samples": offset, "drives": drives}
+    # Samples first, index last: a store with an index is always complete
+    os.replace(samples_path + tmp, samples_path)
+    with open(os.path.join(out_dir, INDEX_FILE) + tmp, "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(os.path.join(out_dir, INDEX_FILE) + tmp, os.path.join(out_dir, INDEX_FILE))
+    hours = sum(drive["duration_s"] for drive in drives) / 3600
+    print(f"Ingested {len(drives)} drives ({hours:.1f} h, {offset} samples) into {out_dir} "
+          f"in {time.perf_counter() - start:.1f} s")
+    return index
+
+
+class ProfileStore:
+    """Read-only view of a store written by ingest()."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+        if index.get("format") != STORE_FORMAT:
+            raise ValueError(f"Unsupported profile store format: {index.get('format')}")
+        self.drives = index["drives"]
+        self._by_name = {drive["name"]: drive for drive in self.drives}
+        self._samples = np.memmap(os.path.join(path, SAMPLES_FILE), dtype=np.float32, mode="r",
+                                  shape=(index["n_samples"], 2))
+
+    def __len__(self):
+        return len(self.drives)
+
+    @property
+    def names(self):
+        return [drive["name"] for drive in self.drives]
+
+    def meta(self, drive):
+        """Index entry of a drive, by name or position."""
+        if isinstance(drive, (int, np.integer)):
+            return self.drives[drive]
+        try:
+            return self._by_name[drive]
+        except KeyError:
+            raise KeyError(f"No drive {drive!r} in {self.path}") from None
+
+    def samples(self, drive):
+        """(time, speed) float32 views of the recorded samples of a drive (no copy)."""
+        meta = self.meta(drive)
+        block = self._samples[meta["offset"]:meta["offset"] + meta["length"]]
+        return block[:, 0], block[:, 1]
+
+    def profile(self, drive, freq, start=0.0, end=None):
+        """
+        Leader speed (m/s) every 1/freq s from start to end (s from the
+        start of the drive, end defaults to its end), linearly interpolated
+        like resample_profile. Only the samples of the segment are read.
+        """
+        timestamps, speeds = self.samples(drive)
+        end = float(timestamps[-1]) if end is None else min(end, float(timestamps[-1]))
+        ts_uniform = np.arange(start, end, 1 / freq)
+        # Samples bracketing the segment, so interpolation at its edges is unchanged
+        lo = max(int(np.searchsorted(timestamps, start, side="right")) - 1, 0)
+        hi = int(np.searchsorted(timestamps, end, side="left")) + 1
+        return np.interp(ts_uniform, timestamps[lo:hi], speeds[lo:hi])
+
+    def select(self, min_duration=0.0, max_stops=None, min_mean_speed=0.0):
+        """Names of the drives at least min_duration s long, with at most max_stops stops and a mean speed above min_mean_speed."""
+        return [drive["name"] for drive in self.drives
+                if drive["duration_s"] >= min_duration and drive["mean_speed"] >= min_mean_speed
+                and (max_stops is None or drive["stop_count"] <= max_stops)]
+
+
+def print_info(store):
+    print(f"{len(store)} drives in {store.path}")
+    print(f"{'drive':<40}{'duration (s)':>14}{'mean (m/s)':>12}{'max (m/s)':>11}{'stops':>7}")
+    for drive in store.drives:
+        print(f"{drive['name']:<40}{drive['duration_s']:>14.1f}{drive['mean_speed']:>12.2f}"
+              f"{drive['max_speed']:>11.2f}{drive['stop_count']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or inspect a store of recorded leader drives.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = commands.add_parser("ingest", help="convert a directory of decoded CAN CSVs into a store")
+    ingest_parser.add_argument("csv_dir")
+    ingest_parser.add_argument("--out", default="output/profiles", help="store directory")
+    ingest_parser.add_argument("--pattern", default="*.csv", help="file name pattern of the CSVs")
+    info_parser = commands.add_parser("info", help="list the drives of a store")
+    info_parser.add_argument("store")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        ingest(args.csv_dir, args.out, args.pattern)
+    else:
+        print_info(ProfileStore(args.store))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# controller/profiler.py
+"""
+Opt-in timing of the run_simulation step loop.
+
+Every step is split into phases: the SUMO step, the state fetch (subscription
+results, platoon order and headways), the controllers (reference speeds and
+commands), the actuation (TraCI setters) and the recording (recorder and
+online metrics). mark() charges the time since the previous mark to a phase,
+so a step costs a handful of perf_counter() calls and list appends; the
+per-step table is only built by report(). Without a profiler the loop only
+checks `profiler is not None`.
+
+    profiler = StepProfiler(freq, cprofile_window=(6000, 6500))
+    run_simulation(ref_speed, interrupt_time, freq, idm_duration, profiler=profiler)
+    profiler.write("output/straight/run.profile.json")
+
+cprofile_window=(start_step, end_step) runs cProfile over those steps only;
+the hottest functions end up in the report (and in a .prof file with
+cprofile_path, for snakeviz or pstats).
+"""
+import cProfile
+import json
+import os
+import pstats
+import time
+
+import numpy as np
+
+PHASES = ("sumo_step", "state_fetch", "controller", "actuation", "recording")
+SUMO_STEP, STATE_FETCH, CONTROLLER, ACTUATION, RECORDING = range(len(PHASES))
+BEGIN, END = -1, -2  # markers around the phases of one step
+HISTOGRAM_EDGES_US = np.logspace(0, 6, 61)  # 1 us .. 1 s, 10 bins per decade
+
+
+class StepProfiler:
+    def __init__(self, freq, cprofile_window=None, cprofile_path=None, cprofile_top=20):
+        self.freq = freq
+        self.cprofile_window = cprofile_window
+        self.cprofile_path = cprofile_path
+        self.cprofile_top = cprofile_top
+        # One (phase, perf_counter) entry per mark; the per-step table is built in report()
+        self._phases = []
+        self._stamps = []
+        self.first_step = None
+        self._profile = None
+        self._cprofile_stats = None
+
+    def begin_step(self, step):
+        if self.first_step is None:
+            self.first_step = step
+        if self.cprofile_window is not None:
+            if step == self.cprofile_window[0]:
+                self._profile = cProfile.Profile()
+                self._profile.enable()
+            elif step == self.cprofile_window[1]:
+                self._stop_cprofile()
+        self._phases.append(BEGIN)
+        self._stamps.append(time.perf_counter())
+
+    def mark(self, phase):
+        """Charge the time since the previous mark (or begin_step) to `phase`."""
+        self._phases.append(phase)
+        self._stamps.append(time.perf_counter())
+
+    def end_step(self):
+        self._phases.append(END)
+        self._stamps.append(self._stamps[-1])
+
+    def _tables(self):
+        """(steps x phases) seconds per phase, per-step latency and mark counts of the completed steps."""
+        phases = np.array(self._phases, dtype=np.int64)
+        stamps = np.array(self._stamps)
+        begins = np.flatnonzero(phases == BEGIN)
+        ends = np.flatnonzero(phases == END)
+        step_of = np.cumsum(phases == BEGIN) - 1
+        # A step without end_step (the loop broke out) is dropped
+        complete = np.zeros(len(begins), dtype=bool)
+        complete[step_of[ends]] = True
+        rows = np.cumsum(complete) - 1
+        is_mark = (phases >= 0) & complete[np.maximum(step_of, 0)]
+        idx = np.flatnonzero(is_mark)
+        times = np.zeros((int(complete.sum()), len(PHASES)))
+        np.add.at(times, (rows[step_of[idx]], phases[idx]), stamps[idx] - stamps[idx - 1])
+        latency = stamps[ends] - stamps[begins[step_of[ends]]]
+        calls = np.bincount(phases[idx], minlength=len(PHASES))
+        return times, latency, calls
+
+    def _stop_cprofile(self):
+        if self._profile is None:
+            return
+        self._profile.disable()
+        if self.cprofile_path:
+            os.makedirs(os.path.dirname(self.cprofile_path) or ".", exist_ok=True)
+            self._profile.dump_stats(self.cprofile_path)
+        stats = pstats.Stats(self._profile)
+        rows = []
+        for (filename, line, func), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({"function": f"{os.path.basename(filename)}:{line}({func})", "calls": ncalls,
+                         "tottime_s": tottime, "cumtime_s": cumtime})
+        rows.sort(key=lambda row: row["tottime_s"], reverse=True)
+        self._cprofile_stats = rows[:self.cprofile_top]
+        self._profile = None
+
+    @property
+    def n_steps(self):
+        return self._phases.count(END)
+
+    def report(self):
+        self._stop_cprofile()  # window still open at the end of the run
+        times, total, calls = self._tables()
+        us = 1e6
+        run_time = float(total.sum())
+
+        def percentiles(values):
+            if not len(values):
+                return {"mean_us": None, "p50_us": None, "p90_us": None, "p99_us": None, "max_us": None}
+            p50, p90, p99 = np.percentile(values, [50, 90, 99]) * us
+            return {"mean_us": float(values.mean() * us), "p50_us": float(p50), "p90_us": float(p90),
+                    "p99_us": float(p99), "max_us": float(values.max() * us)}
+
+        phases = {}
+        for i, name in enumerate(PHASES):
+            spent = float(times[:, i].sum())
+            phases[name] = {"total_s": spent, "share": spent / run_time if run_time else 0.0,
+                            "calls": int(calls[i]), **percentiles(times[:, i])}
+        counts, _ = np.histogram(total * us, bins=HISTOGRAM_EDGES_US)
+        return {
+            "freq": self.freq,
+            "first_step": self.first_step,
+            "n_steps": len(total),
+            "total_s": run_time,
+            "real_time_factor": len(total) / self.freq / run_time if run_time else None,
+            "step_latency": percentiles(total),
+            "phases": phases,
+            "histogram": {"edges_us": HISTOGRAM_EDGES_US.tolist(), "counts": counts.tolist()},
+            "cprofile": None if self.cprofile_window is None else {
+                "window": list(self.cprofile_window), "path": self.cprofile_path, "top": self._cprofile_stats},
+        }
+
+    def summary(self):
+        report = self.report()
+        latency = report["step_latency"]
+        if not report["n_steps"]:
+            print("Step profile: no steps")
+            return report
+        print(f"Step profile: {report['n_steps']} steps, {report['total_s']:.2f} s, "
+              f"p50 {latency['p50_us']:.0f} us, p99 {latency['p99_us']:.0f} us")
+        for name, phase in report["phases"].items():
+            print(f"  {name:<12} {phase['total_s']:8.3f} s  {phase['share'] * 100:5.1f} %  "
+                  f"p50 {phase['p50_us']:8.1f} us  p99 {phase['p99_us']:8.1f} us")
+        return report
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"Step profile saved to: {path}")
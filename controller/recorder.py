@@ -0,0 +1,412 @@
+# controller/recorder.py
+import glob
+import json
+import os
+from collections import defaultdict
+import numpy as np
+
+# Recorded variables, each stored as a (steps x vehicles) array
+FIELDS = ("speed", "acceleration", "x", "y", "headway", "ref_vel")
+
+# CSV column names used by save_simulation_to_csv
+CSV_COLUMNS = {
+    "speed": "speed_mps",
+    "acceleration": "acceleration",
+    "x": "x",
+    "y": "y",
+    "headway": "space_headway",
+    "ref_vel": "ref_vels",
+}
+
+
+def vehicle_sort_key(vid):
+    """Numeric order for vehN IDs (veh2 before veh10), lexical for anything else."""
+    vid = str(vid)
+    if vid.startswith("veh") and vid[3:].isdigit():
+        return (0, int(vid[3:]), vid)
+    return (1, 0, vid)
+
+
+class TrajectoryRecorder:
+    """
+    Columnar trajectory store backed by preallocated (steps x vehicles) arrays.
+
+    Rows are simulation steps and columns are vehicles in order of first
+    appearance. `present` marks the cells a vehicle was actually recorded in;
+    everything else stays NaN. Both dimensions grow by doubling if the
+    initial sizes turn out too small.
+    """
+
+    def __init__(self, n_steps, vehicle_ids=(), dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.ids = []
+        self.index = {}
+        self.cf_models = {}
+        self.first_step = 0  # step stored in row 0 (non-zero once a StreamingRecorder has flushed)
+        self.order = []  # platoon order (front to back) used for roles; numeric ID order if empty
+        self.n_steps = 0
+        capacity = max(len(vehicle_ids), 1)
+        self._alloc(max(int(n_steps), 1), capacity)
+        for vid in vehicle_ids:
+            self.add_vehicle(vid)
+
+    def _alloc(self, rows, cols):
+        for field in FIELDS:
+            setattr(self, "_" + field, np.full((rows, cols), np.nan, dtype=self.dtype))
+        self._present = np.zeros((rows, cols), dtype=bool)
+
+    def _grow(self, rows, cols):
+        old = {field: getattr(self, "_" + field) for field in FIELDS}
+        old_present = self._present
+        r, c = old_present.shape
+        self._alloc(rows, cols)
+        for field in FIELDS:
+            getattr(self, "_" + field)[:r, :c] = old[field]
+        self._present[:r, :c] = old_present
+
+    @property
+    def capacity(self):
+        return self._present.shape
+
+    def add_vehicle(self, vid, cf_model=None):
+        col = self.index.get(vid)
+        if col is None:
+            col = len(self.ids)
+            rows, cols = self.capacity
+            if col >= cols:
+                self._grow(rows, cols * 2)
+            self.ids.append(vid)
+            self.index[vid] = col
+        if cf_model is not None:
+            self.cf_models[vid] = cf_model
+        return col
+
+    def _row(self, step):
+        row = step - self.first_step
+        rows, cols = self.capacity
+        if row >= rows:
+            self._grow(max(rows * 2, row + 1), cols)
+        if row >= self.n_steps:
+            self.n_steps = row + 1
+        return row
+
+    def record(self, step, vid, speed, acceleration, x, y, headway):
+        """Record one vehicle at one step (per-vehicle TraCI loop)."""
+        row = self._row(step)
+        col = self.add_vehicle(vid)
+        self._speed[row, col] = speed
+        self._acceleration[row, col] = acceleration
+        self._x[row, col] = x
+        self._y[row, col] = y
+        self._headway[row, col] = headway
+        self._present[row, col] = True
+
+    def record_ref(self, step, vid, ref_vel):
+        row = self._row(step)
+        self._ref_vel[row, self.add_vehicle(vid)] = ref_vel
+
+    def record_step(self, step, speed, acceleration, x, y, headway, ref_vel=None, cols=None):
+        """Record a whole step at once from arrays ordered like `cols` (default: all vehicles)."""
+        row = self._row(step)
+        cols = slice(0, len(self.ids)) if cols is None else cols
+        self._speed[row, cols] = speed
+        self._acceleration[row, cols] = acceleration
+        self._x[row, cols] = x
+        self._y[row, cols] = y
+        self._headway[row, cols] = headway
+        if ref_vel is not None:
+            self._ref_vel[row, cols] = ref_vel
+        self._present[row, cols] = True
+
+    # Trimmed (recorded steps x known vehicles) views
+    def __getattr__(self, name):
+        data = self.__dict__.get("_" + name) if name in FIELDS or name == "present" else None
+        if data is None:
+            raise AttributeError(name)
+        return data[:self.n_steps, :len(self.ids)]
+
+    @property
+    def time_log(self):
+        return self.first_step + np.arange(self.n_steps)
+
+    def sorted_columns(self):
+        """Column order used for roles in the CSV: platoon order (first one is the leader), then the rest by ID."""
+        ordered = [vid for vid in self.order if vid in self.index]
+        known = set(ordered)
+        ordered += sorted((vid for vid in self.ids if vid not in known), key=vehicle_sort_key)
+        return [self.index[vid] for vid in ordered]
+
+    def legacy_outputs(self):
+        """
+        The eight outputs run_simulation used to return:
+        time_log, speeds, accelerations, x_positions, y_positions, headways, cf_models, ref_vels
+        """
+        dicts = {field: defaultdict(list) for field in FIELDS}
+        present = self.present
+        for col, vid in enumerate(self.ids):
+            rows = present[:, col]
+            for field in FIELDS:
+                dicts[field][vid] = np.round(getattr(self, field)[rows, col].astype(float), 4).tolist()
+        return (self.time_log.tolist(), dicts["speed"], dicts["acceleration"], dicts["x"], dicts["y"],
+                dicts["headway"], dict(self.cf_models), dicts["ref_vel"])
+
+    def to_dataframe(self, decimals=4):
+        """Long (time_step, vehicle) table in the save_simulation_to_csv layout, built without Python loops."""
+        import pandas as pd
+
+        cols = np.array(self.sorted_columns(), dtype=int)
+        ids = np.array(self.ids, dtype=object)[cols]
+        roles = np.array(["Leader"] + [f"Follower{i}" for i in range(1, len(cols))], dtype=object)
+        present = self.present[:, cols]
+        t_idx, v_idx = np.nonzero(present)
+
+        data = {
+            "time_step": self.time_log[t_idx],
+            "vehicle_id": ids[v_idx],
+            "role": roles[v_idx],
+        }
+        for field in FIELDS:
+            values = getattr(self, field)[:, cols][t_idx, v_idx].astype(float)
+            data[CSV_COLUMNS[field]] = np.round(values, decimals) if decimals is not None else values
+        return pd.DataFrame(data)
+
+    def to_arrays(self):
+        arrays = {field: getattr(self, field) for field in FIELDS}
+        arrays["present"] = self.present
+        arrays["time_log"] = self.time_log
+        arrays["ids"] = np.array(self.ids)
+        arrays["order"] = np.array([self.ids[col] for col in self.sorted_columns()])
+        arrays["cf_models"] = np.array([self.cf_models.get(vid, "unknown") for vid in self.ids])
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        ids = [str(vid) for vid in arrays["ids"]]
+        present = np.asarray(arrays["present"], dtype=bool)
+        rec = cls(present.shape[0], ids, dtype=np.asarray(arrays["speed"]).dtype)
+        rec.n_steps = present.shape[0]
+        for field in FIELDS:
+            getattr(rec, "_" + field)[:] = arrays[field]
+        rec._present[:] = present
+        if "cf_models" in arrays:
+            rec.cf_models = dict(zip(ids, (str(m) for m in arrays["cf_models"])))
+        if "order" in arrays:
+            rec.order = [str(vid) for vid in arrays["order"]]
+        return rec
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """Rebuild a recorder from the long CSV/Parquet layout."""
+        ids = sorted(df["vehicle_id"].unique(), key=vehicle_sort_key)
+        steps = df["time_step"].to_numpy()
+        n_steps = int(steps.max()) + 1 if len(steps) else 0
+        rec = cls(n_steps, ids)
+        rec.n_steps = n_steps
+        rows = steps
+        cols = df["vehicle_id"].map(rec.index).to_numpy()
+        for field in FIELDS:
+            getattr(rec, "_" + field)[rows, cols] = df[CSV_COLUMNS[field]].to_numpy(dtype=float)
+        rec._present[rows, cols] = True
+        if "role" in df:
+            # Roles give the platoon order: Leader, Follower1, Follower2, ...
+            roles = df.drop_duplicates("vehicle_id").set_index("vehicle_id")["role"]
+            rank = roles.map(lambda role: 0 if role == "Leader" else int(role.replace("Follower", "")))
+            rec.order = rank.sort_values(kind="stable").index.tolist()
+        return rec
+
+
+class DecimatingRecorder:
+    """
+    Passes every `every`-th step to `recorder` as row step // every, so the
+    rows of the recorder count record_dt ticks. With average=True each
+    recorded value is the mean over the `every` steps up to and including
+    the recorded one (boxcar anti-aliasing) instead of the sample at that step;
+    ref_vel is always sampled.
+    """
+
+    def __init__(self, recorder, every, average=False):
+        self.recorder = recorder
+        self.every = int(every)
+        self.average = average
+        self.sums = {}  # vid -> [n, speed, acceleration, x, y, headway] since the last recorded step
+
+    def add_vehicle(self, vid, cf_model=None):
+        return self.recorder.add_vehicle(vid, cf_model)
+
+    @property
+    def cf_models(self):
+        return self.recorder.cf_models
+
+    def record(self, step, vid, speed, acceleration, x, y, headway):
+        values = (speed, acceleration, x, y, headway)
+        if self.average:
+            acc = self.sums.get(vid)
+            if acc is None:
+                self.sums[vid] = [1, *values]
+            else:
+                acc[0] += 1
+                for i, value in enumerate(values, 1):
+                    acc[i] += value
+        if step % self.every:
+            return
+        if self.average:
+            n, *total = self.sums.pop(vid)
+            values = [value / n for value in total]
+        self.recorder.record(step // self.every, vid, *values)
+
+    def record_ref(self, step, vid, ref_vel):
+        if step % self.every == 0:
+            self.recorder.record_ref(step // self.every, vid, ref_vel)
+
+
+class StreamingRecorder(TrajectoryRecorder):
+    """
+    TrajectoryRecorder that keeps only `chunk_steps` rows in memory and
+    flushes every full chunk to `directory` as one NPZ shard or one Parquet
+    file (a single row group), so memory stays bounded and a crash only loses
+    the chunk in progress.
+
+    Shards are written under a temporary name and renamed when complete, so
+    load_chunks() can read the directory while the run is still going. Call
+    close() at the end to flush the last partial chunk.
+    """
+
+    def __init__(self, directory, chunk_steps=5000, fmt="npz", vehicle_ids=(), dtype=np.float64):
+        if fmt not in ("npz", "parquet"):
+            raise ValueError(f"Unsupported chunk format: {fmt}")
+        self.directory = directory
+        self.chunk_steps = int(chunk_steps)
+        self.fmt = fmt
+        self.n_chunks = 0
+        os.makedirs(directory, exist_ok=True)
+        for old in glob.glob(os.path.join(directory, "chunk_*")):
+            os.remove(old)
+        super().__init__(self.chunk_steps, vehicle_ids, dtype)
+
+    def _row(self, step):
+        if step < self.first_step:
+            raise ValueError(f"Step {step} belongs to a chunk that was already flushed")
+        if step - self.first_step >= self.chunk_steps:
+            self.flush()
+            # Skip whole chunks if steps jumped ahead
+            self.first_step = step - (step - self.first_step) % self.chunk_steps
+        return super()._row(step)
+
+    def flush(self):
+        """Write the buffered rows as the next shard and start an empty chunk after them."""
+        if self.n_steps:
+            path = os.path.join(self.directory, f"chunk_{self.n_chunks:05d}.{self.fmt}")
+            if self.fmt == "npz":
+                _write_npz_chunk(self, path)
+            else:
+                _write_parquet_chunk(self, path)
+            self.n_chunks += 1
+
+        self.first_step += self.chunk_steps
+        self.n_steps = 0
+        for field in FIELDS:
+            getattr(self, "_" + field).fill(np.nan)
+        self._present.fill(False)
+
+    def close(self):
+        if self.n_steps:
+            self.flush()
+
+    def legacy_outputs(self):
+        # The buffer only holds the current chunk
+        return load_chunks(self.directory).legacy_outputs()
+
+
+def _chunk_meta(rec):
+    return {
+        "first_step": int(rec.first_step),
+        "n_steps": int(rec.n_steps),
+        "ids": [str(vid) for vid in rec.ids],
+        "cf_models": {str(vid): model for vid, model in rec.cf_models.items()},
+        "order": [str(vid) for vid in rec.order],
+        "dtype": rec.dtype.str,
+    }
+
+
+def _write_npz_chunk(rec, path):
+    arrays = {field: getattr(rec, field) for field in FIELDS}
+    arrays["present"] = rec.present
+    arrays["meta"] = np.array(json.dumps(_chunk_meta(rec)))
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+
+def _write_parquet_chunk(rec, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(rec.to_dataframe(decimals=None), preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"trajectory"] = json.dumps(_chunk_meta(rec)).encode()
+    tmp = path + ".tmp"
+    pq.write_table(table.replace_schema_metadata(metadata), tmp)
+    os.replace(tmp, path)
+
+
+def _read_chunk(path):
+    """Return (meta, {field: rows x vehicles array}, present) for one shard."""
+    if path.endswith(".npz"):
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            arrays = {field: data[field] for field in FIELDS}
+            present = data["present"]
+        return meta, arrays, present
+
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(path)
+    meta = json.loads(table.schema.metadata[b"trajectory"])
+    df = table.to_pandas()
+    index = {vid: col for col, vid in enumerate(meta["ids"])}
+    shape = (meta["n_steps"], len(meta["ids"]))
+    rows = df["time_step"].to_numpy() - meta["first_step"]
+    cols = df["vehicle_id"].map(index).to_numpy()
+    arrays = {}
+    for field in FIELDS:
+        arrays[field] = np.full(shape, np.nan, dtype=meta["dtype"])
+        arrays[field][rows, cols] = df[CSV_COLUMNS[field]].to_numpy()
+    present = np.zeros(shape, dtype=bool)
+    present[rows, cols] = True
+    return meta, arrays, present
+
+
+def chunk_paths(directory):
+    return sorted(glob.glob(os.path.join(directory, "chunk_*.npz")) +
+                  glob.glob(os.path.join(directory, "chunk_*.parquet")))
+
+
+def iter_chunks(directory):
+    """Yield (meta, arrays, present) shard by shard, so only one chunk is in memory."""
+    for path in chunk_paths(directory):
+        yield _read_chunk(path)
+
+
+def load_chunks(directory):
+    """
+    Reassemble the shards written by a StreamingRecorder into one
+    TrajectoryRecorder, identical to what an in-memory run would hold.
+    Works on a run in progress (only completed shards are read).
+    """
+    chunks = list(iter_chunks(directory))
+    if not chunks:
+        return TrajectoryRecorder(0)
+
+    last = chunks[-1][0]
+    rec = TrajectoryRecorder(last["first_step"] + last["n_steps"], last["ids"], dtype=last["dtype"])
+    rec.n_steps = last["first_step"] + last["n_steps"]
+    for meta, arrays, present in chunks:
+        rows = slice(meta["first_step"], meta["first_step"] + meta["n_steps"])
+        cols = slice(0, len(meta["ids"]))
+        for field in FIELDS:
+            getattr(rec, "_" + field)[rows, cols] = arrays[field]
+        rec._present[rows, cols] = present
+        rec.cf_models.update(meta["cf_models"])
+        rec.order = meta.get("order", rec.order)
+    return rec
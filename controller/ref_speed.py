@@ -0,0 +1,241 @@
+# controller/ref_speed.py
+"""
+Reference-speed estimators for the FollowerStopper phase.
+
+Each estimator is fed the leader speed once per step (update) and exposes its
+current estimate as `value`:
+- WindowedMean: mean of the last `window` speeds, ring buffer + running sum, O(1)
+- EMA: exponential moving average, O(1)
+- WindowedQuantile: q-quantile (median for q=0.5) of the last `window` speeds,
+  two heaps with lazy deletion, O(log window) time and O(window) memory
+
+Estimators are described by specs so they can be assigned per AV like
+controllers in controller_manager:
+    "mean" | "ema" | "median" | {"kind": "quantile", "window_s": 30, "q": 0.25}
+Windows are given in steps ("window") or seconds ("window_s", scaled by freq).
+"""
+import heapq
+import json
+import math
+
+
+class WindowedMean:
+    def __init__(self, window=200):
+        self.window = int(window)
+        self._buf = [0.0] * self.window
+        self._head = 0
+        self._count = 0
+        self._sum = 0.0
+        self._comp = 0.0  # Neumaier compensation so the running sum does not drift over long runs
+        self.value = math.nan
+
+    def _add(self, x):
+        total = self._sum + x
+        if abs(self._sum) >= abs(x):
+            self._comp += (self._sum - total) + x
+        else:
+            self._comp += (x - total) + self._sum
+        self._sum = total
+
+    def update(self, speed):
+        speed = float(speed)
+        if self._count == self.window:
+            self._add(-self._buf[self._head])
+        else:
+            self._count += 1
+        self._buf[self._head] = speed
+        self._head = (self._head + 1) % self.window
+        self._add(speed)
+        self.value = (self._sum + self._comp) / self._count
+        return self.value
+
+
+class EMA:
+    def __init__(self, alpha=None, time_constant=None, freq=None):
+        # alpha directly, or from a time constant in seconds: alpha = dt / (tau + dt)
+        if alpha is None:
+            dt = 1 / freq
+            alpha = dt / (time_constant + dt)
+        self.alpha = float(alpha)
+        self.value = math.nan
+
+    def update(self, speed):
+        speed = float(speed)
+        if math.isnan(self.value):
+            self.value = speed
+        else:
+            self.value += self.alpha * (speed - self.value)
+        return self.value
+
+
+class WindowedQuantile:
+    """
+    Sliding-window q-quantile with linear interpolation (numpy.quantile's
+    default method). `_lo` is a max-heap (stored negated) holding the lowest
+    k + 1 values, `_hi` a min-heap with the rest; values leaving the window are
+    only marked in `_delayed` and dropped once they reach the top of a heap.
+    Values that never reach the top (e.g. on a monotonic input) are cleared
+    by rebuilding both heaps from the window once they hold 2 x window
+    entries, so memory stays O(window).
+    """
+
+    def __init__(self, window=200, q=0.5):
+        self.window = int(window)
+        self.q = float(q)
+        self._buf = [0.0] * self.window
+        self._head = 0
+        self._count = 0
+        self._lo = []
+        self._hi = []
+        self._lo_n = 0
+        self._hi_n = 0
+        self._delayed = {}
+        self.value = math.nan
+
+    def _prune(self, heap, sign):
+        while heap:
+            top = sign * heap[0]
+            pending = self._delayed.get(top)
+            if not pending:
+                break
+            if pending == 1:
+                del self._delayed[top]
+            else:
+                self._delayed[top] = pending - 1
+            heapq.heappop(heap)
+
+    def _rebuild(self, n_lo):
+        # Both heaps from the live values only, the lowest n_lo in _lo
+        live = sorted(self._buf if self._count == self.window else self._buf[:self._count])
+        self._lo = [-x for x in reversed(live[:n_lo])]  # descending, so already a valid max-heap
+        self._hi = live[n_lo:]  # ascending, a valid min-heap
+        self._lo_n = len(self._lo)
+        self._hi_n = len(self._hi)
+        self._delayed.clear()
+
+    def update(self, speed):
+        speed = float(speed)
+        if not self._lo or speed <= -self._lo[0]:
+            heapq.heappush(self._lo, -speed)
+            self._lo_n += 1
+        else:
+            heapq.heappush(self._hi, speed)
+            self._hi_n += 1
+
+        if self._count == self.window:
+            old = self._buf[self._head]
+            self._delayed[old] = self._delayed.get(old, 0) + 1
+            if old <= -self._lo[0]:
+                self._lo_n -= 1
+                self._prune(self._lo, -1)
+            else:
+                self._hi_n -= 1
+                self._prune(self._hi, 1)
+        else:
+            self._count += 1
+        self._buf[self._head] = speed
+        self._head = (self._head + 1) % self.window
+
+        # Rebalance so _lo holds exactly k + 1 live values
+        rank = self.q * (self._count - 1)
+        k = int(rank)
+        while self._lo_n > k + 1:
+            heapq.heappush(self._hi, -heapq.heappop(self._lo))
+            self._lo_n -= 1
+            self._hi_n += 1
+            self._prune(self._lo, -1)
+        while self._lo_n < k + 1:
+            heapq.heappush(self._lo, -heapq.heappop(self._hi))
+            self._hi_n -= 1
+            self._lo_n += 1
+            self._prune(self._hi, 1)
+        if len(self._lo) + len(self._hi) > 2 * self.window:
+            self._rebuild(k + 1)
+
+        low = -self._lo[0]
+        frac = rank - k
+        self.value = low + frac * (self._hi[0] - low) if frac and self._hi_n else low
+        return self.value
+
+
+# Default reference speed: mean of the last 200 leader speeds (4 s at 50 Hz)
+default_estimator = {"kind": "mean", "window": 200}
+
+# Per-vehicle estimator assignment, e.g. {"veh3": {"kind": "median", "window_s": 30}}
+estimator_assignment = {}
+
+
+def make_estimator(spec, freq):
+    spec = normalize_spec(spec)
+    kind = spec["kind"]
+    window = spec.get("window")
+    if window is None and "window_s" in spec:
+        window = int(round(spec["window_s"] * freq))
+
+    if kind == "mean":
+        return WindowedMean(window or 200)
+    if kind == "ema":
+        return EMA(spec.get("alpha"), spec.get("time_constant", 4.0), freq)
+    if kind in ("median", "quantile"):
+        return WindowedQuantile(window or 200, 0.5 if kind == "median" else spec.get("q", 0.5))
+    raise ValueError(f"Unknown reference speed estimator: {kind}")
+
+
+def normalize_spec(spec):
+    return {"kind": spec} if isinstance(spec, str) else dict(spec)
+
+
+class ReferenceSpeeds:
+    """
+    Estimators for all AVs, fed with the leader speed once per step.
+    Vehicles with the same spec share one estimator instance.
+
+    specs: a single spec for every vehicle, or {veh_id: spec} (missing
+    vehicles use default_estimator). None uses estimator_assignment.
+    """
+
+    def __init__(self, freq, specs=None):
+        self.freq = freq
+        if specs is None:
+            specs = estimator_assignment
+        if isinstance(specs, str) or "kind" in specs:
+            self.default, self.assignment = normalize_spec(specs), {}
+        else:
+            self.default, self.assignment = normalize_spec(default_estimator), dict(specs)
+        self._estimators = {}
+        self._by_vehicle = {}
+        self._estimator_for(self.default)
+
+    def _estimator_for(self, spec):
+        key = json.dumps(normalize_spec(spec), sort_keys=True)
+        if key not in self._estimators:
+            self._estimators[key] = make_estimator(spec, self.freq)
+        return self._estimators[key]
+
+    def estimator(self, veh_id):
+        if veh_id not in self._by_vehicle:
+            self._by_vehicle[veh_id] = self._estimator_for(self.assignment.get(veh_id, self.default))
+        return self._by_vehicle[veh_id]
+
+    def prepare(self, vehicle_ids):
+        """Create the estimators of all vehicles up front so they see every leader sample."""
+        for vid in vehicle_ids:
+            self.estimator(vid)
+
+    def update(self, leader_speed):
+        for est in self._estimators.values():
+            est.update(leader_speed)
+
+    @property
+    def value(self):
+        """Estimate of the default estimator."""
+        return self._estimator_for(self.default).value
+
+    def values(self, vehicle_ids):
+        return [self.estimator(vid).value for vid in vehicle_ids]
+
+
+def reference_series(profile, freq, spec):
+    """Estimate after each sample of a whole leader profile (used by the NumPy engine)."""
+    est = make_estimator(spec, freq)
+    return [est.update(speed) for speed in profile]
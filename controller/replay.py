@@ -0,0 +1,400 @@
+# controller/replay.py
+"""
+Record a TraCI session once, then replay it without SUMO.
+
+RecordingConnection wraps a traci connection (or the traci module, or a
+FakeConnection) and logs every call made through it: getters with their
+results, commands (setSpeed, setSpeedMode, subscribe, ...) with their
+arguments. The log is a gzip stream of one pickled frame per simulation step,
+so it is written as the run goes and read back one step at a time.
+
+ReplayConnection serves the same vehicle/simulation/lane surface from the
+log. Getters return the recorded results; commands are compared with the
+recorded ones, and every difference (other speed, missing or unexpected
+command) ends up in the divergence report. The recorded states are replayed
+as they were, so a changed controller shows up as diverging commands rather
+than as a different trajectory.
+
+The leader profile of meta["run_simulation"] is stored in the log (the default
+CAN profile when it has none), so the replay drives the leader with the
+recorded speeds instead of whatever DEFAULT_PROFILE_CSV holds on replay. Pass
+the same leader_profile to run_simulation and to meta.
+
+    conn = RecordingConnection(traci, "output/logs/straight.traci.gz",
+                               meta={"run_simulation": {"ref_speed": 20, "interrupt_time": 500, "freq": 50, "idm_duration": 120}})
+    run_simulation(20, 500, 50, 120, conn=conn)
+    conn.close()  # run_simulation does not close the connection; this flushes and ends the log
+
+    python -m controller.replay output/logs/straight.traci.gz --report output/logs/replay.json
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import math
+import os
+import pickle
+import time
+from collections import defaultdict
+import numpy as np
+
+LOG_FORMAT = 1
+DOMAINS = ("vehicle", "simulation", "lane", "edge", "route", "vehicletype")
+
+
+class ReplayMismatch(RuntimeError):
+    """The replayed code asked for something the log cannot answer."""
+
+
+def profile_digest(profile):
+    return hashlib.sha1(np.ascontiguousarray(profile, dtype=float).tobytes()).hexdigest()
+
+
+def _store_profile(meta):
+    # Copy the leader profile run_simulation will follow into the log header
+    meta = dict(meta or {})
+    params = meta.get("run_simulation")
+    if params is None:
+        return meta
+    meta["run_simulation"] = params = dict(params)
+    if params.get("leader_profile") is None:
+        if "freq" not in params:
+            return meta
+        from controller.leader_speed_profile import DEFAULT_PROFILE_CSV, cached_profile
+        params["leader_profile"] = cached_profile(DEFAULT_PROFILE_CSV, params["freq"])
+    # A real copy: cached profiles are memory-mapped and may be evicted
+    params["leader_profile"] = np.array(params["leader_profile"], dtype=float)
+    meta["leader_profile_sha1"] = profile_digest(params["leader_profile"])
+    return meta
+
+
+def is_getter(name):
+    return name.rsplit(".", 1)[-1].startswith("get")
+
+
+def _command_key(name, args):
+    # Commands on a vehicle are matched by vehicle ID, others by name only
+    return (name, args[0]) if args and isinstance(args[0], str) else (name,)
+
+
+class _RecordingDomain:
+    def __init__(self, domain, prefix, log):
+        self._domain = domain
+        self._prefix = prefix
+        self._log = log
+
+    def __getattr__(self, name):
+        func = getattr(self._domain, name)
+        if not callable(func):
+            return func
+        qualname = f"{self._prefix}.{name}"
+        getter = is_getter(qualname)
+
+        def call(*args, **kwargs):
+            return self._log.call(qualname, func, args, kwargs, getter)
+        setattr(self, name, call)  # later lookups skip __getattr__
+        return call
+
+
+class RecordingConnection:
+    """Proxy that logs every call to `conn` into `path` (gzip of pickled per-step frames)."""
+
+    def __init__(self, conn, path, meta=None, compresslevel=6):
+        self._conn = conn
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = gzip.open(path, "wb", compresslevel=compresslevel)
+        self._names = {}
+        self._new_names = []
+        self._frame = []
+        self.n_frames = 0
+        self.n_calls = 0
+        self.meta = _store_profile(meta)
+        pickle.dump({"format": LOG_FORMAT, "meta": self.meta}, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        for domain in DOMAINS:
+            if hasattr(conn, domain):
+                setattr(self, domain, _RecordingDomain(getattr(conn, domain), domain, self))
+
+    def _name_id(self, name):
+        name_id = self._names.get(name)
+        if name_id is None:
+            name_id = self._names[name] = len(self._names)
+            self._new_names.append(name)
+        return name_id
+
+    def call(self, name, func, args, kwargs, getter=False):
+        name_id = self._name_id(name)
+        self.n_calls += 1
+        try:
+            result = func(*args, **(kwargs or {}))
+        except Exception as exc:
+            self._frame.append((name_id, args, kwargs or None, None, exc))
+            raise
+        # Results are serialized right away: traci reuses its subscription result dicts
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL) if getter else None
+        self._frame.append((name_id, args, kwargs or None, data, None))
+        return result
+
+    def _flush(self):
+        pickle.dump((self._new_names, self._frame), self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._new_names, self._frame = [], []
+        self.n_frames += 1
+
+    def simulationStep(self, *args):
+        self.call("simulationStep", self._conn.simulationStep, args, None)
+        self._flush()
+
+    def getVersion(self):
+        return self.call("getVersion", self._conn.getVersion, (), None, True)
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self.call("close", self._conn.close, (), None)
+        finally:
+            self._flush()
+            self._file.close()
+            size = os.path.getsize(self.path)
+            print(f"TraCI log saved to: {self.path} ({self.n_calls} calls in {self.n_frames} steps, "
+                  f"{size / 1e6:.1f} MB)")
+
+
+class _ReplayDomain:
+    def __init__(self, prefix, replay):
+        self._prefix = prefix
+        self._replay = replay
+
+    def __getattr__(self, name):
+        qualname = f"{self._prefix}.{name}"
+        handler = self._replay.get if is_getter(qualname) else self._replay.command
+
+        def call(*args, **kwargs):
+            return handler(qualname, args, kwargs or None)
+        setattr(self, name, call)  # later lookups skip __getattr__
+        return call
+
+
+class ReplayConnection:
+    """
+    The traci surface answered from a RecordingConnection log. Commands are
+    compared with the recorded ones within atol; differences are collected
+    in `divergences` (see report()).
+
+    Calls are matched in recorded order; a call that is out of order is
+    looked up among the unused calls of the same step (getters by name and
+    arguments, commands by name and vehicle).
+    """
+
+    def __init__(self, path, atol=1e-9, max_divergences=1000):
+        self.path = path
+        self.atol = atol
+        self.max_divergences = max_divergences
+        self._file = gzip.open(path, "rb")
+        header = pickle.load(self._file)
+        if header.get("format") != LOG_FORMAT:
+            raise ValueError(f"Unsupported TraCI log format: {header.get('format')}")
+        self.meta = header["meta"]
+        self._names = []
+        self._ids = {}
+        self.step = 0
+        self.n_commands = 0
+        self.n_diverged = 0
+        self.by_kind = defaultdict(int)
+        self.max_abs_diff = 0.0
+        self.divergences = []
+        self._closed = False
+        for domain in DOMAINS:
+            setattr(self, domain, _ReplayDomain(domain, self))
+        self._load_frame()
+
+    def _load_frame(self):
+        try:
+            new_names, self._frame = pickle.load(self._file)
+        except EOFError:
+            self._frame = None
+            return
+        for name in new_names:
+            self._ids[name] = len(self._names)
+            self._names.append(name)
+        self._pos = 0
+        self._used = set()
+
+    def _take(self, name, args, kwargs, getter):
+        """Index of the recorded call answering this one, or None."""
+        if self._frame is None:
+            raise ReplayMismatch(f"{name} called after the end of the log (step {self.step})")
+        name_id = self._ids.get(name)
+        frame, used = self._frame, self._used
+        pos = self._pos
+        while pos in used:
+            pos += 1
+        if pos < len(frame):
+            entry = frame[pos]
+            if entry[0] == name_id and (not getter or (entry[1] == args and entry[2] == kwargs)):
+                self._pos = pos + 1
+                return pos
+        # Out of order: first unused match in the rest of the step
+        self._pos = pos
+        key = _command_key(name, args)
+        for i in range(pos, len(frame)):
+            entry = frame[i]
+            if i in used or entry[0] != name_id:
+                continue
+            if (getter and entry[1] == args and entry[2] == kwargs) or \
+                    (not getter and _command_key(name, entry[1]) == key):
+                used.add(i)
+                return i
+        return None
+
+    def _diverged(self, kind, name, recorded, replayed, diff=None):
+        self.n_diverged += 1
+        self.by_kind[kind] += 1
+        if diff is not None:
+            self.max_abs_diff = max(self.max_abs_diff, diff)
+        if len(self.divergences) < self.max_divergences:
+            self.divergences.append({"step": self.step, "kind": kind, "call": name,
+                                     "recorded": recorded, "replayed": replayed, "abs_diff": diff})
+
+    def _compare(self, recorded, replayed):
+        """None if equal, else the largest numeric difference (inf for non-numeric ones)."""
+        if recorded == replayed:
+            return None
+        if len(recorded) != len(replayed):
+            return math.inf
+        worst = 0.0
+        for a, b in zip(recorded, replayed):
+            if isinstance(a, (int, float)) and isinstance(b, (int, float)) and not isinstance(a, bool):
+                diff = abs(a - b)
+                if not diff <= self.atol:  # NaN counts as a difference
+                    worst = max(worst, diff if diff == diff else math.inf)
+            elif a != b:
+                worst = math.inf
+        return worst or None
+
+    def get(self, name, args, kwargs=None):
+        i = self._take(name, args, kwargs, True)
+        if i is None:
+            raise ReplayMismatch(f"{name}{args} was not recorded at step {self.step}")
+        _, _, _, data, exc = self._frame[i]
+        if exc is not None:
+            raise exc
+        return pickle.loads(data)
+
+    def command(self, name, args, kwargs=None):
+        self.n_commands += 1
+        i = self._take(name, args, kwargs, False)
+        if i is None:
+            self._diverged("unexpected", name, None, list(args))
+            return None
+        _, rec_args, rec_kwargs, _, exc = self._frame[i]
+        diff = self._compare(rec_args, args)
+        if diff is not None or rec_kwargs != kwargs:
+            self._diverged("changed", name, list(rec_args), list(args), diff)
+        if exc is not None:
+            raise exc
+        return None
+
+    def _end_frame(self):
+        names = self._names
+        for i in range(self._pos, len(self._frame)):
+            name = names[self._frame[i][0]]
+            if i not in self._used and not is_getter(name) and name not in ("simulationStep", "close"):
+                self._diverged("missing", name, list(self._frame[i][1]), None)
+
+    def simulationStep(self, *args):
+        self.command("simulationStep", args)
+        self._end_frame()
+        self.step += 1
+        self._load_frame()
+
+    def getVersion(self):
+        return self.get("getVersion", ())
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._frame is not None:
+            self._end_frame()
+        self._file.close()
+
+    def report(self):
+        return {
+            "log": self.path,
+            "steps": self.step,
+            "commands": self.n_commands,
+            "diverged": self.n_diverged,
+            "by_kind": dict(self.by_kind),
+            "max_abs_diff": self.max_abs_diff,
+            "first_step": self.divergences[0]["step"] if self.divergences else None,
+            "divergences": self.divergences,
+        }
+
+    def summary(self):
+        report = self.report()
+        if not report["diverged"]:
+            print(f"Replay matches the log: {report['commands']} commands over {report['steps']} steps")
+        else:
+            print(f"Replay diverged: {report['diverged']} of {report['commands']} commands differ "
+                  f"{report['by_kind']}, first at step {report['first_step']}, "
+                  f"max |diff| {report['max_abs_diff']:.3g}")
+        return report
+
+
+def replay_run(path, report_path=None, atol=1e-9, **overrides):
+    """
+    Run run_simulation against a log made with meta={"run_simulation": {...}};
+    returns the divergence report. A leader_profile override must match the
+    recorded one; logs without a stored profile need it.
+    """
+    from controller.simulation import run_simulation
+
+    conn = ReplayConnection(path, atol=atol)
+    params = dict(conn.meta.get("run_simulation", {}))
+    recorded = conn.meta.get("leader_profile_sha1")
+    if overrides.get("leader_profile") is not None and recorded is not None \
+            and profile_digest(overrides["leader_profile"]) != recorded:
+        conn.close()
+        raise ValueError(f"leader_profile does not match the one recorded in {path}")
+    params.update(overrides)
+    missing = {"ref_speed", "interrupt_time", "freq", "idm_duration"} - set(params)
+    if params.get("leader_profile") is None:
+        missing.add("leader_profile")
+    if missing:
+        conn.close()
+        raise ValueError(f"Log has no run_simulation parameters for {sorted(missing)}; pass them as overrides")
+    start = time.perf_counter()
+    run_simulation(conn=conn, recorder=False, **params)
+    conn.close()
+    print(f"Replayed {conn.step} steps in {time.perf_counter() - start:.2f} s")
+    report = conn.summary()
+    if report_path:
+        os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2, default=repr)
+        print(f"Divergence report saved to: {report_path}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded TraCI log through run_simulation.")
+    parser.add_argument("log", help="log written by RecordingConnection")
+    parser.add_argument("--report", help="divergence report (JSON)")
+    parser.add_argument("--atol", type=float, default=1e-9, help="tolerance for numeric command arguments")
+    parser.add_argument("--leader-csv", help="CAN CSV of the leader, for logs that do not store the profile")
+    args = parser.parse_args()
+    overrides = {}
+    if args.leader_csv:
+        from controller.leader_speed_profile import resample_profile
+        with gzip.open(args.log, "rb") as f:
+            params = pickle.load(f)["meta"].get("run_simulation", {})
+        if "freq" not in params:
+            parser.error("--leader-csv needs a log that records run_simulation's freq")
+        overrides["leader_profile"] = resample_profile(args.leader_csv, params["freq"])
+    report = replay_run(args.log, args.report, args.atol, **overrides)
+    raise SystemExit(1 if report["diverged"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,143 +1,267 @@
 # controller/route_generator.py
+"""
+Route files for the platoon scenarios.
+
+generate_route() lays the leader and its followers out on the network's
+route and streams the .rou.xml line by line (10k+ vehicles are fine). The
+file carries a hash of its inputs on the first line. When the hash matches,
+the file is left untouched, so main() and sweep workers only write when
+something changed.
+
+Plans:
+- [("idm_follower", 3), ("krauss_follower", 4)]: contiguous blocks, as before
+- ["idm_follower", "krauss_follower", ...]: an explicit follower sequence,
+  e.g. from interleave_plan({"krauss_follower": 0.8, "idm_follower": 0.2}, 100)
+  or pattern_plan(["krauss_follower"] * 4 + ["idm_follower"], 100)
+
+Spacing is the requested gap (12 m) as long as the platoon fits; otherwise it
+shrinks to what the network length allows. On the ring, vehicles past the
+first edge get a departEdge.
+"""
+import hashlib
+import json
 import os
-
-def generate_ring_route(vehicle_types, vehicle_plan, filename="route/ring.rou.xml"):
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, "w") as f:
-        f.write("<routes>\n")
-
-        # Write vehicle types
-        for vtype, attrs in vehicle_types.items():
-            f.write(f'  <vType id="{vtype}" carFollowModel="{attrs["carFollowModel"]}" '
-                    f'accel="{attrs["accel"]}" decel="{attrs["decel"]}" '
-                    f'tau="{attrs["tau"]}" minGap="{attrs["minGap"]}" '
-                    f'maxSpeed="{attrs["maxSpeed"]}" guiShape="passenger"/>\n')
-
-        # Use circular edge IDs
-        # loop_count = int(2200 / 40) + 2
-        # edges = ' '.join(['e0 e1 e2 e3'] * loop_count)
-        loop_count =  2  # min. number of loops needed
-        single_loop_edges = ' '.join([f"e{i}" for i in range(40)])
-        edges = ' '.join([single_loop_edges] * loop_count)
-
-        f.write(f'  <route id="loop" edges="{edges}"/>\n')
-
-        # Compute total number of followers
-        num_followers = sum(count for _, count in vehicle_plan)
-        num_vehicles = 1 + num_followers  # +1 for leader
-
-        gap = 12  # meters between vehicles
-
-        # Starting position (leader at front)
-        start_pos = gap * (num_vehicles - 1)
-
-        # Leader vehicle (veh0)
-        f.write(f'  <vehicle id="veh0" type="idm_follower" route="loop" depart="0" departPos="{start_pos}" color="255,0,0"/>\n')
-
-        # Write followers
-        # Followers
-        veh_id = 1
-        for vtype, count in vehicle_plan:
-            for i in range(count):
-                depart_pos = start_pos - (veh_id * gap)
-                r = (0 + 90 * i) % 256
-                g = (50 + 60 * i) % 256
-                b = (150 + 10 * i) % 256
-
-                f.write(f'  <vehicle id="veh{veh_id}" type="{vtype}" route="loop" '
-                        f'depart="0" departPos="{depart_pos}" color="{r},{g},{b}"/>\n')
-                veh_id += 1
-
-        f.write("</routes>\n")
-
+import xml.etree.ElementTree as ET
+
+# SUMO network used by each network type
+network_files = {
+    "ring": "sumo_config/network/ring_network/ring.net.xml",
+    "straight": "sumo_config/network/straight_line_network/road.net.xml",
+    "circular": "sumo_config/network/circular_network/road.net.xml",
+}
+
+# Edges of one lap / of the road, and how many laps the route repeats
+network_routes = {
+    "ring": {"route_id": "loop", "edges": [f"e{i}" for i in range(40)], "laps": 2, "ring": True},
+    "straight": {"route_id": "straight", "edges": ["e0"], "laps": 1, "ring": False},
+    "circular": {"route_id": "loop", "edges": ["e0", "e1", "e2", "e3"], "laps": int(2200 / 40) + 2, "ring": True},
+}
+
+ROUTE_FORMAT = 1  # bump when the generated XML changes, so cached files are rewritten
+VEHICLE_LENGTH = 5.0  # SUMO default passenger length
+DEFAULT_GAP = 12  # meters between vehicle fronts
+
+
+def write_sumo_config(cfg_file, net_file, route_file, step_length=0.1):
+    """Write a .sumocfg for net_file/route_file; paths are stored absolute so the config can live anywhere."""
+    os.makedirs(os.path.dirname(cfg_file), exist_ok=True)
+    with open(cfg_file, "w") as f:
+        f.write("<configuration>\n")
+        f.write("    <input>\n")
+        f.write(f'        <net-file value="{os.path.abspath(net_file)}"/>\n')
+        f.write(f'        <route-files value="{os.path.abspath(route_file)}"/>\n')
+        f.write("    </input>\n")
+        f.write("    <time>\n")
+        f.write(f'        <step-length value="{step_length}"/>\n')
+        f.write('        <begin value="0"/>\n')
+        f.write("    </time>\n")
+        f.write("    <processing>\n")
+        f.write('        <time-to-teleport value="-1"/> <!-- disables auto-teleport -->\n')
+        f.write("    </processing>\n")
+        f.write("</configuration>\n")
+
+
+def plan_sequence(vehicle_plan):
+    """Follower types in platoon order from [(vtype, count), ...] blocks or an explicit [vtype, ...] list."""
+    sequence = []
+    for entry in vehicle_plan:
+        if isinstance(entry, str):
+            sequence.append(entry)
+        else:
+            vtype, count = entry
+            sequence += [vtype] * count
+    return sequence
+
+
+def interleave_plan(shares, n_followers):
+    """
+    Spread types evenly along the platoon by their share (penetration rate),
+    e.g. {"krauss_follower": 0.8, "idm_follower": 0.2} puts every fifth
+    follower on IDM instead of one block of IDM at the back.
+    """
+    total = sum(shares.values())
+    counts = {vtype: 0 for vtype in shares}
+    sequence = []
+    for i in range(n_followers):
+        # The type that is furthest behind its target count goes next
+        vtype = max(shares, key=lambda t: (i + 1) * shares[t] / total - counts[t])
+        counts[vtype] += 1
+        sequence.append(vtype)
+    return sequence
+
+
+def pattern_plan(pattern, n_followers):
+    """Repeat a follower pattern until n_followers are placed."""
+    return [pattern[i % len(pattern)] for i in range(n_followers)]
+
+
+def route_geometry(net_file, edges):
+    """
+    Start position of every edge of `edges` along the route and its length,
+    counting the junction lanes between consecutive edges like
+    platoon.route_offsets does with TraCI.
+    """
+    root = ET.parse(net_file).getroot()
+    lane_length = {lane.get("id"): float(lane.get("length")) for lane in root.iter("lane")}
+    via = {}
+    for conn in root.iter("connection"):
+        if conn.get("via") and conn.get("fromLane") == "0":
+            via[(conn.get("from"), conn.get("to"))] = lane_length.get(conn.get("via"), 0.0)
+
+    starts, lengths = [], []
+    pos = 0.0
+    for i, edge in enumerate(edges):
+        starts.append(pos)
+        lengths.append(lane_length[f"{edge}_0"])
+        pos += lengths[-1]
+        nxt = edges[(i + 1) % len(edges)]
+        pos += via.get((edge, nxt), 0.0)
+    return starts, lengths, pos
+
+
+def platoon_spacing(n_vehicles, available, gap=DEFAULT_GAP):
+    """Front-to-front spacing: `gap`, or less if n_vehicles would not fit into `available` meters."""
+    if n_vehicles <= 1:
+        return float(gap)
+    spacing = min(float(gap), available / n_vehicles)
+    if spacing <= VEHICLE_LENGTH:
+        raise ValueError(f"{n_vehicles} vehicles do not fit on {available:.0f} m "
+                         f"(spacing {spacing:.2f} m <= vehicle length {VEHICLE_LENGTH} m)")
+    return spacing
+
+
+def platoon_layout(n_vehicles, network_type="straight", gap=DEFAULT_GAP, net_file=None):
+    """
+    Route position of every vehicle (leader first) and where it departs:
+    returns (positions, [(edge index in the route, departPos), ...], spacing).
+    """
+    route = network_routes[network_type]
+    starts, lengths, lap = route_geometry(net_file or network_files[network_type], route["edges"])
+    # Ring: the whole lap; straight: the road, leaving the leader one gap of room
+    available = lap if route["ring"] else lap - gap
+    spacing = platoon_spacing(n_vehicles, available, gap)
+
+    positions = [spacing * (n_vehicles - 1 - i) for i in range(n_vehicles)]
+    departs = []
+    for p in positions:
+        k = max(i for i, start in enumerate(starts) if start <= p)
+        lane_pos = p - starts[k]
+        if lane_pos > lengths[k]:
+            # On the junction lane after edge k: depart at the start of the next edge
+            k, lane_pos = k + 1, 0.0
+        departs.append((k, lane_pos))
+    return positions, departs, spacing
+
+
+def _fmt(value):
+    # 12 -> "12", 12.5 -> "12.5" (integer spacings keep the original file contents)
+    return str(int(value)) if float(value).is_integer() else repr(round(float(value), 6))
+
+
+def _vtype_lines(vehicle_types):
+    for vtype, attrs in vehicle_types.items():
+        yield (f'  <vType id="{vtype}" carFollowModel="{attrs["carFollowModel"]}" '
+               f'accel="{attrs["accel"]}" decel="{attrs["decel"]}" '
+               f'tau="{attrs["tau"]}" minGap="{attrs["minGap"]}" '
+               f'maxSpeed="{attrs["maxSpeed"]}" guiShape="passenger"/>\n')
+
+
+def _route_lines(vehicle_types, sequence, network_type, departs, leader_type="idm_follower", staggered=False):
+    route = network_routes[network_type]
+    route_id = route["route_id"]
+    yield "<routes>\n"
+    yield from _vtype_lines(vehicle_types)
+    edges = " ".join([" ".join(route["edges"])] * route["laps"])
+    yield f'  <route id="{route_id}" edges="{edges}"/>\n'
+
+    if staggered:
+        # One vehicle per second from the start of the route
+        yield f'  <vehicle id="veh0" type="{leader_type}" route="{route_id}" depart="0" color="255,0,0"/>\n'
+    else:
+        yield (f'  <vehicle id="veh0" type="{leader_type}" route="{route_id}" depart="0"'
+               f'{_depart_attrs(departs[0])} color="255,0,0"/>\n')
+
+    # Colors follow the position within each type, so contiguous blocks keep their old colors
+    seen = {}
+    for veh_id, vtype in enumerate(sequence, start=1):
+        i = seen.get(vtype, 0)
+        seen[vtype] = i + 1
+        if staggered:
+            color = f"{(10 * i) % 256},{(50 + 60 * i) % 256},{(100 + 110 * i) % 256}"
+            yield f'  <vehicle id="veh{veh_id}" type="{vtype}" route="{route_id}" depart="{veh_id}" color="{color}"/>\n'
+        else:
+            color = f"{(0 + 90 * i) % 256},{(50 + 60 * i) % 256},{(150 + 10 * i) % 256}"
+            yield (f'  <vehicle id="veh{veh_id}" type="{vtype}" route="{route_id}" '
+                   f'depart="0"{_depart_attrs(departs[veh_id])} color="{color}"/>\n')
+    yield "</routes>\n"
+
+
+def _depart_attrs(depart):
+    edge_index, lane_pos = depart
+    if edge_index == 0:
+        return f' departPos="{_fmt(lane_pos)}"'
+    return f' departEdge="{edge_index}" departPos="{_fmt(lane_pos)}"'
+
+
+def route_inputs_hash(vehicle_types, sequence, network_type, gap, net_file, leader_type, staggered):
+    net_file = net_file or network_files[network_type]
+    stat = os.stat(net_file)
+    inputs = {
+        "format": ROUTE_FORMAT,
+        "vehicle_types": vehicle_types,
+        "sequence": sequence,
+        "network_type": network_type,
+        "route": network_routes[network_type],
+        "gap": gap,
+        "net_file": [os.path.abspath(net_file), stat.st_size, stat.st_mtime_ns],
+        "leader_type": leader_type,
+        "staggered": staggered,
+    }
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _hash_line(digest):
+    return f"<!-- route inputs sha1={digest} -->\n"
+
+
+def generate_route(vehicle_types, vehicle_plan, network_type="straight", filename=None, gap=DEFAULT_GAP,
+                   net_file=None, leader_type="idm_follower", staggered=False, force=False):
+    """
+    Write the route file for `vehicle_plan` on `network_type` unless the
+    existing file was generated from the same inputs. staggered=True departs
+    one vehicle per second from the start of the route instead of placing
+    the platoon. Returns True if the file was written.
+    """
+    filename = filename or f"route/{network_type}.rou.xml"
+    sequence = plan_sequence(vehicle_plan)
+    digest = route_inputs_hash(vehicle_types, sequence, network_type, gap, net_file, leader_type, staggered)
+    if not force and os.path.exists(filename):
+        with open(filename) as f:
+            if f.readline() == _hash_line(digest):
+                print(f"Route file up to date: {filename}")
+                return False
+
+    departs = None if staggered else platoon_layout(1 + len(sequence), network_type, gap, net_file)[1]
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    # Written next to the target and renamed, so concurrent readers never see half a file
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp, "w", buffering=1 << 20) as f:
+        f.write(_hash_line(digest))
+        f.writelines(_route_lines(vehicle_types, sequence, network_type, departs, leader_type, staggered))
+    os.replace(tmp, filename)
     print(f"Route file generated: {filename}")
+    return True
 
 
+def generate_ring_route(vehicle_types, vehicle_plan, filename="route/ring.rou.xml", gap=DEFAULT_GAP):
+    return generate_route(vehicle_types, vehicle_plan, "ring", filename, gap)
 
-# for straight road
 
-def generate_straight_route(vehicle_types, vehicle_plan, filename="route/straight.rou.xml"):
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, "w") as f:
-        f.write("<routes>\n")
-
-        # Write vehicle types
-        for vtype, attrs in vehicle_types.items():
-            f.write(f'  <vType id="{vtype}" carFollowModel="{attrs["carFollowModel"]}" '
-                    f'accel="{attrs["accel"]}" decel="{attrs["decel"]}" '
-                    f'tau="{attrs["tau"]}" minGap="{attrs["minGap"]}" '
-                    f'maxSpeed="{attrs["maxSpeed"]}" guiShape="passenger"/>\n')
-
-        # Route is the straight edge
-        f.write('  <route id="straight" edges="e0"/>\n')
-
-        # Compute total number of followers
-        num_followers = sum(count for _, count in vehicle_plan)
-        num_vehicles = 1 + num_followers  # +1 for leader
-
-        gap = 12  # meters between vehicles
-
-        # Starting position (leader at front)
-        start_pos = gap * (num_vehicles - 1)
-
-        # Leader vehicle (veh0)
-        f.write(f'  <vehicle id="veh0" type="idm_follower" route="straight" depart="0" departPos="{start_pos}" color="255,0,0"/>\n')
-
-        # Followers
-        veh_id = 1
-        for vtype, count in vehicle_plan:
-            for i in range(count):
-                depart_pos = start_pos - (veh_id * gap)
-                r = (0 + 90 * i) % 256
-                g = (50 + 60 * i) % 256
-                b = (150 + 10 * i) % 256
-
-                f.write(f'  <vehicle id="veh{veh_id}" type="{vtype}" route="straight" '
-                        f'depart="0" departPos="{depart_pos}" color="{r},{g},{b}"/>\n')
-                veh_id += 1
-
-        f.write("</routes>\n")
-
-    print(f"Route file generated: {filename}")
+# for straight road
+def generate_straight_route(vehicle_types, vehicle_plan, filename="route/straight.rou.xml", gap=DEFAULT_GAP):
+    return generate_route(vehicle_types, vehicle_plan, "straight", filename, gap)
 
 
 # for circular road
 def generate_circular_road(vehicle_types, vehicle_plan, filename="route/circular.rou.xml"):
-    with open(filename, "w") as f:
-        f.write("<routes>\n")
-
-        # Write vehicle types
-        for vtype, attrs in vehicle_types.items():
-            f.write(f'  <vType id="{vtype}" carFollowModel="{attrs["carFollowModel"]}" '
-                    f'accel="{attrs["accel"]}" decel="{attrs["decel"]}" '
-                    f'tau="{attrs["tau"]}" minGap="{attrs["minGap"]}" '
-                    f'maxSpeed="{attrs["maxSpeed"]}" guiShape="passenger"/>\n')
-
-        # Use circular edge IDs
-        loop_count = int(2200 / 40) + 2
-        edges = ' '.join(['e0 e1 e2 e3'] * loop_count)
-        f.write(f'  <route id="loop" edges="{edges}"/>\n')
-        # f.write('  <route id="loop" edges="e0 e1 e2 e3 e0"/>\n')
-        f.write('  <vehicle id="veh0" type="leader" route="loop" depart="0" color="255,0,0"/>\n')
-
-        # Write followers
-        depart_time = 1
-        veh_id = 1
-        base_color = (0, 50, 100)  # Starting color for followers
-        for vtype, count in vehicle_plan:
-            for i in range(count):
-                # Change the blue channel gradually
-                r = (base_color[0] + 10 * i) % 256
-                g = (base_color[1] + 60 * i) % 256
-                b = (base_color[2] + 110 * i) % 256
-
-                color_str = f"{r},{g},{b}"
-                print(color_str)
-
-                f.write(f'  <vehicle id="veh{veh_id}" type="{vtype}" route="loop" depart="{depart_time}" color="{r},{g},{b}"/>\n')
-                veh_id += 1
-                depart_time += 1
-
-        f.write("</routes>\n")
-
-    print(f"Route file generated: {filename}")
\ No newline at end of file
+    return generate_route(vehicle_types, vehicle_plan, "circular", filename, leader_type="leader", staggered=True)
@@ -1,49 +1,170 @@
 import traci
-from collections import defaultdict
+import numpy as np
 from controller.controller_manager import *
 from controller.vehicle_config import vehicle_types
 from controller.leader_speed_profile import *
-
-def run_simulation(ref_speed, interrupt_time, freq, idm_duration):
+from controller.state import CountingConnection, SubscriptionStateReader
+from controller.recorder import TrajectoryRecorder, DecimatingRecorder
+from controller.ref_speed import ReferenceSpeeds
+from controller.platoon import PlatoonIndex
+from controller.profiler import SUMO_STEP, STATE_FETCH, CONTROLLER, ACTUATION, RECORDING
+from controller.snapshot import warmup_key, load_snapshot, save_snapshot, recorder_prefix, restore_prefix
+
+def steps_per(dt, freq, name="dt"):
+    """Number of simulation steps (1/freq s each) in dt; dt=None is one step."""
+    if dt is None:
+        return 1
+    steps = round(dt * freq)
+    if steps < 1 or abs(steps - dt * freq) > 1e-6:
+        raise ValueError(f"{name}={dt} is not a multiple of the simulation step 1/freq={1 / freq}")
+    return steps
+
+def run_simulation(ref_speed, interrupt_time, freq, idm_duration, conn=None, engine=None, recorder=None, ref_estimators=None,
+                   leader_check=False, metrics=None, controllers=None, warm_start=False, profiler=None,
+                   leader_profile=None, control_dt=None, record_dt=None, record_average=False,
+                   leader_dist=2000):
+    # conn: traci connection to drive (labelled connection, fake_traci.FakeConnection, ...); defaults to the traci module
+    # engine: numpy_engine.NumpyPlatoonEngine to run without SUMO; conn is ignored then
+    # recorder: TrajectoryRecorder to fill; when given it is returned instead of the eight legacy outputs.
+    #           recorder=False records nothing and returns `metrics` (metrics-only runs)
+    # ref_estimators: reference speed estimator spec, or {veh_id: spec} (see controller/ref_speed.py)
+    # leader_check: also subscribe getLeader and compare it with the position-derived gaps
+    # metrics: analysis.online_metrics.OnlineMetrics updated every step
+    # controllers: controller name for every follower after idm_duration, or {veh_id: name} (others use
+    #              follower_stopper); see controller_manager.controller_registry
+    # warm_start: True (or a cache directory) saves the state at the IDM -> controller switch and restores it in
+    #             later runs with the same warm-up inputs (see controller/snapshot.py; SUMO needs SNAPSHOT_SUMO_ARGS)
+    # profiler: controller.profiler.StepProfiler timing the phases of every step (traci runs only)
+    # leader_profile: leader speed (m/s) per step at freq, e.g. ProfileStore.profile(drive, freq)
+    #                 (controller/profile_store.py); defaults to the drive in DEFAULT_PROFILE_CSV
+    # control_dt: seconds between follower controller updates, a multiple of the simulation step 1/freq;
+    #             commands are held in between (zero-order hold). None: every step
+    # record_dt: seconds between recorded rows (row n is step n * record_dt * freq); record_average=True
+    #            records the mean over each record_dt instead of the sample. None: every step (traci runs only)
+    # leader_dist: gaps beyond this many meters count as no leader (e.g. the lap of a network_builder ring)
+    control_every = steps_per(control_dt, freq, "control_dt")
+    record_every = steps_per(record_dt, freq, "record_dt")
+    return_recorder = recorder is not None
+    if recorder is None:
+        recorder = TrajectoryRecorder(-(-interrupt_time * freq // record_every))
+
+    def result():
+        if recorder is False:
+            return metrics
+        return recorder if return_recorder else recorder.legacy_outputs()
+
+    # Leader speed profile, local to this run
+    if leader_profile is None:
+        leader_profile = cached_profile(DEFAULT_PROFILE_CSV, freq)
+    leader_profile = np.asarray(leader_profile, dtype=float)
+
+    if engine is not None:
+        if control_every != 1 or record_every != 1:
+            raise ValueError("control_dt and record_dt need the traci backend")
+        if controllers is not None:
+            engine.controllers = controllers
+        engine.simulate(leader_profile, interrupt_time, idm_duration, recorder=recorder, metrics=metrics,
+                        target_speed=ref_speed)
+        return result()
+
+    conn = CountingConnection(conn if conn is not None else traci)
     step = 0
-    traci.simulationStep()  # Trigger vehicle spawn
-
-    vehicle_ids = traci.vehicle.getIDList()
-    if not vehicle_ids:
-        raise RuntimeError("No vehicles found in simulation. Check route file.")
-
-    leader_id = sorted(vehicle_ids)[0] #veh0
-    traci.vehicle.setSpeedMode(leader_id, 0) #disable sumo driving model
-    # print("Leader ID: ", leader_id)
-    # reset first follower driving mode
-    # first_follower_id = sorted(vehicle_ids)[1] #veh1
-    # traci.vehicle.setSpeedMode(first_follower_id, 0)
-
-    # for vid in vehicle_ids:
-    #     traci.vehicle.setSpeedMode(vid, 0)
-    #     print(f"vehicle {vid} is disabled for default mode")
-
-    time_log = []
-
-    speeds = defaultdict(list)
-    x_positions = defaultdict(list)
-    y_positions = defaultdict(list)
-    accelerations = defaultdict(list)
-    headways = defaultdict(list)
-    ref_vels = defaultdict(list)  # To store r per follower_id
-    vehicle_cf_model = {}
-
-    leader_speed_list = []
-
-    # Load leader speed profile
-    load_real_profile("controller/2021-07-26-21-10-20_2T3H1RFV8LC057037_CAN_Messages_decoded_speed.csv", freq)
+    # Rows go to the recorder through the decimator (a pass-through at record_every=1)
+    sink = DecimatingRecorder(recorder, record_every, record_average) if recorder is not False else False
+
+    # Reference speed estimators of the FS phase (rolling mean of 200 leader speeds by default)
+    ref_speeds = ReferenceSpeeds(freq, ref_estimators)
+
+    # Warm start: continue from the switch step if the same warm-up was simulated before
+    switch_step = int(idm_duration * freq)
+    snapshot_key = warm = None
+    if warm_start and 0 < switch_step < min(len(leader_profile), interrupt_time * freq):
+        cache_dir = warm_start if isinstance(warm_start, str) else None
+        snapshot_key = warmup_key(conn, freq, idm_duration, leader_profile, ref_speeds,
+                                  recorder is not False and (record_every, record_average), metrics, leader_dist)
+        warm = load_snapshot(snapshot_key, conn, cache_dir)
+
+    if warm is not None:
+        step, vehicle_ids, platoon, ref_speeds = warm["step"], warm["vehicle_ids"], warm["platoon"], warm["ref_speeds"]
+        state_reader = SubscriptionStateReader(conn, leader_dist=leader_dist, leader=leader_check)
+        state_reader.start()
+        leader_id = platoon.order[0]
+        # TraCI overrides are not part of SUMO's state: the leader keeps its last speed command
+        conn.vehicle.setSpeedMode(leader_id, 0)
+        conn.vehicle.setSpeed(leader_id, warm["leader_speed"])
+        if recorder is not False:
+            restore_prefix(recorder, warm["recorder"])
+            sink.sums = warm["record_sums"]
+        if metrics is not None:
+            metrics.__dict__.update(warm["metrics"])
+        setup_round_trips = conn.round_trips
+    else:
+        conn.simulationStep()  # Trigger vehicle spawn
+
+        vehicle_ids = conn.vehicle.getIDList()
+        if not vehicle_ids:
+            raise RuntimeError("No vehicles found in simulation. Check route file.")
+
+        # All vehicle variables arrive with the step response through subscriptions
+        state_reader = SubscriptionStateReader(conn, leader_dist=leader_dist, leader=leader_check)
+        state_reader.start()
+
+        # Platoon order and headways from lane positions (leader within 2 km ahead)
+        platoon = PlatoonIndex.from_route(conn, vehicle_ids[0], leader_dist=leader_dist)
+        platoon.update(state_reader.fetch(), conn)
+        setup_round_trips = conn.round_trips
+
+        leader_id = platoon.order[0] #veh0
+        conn.vehicle.setSpeedMode(leader_id, 0) #disable sumo driving model
+        # print("Leader ID: ", leader_id)
+        # reset first follower driving mode
+        # first_follower_id = sorted(vehicle_ids)[1] #veh1
+        # traci.vehicle.setSpeedMode(first_follower_id, 0)
+
+        # for vid in vehicle_ids:
+        #     traci.vehicle.setSpeedMode(vid, 0)
+        #     print(f"vehicle {vid} is disabled for default mode")
+
+        if recorder is not False:
+            for vid in platoon.order:
+                recorder.add_vehicle(vid)
+            recorder.order = list(platoon.order)
+        if metrics is not None:
+            metrics.start(platoon.order, platoon.min_gap)  # min_gap fills up as SUMO inserts vehicles
+
+        ref_speeds.prepare(vehicle_ids)
+
+    # Controllers of the FS phase, evaluated per controller group every control step
+    if isinstance(controllers, str):
+        dispatcher = ControllerDispatcher(default=controllers, dt=control_every / freq)
+    else:
+        dispatcher = ControllerDispatcher(controllers or {}, default="follower_stopper", dt=control_every / freq)
+    held_refs = {}  # r of the last control step, recorded until the next one
 
     while True:
-        traci.simulationStep()
-        current_ids = traci.vehicle.getIDList()
+        if snapshot_key is not None and warm is None and step == switch_step:
+            save_snapshot(snapshot_key, conn, {
+                "step": step, "vehicle_ids": vehicle_ids, "platoon": platoon, "ref_speeds": ref_speeds,
+                "leader_speed": leader_profile[step - 1],
+                "recorder": recorder_prefix(recorder) if recorder is not False else None,
+                "record_sums": sink.sums if recorder is not False else None,
+                "metrics": dict(metrics.__dict__) if metrics is not None else None,
+            }, cache_dir)
+        if profiler is not None:
+            profiler.begin_step(step)
+        conn.simulationStep()
+        if profiler is not None:
+            profiler.mark(SUMO_STEP)
+        snapshot = state_reader.fetch()
+        current_ids, headways = platoon.update(snapshot, conn)
+        speeds = np.array([snapshot[vid]["speed"] for vid in current_ids])
+        if leader_check:
+            platoon.cross_check(snapshot)
+        if profiler is not None:
+            profiler.mark(STATE_FETCH)
 
         if len(current_ids) > 1:
-            first_follower_id = sorted(current_ids)[1] #veh1
+            first_follower_id = current_ids[1] #veh1
             # print("First Follower ID: ", first_follower_id)
         else:
             first_follower_id = None
@@ -57,70 +178,74 @@ def run_simulation(ref_speed, interrupt_time, freq, idm_duration):
         follower_ids = [vid for vid in current_ids if vid != leader_id]
 
         # Apply leader speed if profile still has data
-        if step < get_profile_length():
+        if step < len(leader_profile):
             if leader_id in current_ids:
-                leader_speed = real_profile(step)
+                leader_speed = leader_profile[step]
                 # print(f"Step {step}, Leader speed = {leader_speed} m/s")
-                traci.vehicle.setSpeed(leader_id, leader_speed)
-                if step < idm_duration*freq:
-                    leader_speed_list.append(leader_speed)
-
-                else:
-                    if step == idm_duration*freq:
-                        # At switch point: calculate average of last 200 from phase 1
-                        last_200 = leader_speed_list[-200:] if len(leader_speed_list) >= 200 else leader_speed_list
-                        ref_speed = sum(last_200) / len(last_200)
-                        print(f"Initial ref_speed from last 200 steps of IDM phase: {ref_speed:.2f} m/s")
-
-                        #reset all other driving mode to run FS controller
-                        for vid in vehicle_ids:
-                            traci.vehicle.setSpeedMode(vid, 0)
-                            print(f"vehicle {vid} is disabled for default mode")
-
-                        # Replace leader_speed_list with only last 200
-                        leader_speed_list = last_200.copy()
-
-                    # add latest leader speed to rolling list
-                    leader_speed_list.append(leader_speed)
-                    if len(leader_speed_list) > 200:
-                        leader_speed_list.pop(0)  # keep only last 200
-
-                    # Compute rolling average
-                    ref_speed = sum(leader_speed_list) / len(leader_speed_list)
-
+                conn.vehicle.setSpeed(leader_id, leader_speed)
+                if step == idm_duration*freq:
+                    # At switch point: the estimators hold the IDM phase samples
+                    print(f"Initial ref_speed from the IDM phase: {ref_speeds.value:.2f} m/s")
+
+                    #reset all other driving mode to run FS controller
+                    for vid in vehicle_ids:
+                        conn.vehicle.setSpeedMode(vid, 0)
+                        print(f"vehicle {vid} is disabled for default mode")
+                if profiler is not None:
+                    profiler.mark(ACTUATION)
+
+                # add latest leader speed to every reference speed estimator
+                ref_speeds.update(leader_speed)
+
+                if step >= idm_duration*freq and (step - switch_step) % control_every == 0:
                     #apply nominal and FS controller to AV which is first follower
-                    for follower_id in follower_ids:
-                        gap_info = traci.vehicle.getLeader(follower_id, 2000) # find leader within 2 km ahead
-                        if gap_info:
-                            dx = gap_info[1]
-                            v_av = traci.vehicle.getSpeed(follower_id)
-                            v_lead = traci.vehicle.getSpeed(gap_info[0])
-                            dv = v_lead - v_av
-                            dx_min = 4.5 # omega_1
-                            dx_activate = 6.0 # omega 3
-                            decel = [1.5, 1.0, 0.5]
-                            h = [0.4, 1.2, 1.8]
-                            
-                            # applying nominal controller
-                            # r = nominal_controller(
-                            #     vel = v_av,
-                            #     max_speed = ref_speed, # desired cruising speed
-                            #     max_accel = 2.0,
-                            #     max_decel = -2.0,
-                            #     freq = freq
-                            # )
-
-                            r = ref_speed
-                            
-                            r = round(r, 4)  # Round to 4 decimal places
-                            # print(f"New r = {r}")
-
-                            ref_vels[follower_id].append(r)
-
-                            u_cmd = follower_stopper(r, dx, dv, v_av, dx_min, dx_activate, decel, h)
-                            traci.vehicle.setSpeed(follower_id, u_cmd)
-                        else:
-                            print(f"At step: {step}, No leader found!!")
+                    has_leader = ~np.isnan(headways)
+                    is_follower = np.array([vid != leader_id for vid in current_ids])
+                    for _ in range(int(np.sum(is_follower & ~has_leader))):
+                        print(f"At step: {step}, No leader found!!")
+
+                    # Gap and speed difference to the vehicle ahead in platoon order
+                    # (index -1 wraps to the last vehicle for the front one on a ring)
+                    fs = np.flatnonzero(is_follower & has_leader)
+                    fs_ids = [current_ids[i] for i in fs]
+                    dxs = headways[fs]
+                    dvs = speeds[fs - 1] - speeds[fs]
+                    v_avs = speeds[fs]
+
+                    # applying nominal controller
+                    # r = nominal_controller(
+                    #     vel = v_av,
+                    #     max_speed = ref_speed, # desired cruising speed
+                    #     max_accel = 2.0,
+                    #     max_decel = -2.0,
+                    #     freq = freq
+                    # )
+
+                    rs = [round(r, 4) for r in ref_speeds.values(fs_ids)]  # Round to 4 decimal places
+                    # print(f"New r = {rs}")
+
+                    # One call per controller group (FS for every follower by default), then one actuation pass
+                    inputs = {"ref_speed": np.array(rs), "gap": dxs, "dv": dvs, "speed": v_avs,
+                              "leader_speed": speeds[fs - 1], "target_speed": ref_speed}
+                    speed_cmds, accel_cmds = dispatcher.compute(fs_ids, inputs)
+                    held_refs = dict(zip(fs_ids, rs))
+                    if sink is not False:
+                        for follower_id, r in held_refs.items():
+                            sink.record_ref(step, follower_id, r)
+                    if profiler is not None:
+                        profiler.mark(CONTROLLER)
+                    dispatcher.apply(conn, fs_ids, speed_cmds, accel_cmds)
+                    if profiler is not None:
+                        profiler.mark(ACTUATION)
+                elif step >= idm_duration*freq:
+                    # Between control steps SUMO keeps the last commands (zero-order hold)
+                    if sink is not False:
+                        for follower_id, r in held_refs.items():
+                            sink.record_ref(step, follower_id, r)
+                    if profiler is not None:
+                        profiler.mark(CONTROLLER)
+                elif profiler is not None:
+                    profiler.mark(CONTROLLER)
 
         else:
             # Leader profile finished
@@ -135,42 +260,54 @@ def run_simulation(ref_speed, interrupt_time, freq, idm_duration):
                 print(f"Leader profile finished at step {step}, waiting for {len(follower_ids)} followers.")
                 break
 
-        # Record speed and position data
-        for vid in current_ids:
-            speed = round(traci.vehicle.getSpeed(vid), 4)
-            acc = round(traci.vehicle.getAcceleration(vid), 4)
-            x, y = traci.vehicle.getPosition(vid)
-            x = round(x, 4)
-            y = round(y, 4)
-
-            speeds[vid].append(speed)
-            accelerations[vid].append(acc)
-            x_positions[vid].append(x)
-            y_positions[vid].append(y)
-
-            leader_info = traci.vehicle.getLeader(vid)
-            headway = round(leader_info[1], 4) if leader_info else float('nan')
-            # print(f"Step: {step}, Vehicle: {vid}, headway: {headway}")
-            headways[vid].append(headway)
-
-            if step < idm_duration * freq:
-                ref_vels[vid].append(float('nan'))
-
-            if vid not in vehicle_cf_model:
-                try:
-                    vtype = traci.vehicle.getTypeID(vid)
-                    cf_model = vehicle_types.get(vtype, {}).get("carFollowModel", "unknown")
-                    vehicle_cf_model[vid] = cf_model
-                except:
-                    vehicle_cf_model[vid] = "unknown"
-
-        time_log.append(step)
+        # Record speed and position data (rounding happens on export)
+        if recorder is not False:
+            for vid, headway in zip(current_ids, headways.tolist()):
+                state = snapshot[vid]
+                # print(f"Step: {step}, Vehicle: {vid}, headway: {headway}")
+                sink.record(step, vid, state["speed"], state["acceleration"], state["x"], state["y"], headway)
+
+                if vid not in recorder.cf_models:
+                    vtype = state["type"]
+                    recorder.add_vehicle(vid, vehicle_types.get(vtype, {}).get("carFollowModel", "unknown"))
+        if metrics is not None:
+            metrics.update(step, current_ids, speeds, headways)
+        if profiler is not None:
+            profiler.mark(RECORDING)
+            profiler.end_step()
+
         step += 1
 
         if(step==interrupt_time*freq):
-            return time_log, speeds, accelerations, x_positions, y_positions, headways, vehicle_cf_model, ref_vels
-
-    traci.close()
-
-    print(vehicle_cf_model)
-    return time_log, speeds, accelerations, x_positions, y_positions, headways, vehicle_cf_model, ref_vels
+            report_round_trips(conn, setup_round_trips, step)
+            dispatcher.report()
+            report_leader_check(platoon, leader_check)
+            if profiler is not None:
+                profiler.summary()
+            return result()
+
+    conn.close()
+
+    report_round_trips(conn, setup_round_trips, step)
+    dispatcher.report()
+    report_leader_check(platoon, leader_check)
+    if profiler is not None:
+        profiler.summary()
+    if recorder is not False:
+        print(recorder.cf_models)
+    return result()
+
+
+def report_round_trips(conn, setup_round_trips, steps):
+    loop_round_trips = conn.round_trips - setup_round_trips
+    per_step = loop_round_trips / steps if steps else 0.0
+    print(f"TraCI round trips: {conn.round_trips} total, {per_step:.2f} per step over {steps} steps")
+    return per_step
+
+
+def report_leader_check(platoon, leader_check):
+    if not leader_check:
+        return
+    stats = platoon.check_stats
+    print(f"getLeader cross-check: {stats['mismatches']} mismatches in {stats['checked']} checks, "
+          f"max gap error {stats['max_gap_error']:.2e} m")
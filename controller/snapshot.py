@@ -0,0 +1,169 @@
+# controller/snapshot.py
+"""
+Warm-start snapshots of the IDM phase.
+
+Every run spends its first idm_duration seconds in the same IDM warm-up
+before the follower controllers take over. With warm_start enabled,
+run_simulation saves the full state at the switch step: SUMO's own state
+(simulation.saveState) plus the Python side (step counter, platoon order,
+reference speed estimators, recorded prefix, online metrics). Later runs
+with the same warm-up inputs load it (simulation.loadState) and continue
+from the switch step instead of simulating the warm-up again.
+
+Snapshots are content-addressed: the key hashes everything the warm-up
+depends on (SUMO version, net/route file contents, the SUMO options in
+STATE_OPTIONS, freq, idm_duration, the leader profile up to the switch
+step, reference speed estimator specs, what is recorded). Follower
+controller parameters and ref_speed only act after the switch and are not
+part of the key, so a sweep over them shares one snapshot.
+
+SUMO only restores a run exactly when it was started with
+SNAPSHOT_SUMO_ARGS (full-precision state and RNG state); otherwise no
+snapshot is written.
+"""
+import glob
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+from controller.recorder import StreamingRecorder, FIELDS, iter_chunks
+
+SNAPSHOT_CACHE_DIR = "output/cache/snapshots"
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_SUMO_ARGS = ["--save-state.precision", "17", "--save-state.rng"]
+# SUMO options that change the warm-up; config file paths are not hashed, so
+# sweep jobs with their own copies of the same route file share a snapshot
+STATE_OPTIONS = ("seed", "step-length", "begin", "time-to-teleport", "collision.action", "default.action-step-length")
+snapshot_cache_stats = {"hits": 0, "misses": 0, "saved": 0}
+
+
+def _file_digest(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _option(conn, name):
+    try:
+        return conn.simulation.getOption(name)
+    except Exception:
+        return ""
+
+
+def lossless_state(conn):
+    """True if SUMO writes its state with full precision and RNG state (see SNAPSHOT_SUMO_ARGS)."""
+    try:
+        precision = int(_option(conn, "save-state.precision") or 0)
+    except ValueError:
+        return False
+    return precision >= 17 and _option(conn, "save-state.rng") == "true"
+
+
+def warmup_key(conn, freq, idm_duration, profile, ref_speeds, record=True, metrics=None, leader_dist=2000):
+    """
+    sha1 of all inputs the warm-up depends on; ref_speeds is the (fresh)
+    ReferenceSpeeds of the run, record False or (record_every, record_average).
+    """
+    switch_step = int(idm_duration * freq)
+    files = {}
+    for option in ("net-file", "route-files", "additional-files"):
+        for path in filter(None, _option(conn, option).split(",")):
+            files[path] = _file_digest(path)
+    try:
+        version = conn.getVersion()
+    except Exception:
+        version = None
+    inputs = {
+        "format": SNAPSHOT_FORMAT,
+        "version": version,
+        "files": sorted(files.values()),
+        "options": {name: _option(conn, name) for name in STATE_OPTIONS},
+        "freq": float(freq),
+        "idm_duration": float(idm_duration),
+        "profile": hashlib.sha1(np.ascontiguousarray(profile[:switch_step + 1], dtype=float).tobytes()).hexdigest(),
+        "ref_estimators": [ref_speeds.default, ref_speeds.assignment],
+        "record": list(record) if isinstance(record, tuple) else bool(record),
+        "metrics": None if metrics is None else [float(metrics.freq), metrics.window],
+        "leader_dist": float(leader_dist),
+    }
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _paths(key, cache_dir):
+    cache_dir = cache_dir or SNAPSHOT_CACHE_DIR
+    return os.path.join(cache_dir, key + ".state.xml"), os.path.join(cache_dir, key + ".pkl")
+
+
+def save_snapshot(key, conn, state, cache_dir=None):
+    """
+    Write SUMO's state and the pickled Python state under `key`. The pickle
+    is renamed into place last, so its presence marks a complete snapshot.
+    """
+    if not lossless_state(conn):
+        print(f"Warm-start snapshot not saved: start SUMO with {' '.join(SNAPSHOT_SUMO_ARGS)}")
+        return False
+    xml_path, pkl_path = _paths(key, cache_dir)
+    os.makedirs(os.path.dirname(xml_path), exist_ok=True)
+    tmp = f".{os.getpid()}.tmp"
+    conn.simulation.saveState(xml_path + tmp)
+    os.replace(xml_path + tmp, xml_path)
+    with open(pkl_path + tmp, "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(pkl_path + tmp, pkl_path)
+    snapshot_cache_stats["saved"] += 1
+    print(f"Warm-start snapshot saved at step {state['step']} ({key[:12]})")
+    return True
+
+
+def load_snapshot(key, conn, cache_dir=None):
+    """Load the snapshot `key` into the simulation; returns the Python state, or None on a miss."""
+    xml_path, pkl_path = _paths(key, cache_dir)
+    try:
+        with open(pkl_path, "rb") as f:
+            state = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        snapshot_cache_stats["misses"] += 1
+        return None
+    conn.simulation.loadState(xml_path)
+    snapshot_cache_stats["hits"] += 1
+    print(f"Warm start from snapshot at step {state['step']} ({key[:12]})")
+    return state
+
+
+def clear_snapshot_cache(cache_dir=None):
+    for path in glob.glob(os.path.join(cache_dir or SNAPSHOT_CACHE_DIR, "*")):
+        os.remove(path)
+
+
+def recorder_prefix(recorder):
+    """
+    Everything recorded so far as a list of (first_step, ids, cf_models,
+    order, arrays, present) blocks: the flushed chunks of a
+    StreamingRecorder, then the rows in memory.
+    """
+    blocks = []
+    if isinstance(recorder, StreamingRecorder):
+        for meta, arrays, present in iter_chunks(recorder.directory):
+            blocks.append((meta["first_step"], meta["ids"], meta["cf_models"], meta["order"], arrays, present))
+    arrays = {field: getattr(recorder, field).copy() for field in FIELDS}
+    blocks.append((recorder.first_step, list(recorder.ids), dict(recorder.cf_models), list(recorder.order),
+                   arrays, recorder.present.copy()))
+    return blocks
+
+
+def restore_prefix(recorder, blocks):
+    """Replay recorder_prefix() blocks into an empty recorder, row by row (streaming recorders flush as usual)."""
+    for first_step, ids, cf_models, order, arrays, present in blocks:
+        cols = np.array([recorder.add_vehicle(vid, cf_models.get(vid)) for vid in ids], dtype=int)
+        recorder.order = list(order)
+        for row in range(present.shape[0]):
+            mask = present[row]
+            if not mask.any():
+                continue
+            recorder.record_step(first_step + row, *(arrays[field][row, mask] for field in FIELDS),
+                                 cols=cols[mask])
@@ -0,0 +1,124 @@
+# controller/state.py
+import traci.constants as tc
+
+# Variables fetched for every vehicle through one subscription
+VEHICLE_VARS = (tc.VAR_SPEED, tc.VAR_ACCELERATION, tc.VAR_POSITION, tc.VAR_TYPE,
+                tc.VAR_ROAD_ID, tc.VAR_LANEPOSITION)
+
+# Getters that only read the client-side subscription cache (no socket traffic)
+LOCAL_CALLS = {
+    "getAllSubscriptionResults",
+    "getSubscriptionResults",
+    "getAllContextSubscriptionResults",
+    "getContextSubscriptionResults",
+}
+
+
+class _CountingDomain:
+    def __init__(self, domain, counter):
+        self._domain = domain
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._domain, name)
+        if not callable(attr) or name in LOCAL_CALLS:
+            return attr
+
+        def call(*args, **kwargs):
+            self._counter.round_trips += 1
+            return attr(*args, **kwargs)
+        return call
+
+
+class CountingConnection:
+    """
+    Thin proxy around a traci connection (or the traci module itself) that
+    counts every call that needs a response from SUMO.
+
+    Reads from the subscription cache are not counted since traci delivers
+    subscription results together with the simulationStep response.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.round_trips = 0
+        self.vehicle = _CountingDomain(conn.vehicle, self)
+        self.simulation = _CountingDomain(conn.simulation, self)
+        self.lane = _CountingDomain(conn.lane, self)
+
+    def simulationStep(self, *args):
+        self.round_trips += 1
+        return self._conn.simulationStep(*args)
+
+    def close(self):
+        self.round_trips += 1
+        return self._conn.close()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class SubscriptionStateReader:
+    """
+    Fetches the state of all vehicles with TraCI subscriptions instead of
+    per-vehicle getters.
+
+    Every vehicle is subscribed once (speed, acceleration, position, type,
+    road and lane position, plus the leader within leader_dist if `leader` is
+    set). Newly departed vehicles are picked up through a simulation
+    subscription, so after the initial setup a step costs a single round trip
+    (the simulationStep itself).
+
+    fetch() returns a per-step snapshot:
+        {veh_id: {"speed", "acceleration", "x", "y", "type", "road", "lane_pos", "leader"}}
+    where "leader" is (leader_id, gap) or None (always None without `leader`).
+    """
+
+    def __init__(self, conn, leader_dist=2000.0, leader=True):
+        self.conn = conn
+        self.leader_dist = leader_dist
+        self.leader = leader
+        self._subscribed = set()
+
+    def start(self):
+        # Departures are reported with each step so new vehicles can be subscribed
+        self.conn.simulation.subscribe((tc.VAR_DEPARTED_VEHICLES_IDS,))
+        self.subscribe(self.conn.vehicle.getIDList())
+
+    def subscribe(self, vehicle_ids):
+        for vid in vehicle_ids:
+            if vid in self._subscribed:
+                continue
+            if self.leader:
+                self.conn.vehicle.subscribe(vid, VEHICLE_VARS + (tc.VAR_LEADER,),
+                                            parameters={tc.VAR_LEADER: ("d", self.leader_dist)})
+            else:
+                self.conn.vehicle.subscribe(vid, VEHICLE_VARS)
+            self._subscribed.add(vid)
+
+    def fetch(self):
+        departed = self.conn.simulation.getSubscriptionResults().get(tc.VAR_DEPARTED_VEHICLES_IDS, ())
+        if departed:
+            self.subscribe(departed)
+
+        results = self.conn.vehicle.getAllSubscriptionResults()
+        snapshot = {}
+        for vid, values in results.items():
+            x, y = values[tc.VAR_POSITION]
+            leader = values.get(tc.VAR_LEADER)
+            if not leader or leader[0] == "":
+                leader = None
+            snapshot[vid] = {
+                "speed": values[tc.VAR_SPEED],
+                "acceleration": values[tc.VAR_ACCELERATION],
+                "x": x,
+                "y": y,
+                "type": values[tc.VAR_TYPE],
+                "road": values[tc.VAR_ROAD_ID],
+                "lane_pos": values[tc.VAR_LANEPOSITION],
+                "leader": leader,
+            }
+
+        # Vehicles that left the network no longer report results
+        self._subscribed.intersection_update(results.keys())
+        return snapshot
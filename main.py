@@ -7,12 +7,34 @@ from controller.io_utils import *
 from analysis.plot_stability import *
 from controller.vehicle_config import *
 from controller.route_generator import *
+from controller.numpy_engine import NumpyPlatoonEngine
+from controller.recorder import TrajectoryRecorder, StreamingRecorder, load_chunks
+from controller.snapshot import SNAPSHOT_SUMO_ARGS
+from controller.profiler import StepProfiler
+from controller.profile_store import ProfileStore
+from controller.network_builder import build_network
+from controller.catalog import Catalog, config_hash, run_config
+from analysis.online_metrics import OnlineMetrics
+from analysis.string_stability import write_report
 
 ref_speed = 20
 interrupt_time = 500 # in second
 freq = 50
 del_t = 1/freq
 idm_duration = 120 # in second
+chunk_steps = None # e.g. 5000 to stream trajectories to disk during the run
+plot_style = "usetex" # "usetex": publication PDF through LaTeX, "fast": mathtext without LaTeX
+show_plot = True # False never opens a window (e.g. on a headless machine)
+profile_steps = False # True times every step's phases and writes <csv>.profile.json next to the CSV (traci)
+warm_start = False # True restores the IDM warm-up from output/cache/snapshots when it was simulated before (traci)
+profile_store = None # e.g. "output/profiles" (python -m controller.profile_store ingest ...); None uses the bundled CAN drive
+leader_drive = None # drive name in profile_store, or (name, start_s, end_s) for a segment
+control_dt = None # seconds between FS controller updates (multiple of del_t, held in between); None: every step
+record_dt = None # seconds between recorded rows, e.g. 0.1 for 10 Hz output (traci); None: every step
+record_average = False # True records the mean over each record_dt instead of the sample
+network_length = None # e.g. 2000: build a ring lap / straight road of this many meters (controller/network_builder.py)
+network_lanes = 1 # lanes of a built network
+use_catalog = False # True reuses a run with the same configuration hash from output/catalog.sqlite (saved under output/runs/<hash>/)
 
 def main():
     vehicle_plan = [("idm_follower", 7)]
@@ -20,7 +42,20 @@ def main():
     # Select network type
     network_type = "straight"  # Options: "ring", "straight", "circular"
 
-    if network_type == "ring":
+    # Select simulation backend
+    backend = "traci"  # Options: "traci" (SUMO), "numpy" (SUMO-free engine, ring/straight only)
+
+    net_name = network_type
+    leader_dist = 2000
+    if network_length is not None:
+        net = build_network(network_type, network_length, network_lanes)
+        net_name = net.name
+        route_file = f"sumo_config/route/{net.name}.rou.xml"
+        cfg_file = net.write_config(f"sumo_config/config/{net.name}.sumocfg", route_file, del_t)
+        generate_route(vehicle_types, vehicle_plan, net.name, filename=route_file)
+        leader_dist = net.length
+
+    elif network_type == "ring":
         route_file = "sumo_config/route/ring.rou.xml"
         cfg_file = "sumo_config/config/ring.sumocfg"
         generate_ring_route(vehicle_types, vehicle_plan, filename=route_file)
@@ -39,31 +74,82 @@ def main():
         raise ValueError(f"Unknown network type: {network_type}")
 
 
-    # start sumo
-    SUMO_BINARY = "sumo-gui"  # "sumo" Or "sumo-gui" for GUI version
-    os.makedirs(os.path.dirname(cfg_file), exist_ok=True)
-    sumo_cmd = [SUMO_BINARY, "-c", cfg_file, "--step-length", f"{del_t}"]
-    traci.start(sumo_cmd)
-    
     #reference speed
     global ref_speed
 
-    # Get all recorded simulation data
-    time_log, speeds, accelerations, x_positions, y_positions, headways, cf_models, ref_vels = run_simulation(ref_speed, interrupt_time, freq, idm_duration)
+    if chunk_steps:
+        recorder = StreamingRecorder(f"output/{network_type}/chunks", chunk_steps)
+    else:
+        recorder = TrajectoryRecorder(-(-interrupt_time * freq // steps_per(record_dt, freq, "record_dt")))
+    profiler = StepProfiler(freq) if profile_steps else None
+
+    leader_profile = None
+    if profile_store is not None:
+        drive, start, end = (leader_drive, 0.0, None) if isinstance(leader_drive, str) else leader_drive
+        leader_profile = ProfileStore(profile_store).profile(drive, freq, start, end)
+
+    catalog = cached = metrics = None
+    if use_catalog:
+        catalog = Catalog()
+        config = run_config(ref_speed, interrupt_time, freq, idm_duration, vehicle_plan, vehicle_types, net_name,
+                            network_files[net_name], route_file, leader_profile, backend, control_dt=control_dt,
+                            record_dt=record_dt, record_average=record_average, leader_dist=leader_dist)
+        key = config_hash(config)
+        cached = catalog.lookup(key, trajectories=True)
+        metrics = OnlineMetrics(freq)
+
+    if cached is not None:
+        print(f"Cataloged run {key[:12]}: {cached['trajectories']}")
+        recorder = load_trajectories(cached["trajectories"])
 
+    elif backend == "numpy":
+        engine = NumpyPlatoonEngine(vehicle_types, vehicle_plan, freq, network_type=net_name, leader_dist=leader_dist)
+        # The engine raises on control_dt/record_dt rather than running at full rate
+        run_simulation(ref_speed, interrupt_time, freq, idm_duration, engine=engine, recorder=recorder,
+                       metrics=metrics, leader_profile=leader_profile, control_dt=control_dt, record_dt=record_dt,
+                       record_average=record_average)
 
-    n_followers = len(speeds) - 1 # number of followers
+    else:
+        # start sumo
+        SUMO_BINARY = "sumo-gui"  # "sumo" Or "sumo-gui" for GUI version
+        os.makedirs(os.path.dirname(cfg_file), exist_ok=True)
+        sumo_cmd = [SUMO_BINARY, "-c", cfg_file, "--step-length", f"{del_t}"]
+        if warm_start:
+            sumo_cmd += SNAPSHOT_SUMO_ARGS
+        traci.start(sumo_cmd)
+
+        # Get all recorded simulation data
+        run_simulation(ref_speed, interrupt_time, freq, idm_duration, recorder=recorder, metrics=metrics,
+                       warm_start=warm_start, profiler=profiler, leader_profile=leader_profile, control_dt=control_dt, record_dt=record_dt,
+                       record_average=record_average, leader_dist=leader_dist)
+
+
+    if chunk_steps and cached is None:
+        recorder.close()
+        recorder = load_chunks(recorder.directory)
+
+    n_followers = len(recorder.ids) - 1 # number of followers
     plot_path = f"figures/{network_type}/04092025_latest_09042025_{freq}_IDM_FS_followers_{n_followers}.pdf"
     os.makedirs(os.path.dirname(plot_path), exist_ok=True)
     csv_path = f"output/{network_type}/04092025_latest_{freq}_IDM_FS_followers_{n_followers}.csv"
+    if use_catalog:
+        csv_path = f"output/runs/{key}/trajectories.csv"
     os.makedirs(os.path.dirname(csv_path), exist_ok=True)
 
-    # Save full simulation data to CSV
-    save_simulation_to_csv(
-        time_log, speeds, accelerations, x_positions, y_positions, headways, ref_vels,
-        save_path=csv_path
-    )
-    plot_speeds(time_log, ref_speed, speeds, cf_models=cf_models, ref_vels = ref_vels, del_t = del_t, save_path=plot_path, xlim_start=0, xlim_end=200, ylim_bottom=None, ylim_top=None)
+    # Save full simulation data to CSV (use a .npz or .parquet path for binary output)
+    if cached is None:
+        save_trajectories(recorder, csv_path)
+    if profiler is not None and profiler.n_steps:
+        profiler.write(os.path.splitext(csv_path)[0] + ".profile.json")
+    if use_catalog and cached is None:
+        report = metrics.report()
+        metrics_path = os.path.join(os.path.dirname(csv_path), "metrics.json")
+        write_report(report, metrics_path)
+        catalog.register(key, config, trajectories=csv_path, metrics=report, metrics_path=metrics_path)
+
+    time_log, speeds, accelerations, x_positions, y_positions, headways, cf_models, ref_vels = recorder.legacy_outputs()
+    plot_speeds(time_log, ref_speed, speeds, cf_models=cf_models, ref_vels = ref_vels, del_t = record_dt or del_t, save_path=plot_path, xlim_start=0, xlim_end=200, ylim_bottom=None, ylim_top=None,
+                style=plot_style, show=show_plot)
 
 if __name__ == "__main__":
     main()
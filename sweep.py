@@ -0,0 +1,312 @@
+"""
+Parameter sweep over ref_speed, freq, idm_duration, vehicle_plan and network_type.
+
+Every job runs in its own process with its own SUMO instance (labelled
+traci connection on a free port) and its own route/config files under
+<out_dir>/<job_name>/, so concurrent jobs never touch sumo_config/route/.
+
+    python sweep.py --workers 32 --timeout 3600
+    python sweep.py --grid my_grid.json --backend numpy
+    python sweep.py --grid fs_params.json --warm-start
+    python sweep.py --grid drives.json --profile-store output/profiles
+    python sweep.py --catalog output/catalog.sqlite
+
+With --catalog, every job is looked up by the hash of its configuration
+(controller/catalog.py) before it runs: a job computed before returns the
+cataloged trajectories and metrics with status "cached", new jobs are
+registered when they finish.
+
+A network_type is "ring", "straight" or "circular" (the networks under
+sumo_config/network/), or {"kind": "ring", "length": 2000, "lanes": 1} for a
+network from controller/network_builder.py, built once and shared by all
+jobs through its cache.
+"""
+import argparse
+import itertools
+import json
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import sumolib
+import traci
+
+from controller.simulation import run_simulation, steps_per
+from controller.io_utils import save_trajectories
+from controller.recorder import TrajectoryRecorder, StreamingRecorder
+from controller.vehicle_config import vehicle_types
+from controller.route_generator import *
+from controller.numpy_engine import NumpyPlatoonEngine
+from controller.snapshot import SNAPSHOT_SUMO_ARGS
+from controller.profiler import StepProfiler
+from controller.profile_store import ProfileStore
+from controller.network_builder import build_network, network_label
+from controller.catalog import Catalog, config_hash, run_config
+from analysis.online_metrics import OnlineMetrics
+from analysis.string_stability import write_report
+
+interrupt_time = 500 # in second
+
+# Default grid; every combination becomes one job
+param_grid = {
+    "ref_speed": [15, 20, 25, 30, 35],
+    "freq": [50],
+    "idm_duration": [120],
+    "vehicle_plan": [[("idm_follower", 7)]],
+    "network_type": ["straight"],
+}
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def expand_grid(grid):
+    keys = list(grid)
+    jobs = []
+    for job_id, values in enumerate(itertools.product(*(grid[k] for k in keys))):
+        job = dict(zip(keys, values))
+        job["job_id"] = job_id
+        # [vtype, count] blocks, or an explicit sequence of follower types (route_generator.plan_sequence)
+        job["vehicle_plan"] = [entry if isinstance(entry, str) else tuple(entry) for entry in job["vehicle_plan"]]
+        job["name"] = job_name(job)
+        jobs.append(job)
+    return jobs
+
+
+def job_name(job):
+    sequence = plan_sequence(job["vehicle_plan"])
+    blocks = [(vtype, len(list(group))) for vtype, group in itertools.groupby(sequence)]
+    if len(blocks) > 4:
+        # Interleaved plan: counts per type
+        blocks = [(vtype, sequence.count(vtype)) for vtype in dict.fromkeys(sequence)] + [("mix", "")]
+    plan = "_".join(f"{vtype.replace('_follower', '')}{count}" for vtype, count in blocks)
+    network = job["network_type"]
+    if isinstance(network, dict):
+        network = network_label(network["kind"], network["length"], network.get("lanes", 1))
+    name = f"{job['job_id']:03d}_{network}_r{job['ref_speed']}_f{job['freq']}_idm{job['idm_duration']}_{plan}"
+    return f"{name}_{job['drive']}" if job.get("drive") is not None else name
+
+
+def _raise_timeout(signum, frame):
+    raise JobTimeout()
+
+
+def run_job(job, out_dir, timeout=None, backend="traci", sumo_binary="sumo", fmt="csv", chunk_steps=None,
+            metrics_only=False, warm_start=False, profile=False, profile_store=None, catalog=None, use_cache=True):
+    """
+    Run one sweep job in the current process and return its summary row.
+    With chunk_steps, trajectories are streamed to <job_dir>/chunks/ in npz or
+    parquet shards, so a timed-out or crashed job keeps its completed chunks.
+    String-stability and safety metrics are accumulated during the run and
+    saved to <job_dir>/metrics.json; with metrics_only no trajectories are
+    kept or written. With warm_start, jobs that share the IDM warm-up restore
+    it from the snapshot cache (controller/snapshot.py) instead of simulating
+    it again. With profile, the phases of every step are timed and saved to
+    <job_dir>/profile.json (traci backend). A "drive" in the job picks the
+    leader drive from the profile_store directory (controller/profile_store.py).
+    Optional "control_dt", "record_dt" and "record_average" job keys set the
+    controller and recording rates (traci backend). With a catalog path, a
+    job whose configuration hash is cataloged (and use_cache) returns the
+    cataloged result; computed jobs are registered.
+    """
+    job_dir = os.path.join(out_dir, job["name"])
+    os.makedirs(job_dir, exist_ok=True)
+    route_file = os.path.join(job_dir, "route.rou.xml")
+    cfg_file = os.path.join(job_dir, "run.sumocfg")
+    csv_path = os.path.join(job_dir, f"trajectories.{fmt}")
+    freq = job["freq"]
+
+    summary = {"name": job["name"], "status": "ok", "port": None, "runtime_s": None, "csv": csv_path,
+               "head_to_tail_amplification": None, "min_ttc": None}
+    conn = None
+    metrics = OnlineMetrics(freq)
+    profiler = StepProfiler(freq) if profile and backend != "numpy" else None
+
+    # Per-job timeout through SIGALRM (not available on Windows)
+    if timeout and hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.alarm(int(timeout))
+
+    start = time.perf_counter()
+    try:
+        leader_profile = None
+        if job.get("drive") is not None:
+            if profile_store is None:
+                raise ValueError("jobs with a drive need --profile-store")
+            leader_profile = ProfileStore(profile_store).profile(job["drive"], freq)
+
+        network_type, leader_dist = job["network_type"], 2000
+        if isinstance(network_type, dict):
+            net = build_network(**network_type)
+            network_type, leader_dist = net.name, net.length
+            generate_route(vehicle_types, job["vehicle_plan"], network_type, filename=route_file)
+        elif network_type == "ring":
+            generate_ring_route(vehicle_types, job["vehicle_plan"], filename=route_file)
+        else:
+            generate_straight_route(vehicle_types, job["vehicle_plan"], filename=route_file)
+
+        if catalog is not None:
+            catalog = Catalog(catalog)
+            config = run_config(job["ref_speed"], interrupt_time, freq, job["idm_duration"], job["vehicle_plan"],
+                                vehicle_types, network_type, network_files[network_type], route_file,
+                                leader_profile, backend, control_dt=job.get("control_dt"),
+                                record_dt=job.get("record_dt"), record_average=job.get("record_average", False),
+                                leader_dist=leader_dist)
+            key = config_hash(config)
+            cached = catalog.lookup(key, trajectories=not metrics_only) if use_cache else None
+            if cached is not None:
+                amplification, min_ttc = cached["head_to_tail_amplification"], cached["min_ttc"]
+                summary.update(status="cached", csv=None if metrics_only else cached["trajectories"],
+                               head_to_tail_amplification=None if amplification is None else round(amplification, 4),
+                               min_ttc=None if min_ttc is None else round(min_ttc, 3),
+                               runtime_s=round(time.perf_counter() - start, 2))
+                return summary
+
+        if metrics_only:
+            summary["csv"] = None
+            recorder = False
+        elif chunk_steps:
+            csv_path = os.path.join(job_dir, "chunks")
+            summary["csv"] = csv_path
+            recorder = StreamingRecorder(csv_path, chunk_steps, fmt="parquet" if fmt == "parquet" else "npz")
+        else:
+            record_every = steps_per(job.get("record_dt"), freq, "record_dt")
+            recorder = TrajectoryRecorder(-(-interrupt_time * freq // record_every))
+        if backend == "numpy":
+            engine = NumpyPlatoonEngine(vehicle_types, job["vehicle_plan"], freq, network_type=network_type,
+                                        leader_dist=leader_dist)
+            run_simulation(job["ref_speed"], interrupt_time, freq, job["idm_duration"], engine=engine, recorder=recorder,
+                           metrics=metrics, leader_profile=leader_profile, control_dt=job.get("control_dt"),
+                           record_dt=job.get("record_dt"), record_average=job.get("record_average", False))
+        else:
+            write_sumo_config(cfg_file, network_files[network_type], route_file, step_length=1/freq)
+            port = sumolib.miscutils.getFreeSocketPort()
+            summary["port"] = port
+            label = f"sweep_{job['name']}"
+            extra = SNAPSHOT_SUMO_ARGS if warm_start else []
+            traci.start([sumo_binary, "-c", cfg_file, "--step-length", f"{1/freq}", "--no-step-log"] + extra,
+                        port=port, label=label)
+            conn = traci.getConnection(label)
+            run_simulation(job["ref_speed"], interrupt_time, freq, job["idm_duration"], conn=conn, recorder=recorder,
+                           metrics=metrics, warm_start=warm_start, profiler=profiler,
+                           leader_profile=leader_profile, control_dt=job.get("control_dt"),
+                           record_dt=job.get("record_dt"), record_average=job.get("record_average", False),
+                           leader_dist=leader_dist)
+
+        if chunk_steps and not metrics_only:
+            recorder.close()
+        elif not metrics_only:
+            save_trajectories(recorder, csv_path)
+
+        if profiler is not None:
+            profiler.write(os.path.join(job_dir, "profile.json"))
+        report = metrics.report()
+        write_report(report, os.path.join(job_dir, "metrics.json"))
+        ttcs = [ttc for ttc in report["per_follower"]["min_ttc"] or [] if ttc is not None]
+        amplification = report["head_to_tail_amplification"]
+        summary["head_to_tail_amplification"] = round(amplification, 4) if amplification is not None else None
+        summary["min_ttc"] = round(min(ttcs), 3) if ttcs else None
+        if catalog is not None:
+            catalog.register(key, config, trajectories=summary["csv"], metrics=report,
+                             metrics_path=os.path.join(job_dir, "metrics.json"),
+                             runtime_s=round(time.perf_counter() - start, 2))
+
+    except JobTimeout:
+        summary["status"] = "timeout"
+    except Exception as exc:
+        summary["status"] = f"error: {exc!r}"
+    finally:
+        if timeout and hasattr(signal, "SIGALRM"):
+            signal.alarm(0)
+        if backend != "numpy":
+            close_sumo(conn, f"sweep_{job['name']}")
+        if isinstance(catalog, Catalog):
+            catalog.close()
+
+    summary["runtime_s"] = round(time.perf_counter() - start, 2)
+    return summary
+
+
+def close_sumo(conn, label):
+    """Close the job's SUMO instance, killing it if the connection is left mid-command (e.g. after a timeout)."""
+    if conn is None:
+        try:
+            conn = traci.getConnection(label)
+        except traci.TraCIException:
+            return  # SUMO never came up
+    try:
+        conn.close()
+    except Exception:
+        process = getattr(conn, "_process", None)
+        if process is not None and process.poll() is None:
+            process.kill()
+
+
+def run_sweep(jobs, out_dir, workers=None, timeout=None, backend="traci", sumo_binary="sumo", fmt="csv", chunk_steps=None,
+              metrics_only=False, warm_start=False, profile=False, profile_store=None, catalog=None, use_cache=True):
+    os.makedirs(out_dir, exist_ok=True)
+    summaries = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, job, out_dir, timeout, backend, sumo_binary, fmt, chunk_steps,
+                               metrics_only, warm_start, profile, profile_store, catalog, use_cache): job for job in jobs}
+        for future in as_completed(futures):
+            summary = future.result()
+            print(f"[{len(summaries) + 1}/{len(jobs)}] {summary['name']}: {summary['status']} ({summary['runtime_s']} s)")
+            summaries.append(summary)
+
+    summaries.sort(key=lambda row: row["name"])
+    write_summary(summaries, os.path.join(out_dir, "summary.csv"))
+    return summaries
+
+
+def write_summary(summaries, path):
+    import pandas as pd
+
+    df = pd.DataFrame(summaries, columns=["name", "status", "port", "runtime_s", "csv",
+                                         "head_to_tail_amplification", "min_ttc"])
+    df.to_csv(path, index=False)
+    print(df[["name", "status", "runtime_s", "head_to_tail_amplification"]].to_string(index=False))
+    print(f"Total job time: {df['runtime_s'].sum():.1f} s, summary saved to: {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a parameter sweep in a process pool.")
+    parser.add_argument("--grid", help="JSON file with the parameter grid (defaults to param_grid)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of concurrent jobs")
+    parser.add_argument("--timeout", type=float, default=None, help="per-job timeout in seconds")
+    parser.add_argument("--backend", choices=["traci", "numpy"], default="traci")
+    parser.add_argument("--sumo-binary", default="sumo")
+    parser.add_argument("--format", choices=["csv", "npz", "parquet"], default="csv", help="trajectory file format")
+    parser.add_argument("--chunk-steps", type=int, default=None,
+                        help="stream trajectories to disk every N steps (npz shards, or parquet with --format parquet)")
+    parser.add_argument("--metrics-only", action="store_true",
+                        help="only keep the online string-stability/safety metrics (metrics.json), no trajectories")
+    parser.add_argument("--warm-start", action="store_true",
+                        help="restore the IDM warm-up from the snapshot cache when jobs share it (traci backend)")
+    parser.add_argument("--profile", action="store_true",
+                        help="time the phases of every step and write <job>/profile.json (traci backend)")
+    parser.add_argument("--profile-store",
+                        help="leader drive store (controller/profile_store.py) for grids with a \"drive\" key")
+    parser.add_argument("--catalog", help="run catalog (e.g. output/catalog.sqlite): reuse cataloged jobs, register new ones")
+    parser.add_argument("--no-cache", action="store_true", help="with --catalog, rerun cataloged jobs and replace them")
+    parser.add_argument("--out", default=f"output/sweeps/{time.strftime('%Y%m%d_%H%M%S')}")
+    args = parser.parse_args()
+
+    grid = param_grid
+    if args.grid:
+        with open(args.grid) as f:
+            grid = json.load(f)
+
+    jobs = expand_grid(grid)
+    print(f"Running {len(jobs)} jobs on {args.workers} workers -> {args.out}")
+    run_sweep(jobs, args.out, workers=args.workers, timeout=args.timeout,
+              backend=args.backend, sumo_binary=args.sumo_binary, fmt=args.format,
+              chunk_steps=args.chunk_steps, metrics_only=args.metrics_only, warm_start=args.warm_start,
+              profile=args.profile, profile_store=args.profile_store, catalog=args.catalog,
+              use_cache=not args.no_cache)
+
+
+if __name__ == "__main__":
+    main()